@@ -0,0 +1,345 @@
+"""
+PUT/GET throughput and latency, and time to full replication, of a local cluster
+
+Starts the master, --nodes storage nodes and a Celery replication worker on
+localhost ports, with a filesystem Celery broker (local_broker.py) instead of
+redis and all the state (DB, storage dirs, broker queue) in a throwaway work
+dir. Puts --files
+files with sizes drawn from --sizes, --concurrency at a time, through
+client.py, gets them all back, and prints the results as JSON.
+
+$ python benchmarks/cluster_benchmark.py --nodes 3 --files 200 --sizes 4KB:70,1MB:25,16MB:5 --concurrency 8
+$ python benchmarks/cluster_benchmark.py --set compression.codec=zlib --output results.json
+"""
+import argparse
+import configparser
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_NAME = os.path.basename(__file__)
+NODE = '127.0.0.1'
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+STARTUP_TIMEOUT = 30
+REPLICATION_POLL_INTERVAL = 0.05
+WARMUP_FILE_SIZE = 1024
+BROKER_POLLING_INTERVAL = 0.05
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser(prog=SCRIPT_NAME)
+    parser.add_argument('--nodes', type=int, default=3, help="storage nodes to start")
+    parser.add_argument('--replication-factor', type=int, default=1, help="replicas of every file")
+    parser.add_argument('--files', type=int, default=100, help="files to put and get")
+    parser.add_argument('--sizes', default='4KB:70,1MB:25,8MB:5',
+                        help="file size distribution as SIZE:WEIGHT,... (units B, KB, MB, GB)")
+    parser.add_argument('--concurrency', type=int, default=8, help="transfers in flight")
+    parser.add_argument('--direct', action='store_true', help="move the data directly to/from the storage nodes")
+    parser.add_argument('--base-port', type=int, default=5600,
+                        help="master port; the storage nodes take the following ones")
+    parser.add_argument('--worker-concurrency', type=int, default=4, help="replication worker processes")
+    parser.add_argument('--replication-timeout', type=float, default=120,
+                        help="seconds to wait for the replicas once all the files are put")
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                        help="override a dfs.cfg setting, e.g. chunking.enabled=true")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the file sizes and contents")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--keep-work-dir', action='store_true', help="keep the DB, storage dirs and logs")
+    args = parser.parse_args()
+    if args.nodes <= args.replication_factor:
+        parser.error("--nodes must be greater than --replication-factor")
+    return args
+
+def parse_size(size):
+    size = size.strip().upper()
+    for unit in sorted(SIZE_UNITS, key=len, reverse=True):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * SIZE_UNITS[unit])
+    return int(size)
+
+def parse_size_distribution(sizes):
+    distribution = []
+    for item in sizes.split(','):
+        size, _, weight = item.partition(':')
+        distribution.append((parse_size(size), float(weight or 1)))
+    return distribution
+
+def setup_cluster_config(work_dir, args):
+    master_port = args.base_port
+    sn_ports = [args.base_port + 1 + i for i in range(args.nodes)]
+    broker_dir = os.path.join(work_dir, 'broker')
+    os.makedirs(broker_dir)
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(PROJECT_ROOT, 'dfs.cfg'))
+    config['default']['database'] = os.path.join(work_dir, 'dfs.db')
+    config['default']['replication_factor'] = str(args.replication_factor)
+    config['master']['server_endpoint'] = f"{NODE}:{master_port}"
+    config['storage_nodes']['machine_list_docker'] = ',\n'.join(f"{NODE}:{port}" for port in sn_ports)
+    config['docker_host_node_mapping']['mapping'] = '{}'
+    config['replication']['storage_root'] = work_dir
+    config['replication']['slots_dir'] = os.path.join(work_dir, 'replication_slots')
+    config['celery'] = {
+        'broker_url': 'filesystem://',
+        'broker_transport': 'local_broker:Transport',
+        'result_backend': '',
+        # the worker polls the queue dir; keep its 1s default from dominating the replication times
+        'broker_transport_options': json.dumps({
+            'data_folder_in': broker_dir,
+            'data_folder_out': broker_dir,
+            'polling_interval': BROKER_POLLING_INTERVAL
+        })
+    }
+    for override in args.overrides:
+        key, _, value = override.partition('=')
+        section, _, option = key.partition('.')
+        if section not in config:
+            config[section] = {}
+        config[section][option] = value
+
+    config_file = os.path.join(work_dir, 'dfs.cfg')
+    with open(config_file, 'w') as fp:
+        config.write(fp)
+    os.environ['DFS_CONFIG'] = config_file
+    return master_port, sn_ports
+
+def start_process(cmd, work_dir, log_name, **env):
+    # local_broker, the Celery transport, is in the benchmarks dir
+    process_env = dict(os.environ, PYTHONPATH=os.pathsep.join([PROJECT_ROOT, BENCHMARKS_DIR]), **env)
+    log_file = open(os.path.join(work_dir, log_name), 'w')
+    return subprocess.Popen(cmd, cwd=work_dir, env=process_env, stdout=log_file, stderr=subprocess.STDOUT)
+
+def start_cluster(work_dir, master_port, sn_ports, args):
+    processes = []
+    for port in sn_ports:
+        processes.append(start_process(
+            [sys.executable, os.path.join(PROJECT_ROOT, 'storage_node_app.py')],
+            work_dir, f"sn_{port}.log", NODE=NODE, PORT=str(port)
+        ))
+    processes.append(start_process(
+        [sys.executable, os.path.join(PROJECT_ROOT, 'master_app.py')],
+        work_dir, 'master.log', NODE='master', PORT=str(master_port)
+    ))
+    processes.append(start_process(
+        [sys.executable, '-m', 'celery', '-A', 'dfs_celery_tasks', 'worker',
+         '--loglevel=info', f"--concurrency={args.worker_concurrency}"],
+        work_dir, 'worker.log'
+    ))
+    return processes
+
+def stop_cluster(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def wait_until_up(urls, processes):
+    import requests
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    pending = list(urls)
+    while pending:
+        if time.monotonic() > deadline:
+            raise Exception(f"Not up after {STARTUP_TIMEOUT}s: {pending}")
+        for process in processes:
+            if process.poll() is not None:
+                raise Exception(f"{process.args} exited with {process.returncode}; see the logs in the work dir.")
+        try:
+            if requests.get(pending[0], timeout=1).status_code == requests.codes.ok:
+                pending.pop(0)
+                continue
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.1)
+
+def create_files(files_dir, count, distribution, seed, prefix='bench'):
+    rnd = random.Random(seed)
+    sizes, weights = zip(*distribution)
+    filepaths = []
+    for idx, size in enumerate(rnd.choices(sizes, weights=weights, k=count)):
+        filepath = os.path.join(files_dir, f"{prefix}_{idx:06d}.bin")
+        with open(filepath, 'wb') as fp:
+            fp.write(rnd.getrandbits(size * 8).to_bytes(size, 'little') if size else b"")
+        filepaths.append(filepath)
+    return filepaths
+
+"""
+Track the time from the end of each PUT until the file has all its replicas
+"""
+class ReplicationWatcher:
+    def __init__(self, replication_factor):
+        self.replication_factor = replication_factor
+        self.pending = {}
+        self.durations = []
+        self.lock = threading.Lock()
+
+    def add(self, filename):
+        with self.lock:
+            self.pending[filename] = time.monotonic()
+
+    def poll(self):
+        import metadata_store
+        with self.lock:
+            pending = list(self.pending.items())
+        for filename, stored_at in pending:
+            if len(metadata_store.get_sns_with_file_copy(filename)) >= self.replication_factor:
+                with self.lock:
+                    del self.pending[filename]
+                    self.durations.append(time.monotonic() - stored_at)
+
+    def wait(self, timeout, stop_event=None):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.poll()
+            if stop_event is None and not self.pending:
+                return
+            if stop_event is not None and stop_event.is_set():
+                return
+            time.sleep(REPLICATION_POLL_INTERVAL)
+
+def run_transfers(transfer, items, concurrency):
+    latencies = []
+    errors = []
+
+    def timed(item):
+        start = time.perf_counter()
+        result = transfer(item)
+        latency = time.perf_counter() - start
+        if result['status_code'] == 200:
+            latencies.append(latency)
+        else:
+            errors.append({'item': os.path.basename(item), 'result': result})
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, items))
+    return time.monotonic() - start, sorted(latencies), errors
+
+def summarize(seconds, latencies, errors, num_bytes):
+    return {
+        'files': len(latencies),
+        'errors': len(errors),
+        'first_errors': errors[:5],
+        'bytes': num_bytes,
+        'seconds': round(seconds, 3),
+        'files_per_sec': round(len(latencies) / seconds, 1) if seconds else 0,
+        'mb_per_sec': round(num_bytes / seconds / SIZE_UNITS['MB'], 2) if seconds else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3)
+    }
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[idx]
+
+def run_benchmark(work_dir, args):
+    import client
+    client.show_file_messages = False
+
+    files_dir = os.path.join(work_dir, 'files')
+    os.makedirs(files_dir)
+    distribution = parse_size_distribution(args.sizes)
+    filepaths = create_files(files_dir, args.files, distribution, args.seed)
+    total_bytes = sum(os.path.getsize(filepath) for filepath in filepaths)
+
+    # also waits for the worker to consume the broker queue
+    watcher = ReplicationWatcher(args.replication_factor)
+    warmup = create_files(files_dir, 1, [(WARMUP_FILE_SIZE, 1)], args.seed, prefix='warmup')[0]
+    if client.put_file_at_server(warmup, direct=args.direct)['status_code'] != 200:
+        raise Exception("Warm-up PUT failed; see the logs in the work dir.")
+    watcher.add(os.path.basename(warmup))
+    watcher.wait(STARTUP_TIMEOUT)
+    if watcher.pending:
+        raise Exception("Warm-up file not replicated; see worker.log in the work dir.")
+    watcher.durations.clear()
+
+    def put(filepath):
+        result = client.put_file_at_server(filepath, direct=args.direct)
+        if result['status_code'] == 200:
+            watcher.add(os.path.basename(filepath))
+        return result
+
+    puts_done = threading.Event()
+    watcher_thread = threading.Thread(target=watcher.wait, args=(float('inf'), puts_done), daemon=True)
+    watcher_thread.start()
+    put_seconds, put_latencies, put_errors = run_transfers(put, filepaths, args.concurrency)
+    puts_done.set()
+    watcher_thread.join()
+    watcher.wait(args.replication_timeout)
+
+    def get(filepath):
+        return client.request_file_from_server(os.path.basename(filepath), direct=args.direct)
+
+    get_seconds, get_latencies, get_errors = run_transfers(get, filepaths, args.concurrency)
+
+    replication_durations = sorted(watcher.durations)
+    return {
+        'config': {
+            'nodes': args.nodes,
+            'replication_factor': args.replication_factor,
+            'files': args.files,
+            'sizes': args.sizes,
+            'concurrency': args.concurrency,
+            'direct': args.direct,
+            'overrides': args.overrides
+        },
+        'put': summarize(put_seconds, put_latencies, put_errors, total_bytes),
+        'get': summarize(get_seconds, get_latencies, get_errors, total_bytes),
+        'replication': {
+            'replicated': len(replication_durations),
+            'not_replicated': len(watcher.pending),
+            'p50_ms': round(percentile(replication_durations, 50) * 1000, 3),
+            'p99_ms': round(percentile(replication_durations, 99) * 1000, 3),
+            'max_ms': round(replication_durations[-1] * 1000, 3) if replication_durations else 0
+        }
+    }
+
+def main():
+    args = parse_cmd_args()
+    sys.path.insert(0, PROJECT_ROOT)
+    work_dir = tempfile.mkdtemp(prefix='dfs_bench_')
+    cwd = os.getcwd()
+    processes = []
+    try:
+        master_port, sn_ports = setup_cluster_config(work_dir, args)
+        # the client writes what it gets to received_files in the working dir
+        os.chdir(work_dir)
+        import one_time_setup
+        with redirect_stdout(sys.stderr):
+            one_time_setup.main()
+        processes = start_cluster(work_dir, master_port, sn_ports, args)
+        wait_until_up(
+            [f"http://{NODE}:{port}/health" for port in sn_ports] + [f"http://{NODE}:{master_port}/test"],
+            processes
+        )
+        results = run_benchmark(work_dir, args)
+    finally:
+        stop_cluster(processes)
+        os.chdir(cwd)
+        if args.keep_work_dir:
+            print(f"Work dir kept at {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+kombu filesystem transport whose messages appear atomically
+
+The benchmark's stand-in for redis. kombu's filesystem transport creates the
+message file and then writes it, so a worker polling the queue dir can pick
+up an empty file, and dies decoding it. Here a message is written under a
+staging dir and renamed into the queue dir, where consumers only ever see it
+complete. Used with [celery] broker_url = filesystem:// and
+broker_transport = local_broker:Transport.
+"""
+import os
+import time
+import uuid
+
+from kombu.transport import filesystem
+from kombu.utils.encoding import str_to_bytes
+from kombu.utils.json import dumps
+
+STAGING_DIR = 'staging'
+
+
+class Channel(filesystem.Channel):
+    def _put(self, queue, payload, **kwargs):
+        filename = f"{int(round(time.monotonic() * 1000))}_{uuid.uuid4()}.{queue}.msg"
+        staging_dir = os.path.join(self.data_folder_out, STAGING_DIR)
+        os.makedirs(staging_dir, exist_ok=True)
+        staging_filepath = os.path.join(staging_dir, filename)
+        with open(staging_filepath, 'wb') as fp:
+            fp.write(str_to_bytes(dumps(payload)))
+        os.replace(staging_filepath, os.path.join(self.data_folder_out, filename))
+
+
+class Transport(filesystem.Transport):
+    Channel = Channel
@@ -0,0 +1,135 @@
+"""
+Metadata ops/sec under concurrent load
+
+Runs the PUT + replication metadata workload (reserve a unique name, set its
+primary node, look it up, record two replicas, list the replicas) from many
+threads against a throwaway DB, once with metadata_store and once with the
+previous connection-per-call helpers, and prints the results as JSON.
+
+$ python benchmarks/metadata_benchmark.py --threads 16 --duration 5
+"""
+import argparse
+import configparser
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_NAME = os.path.basename(__file__)
+OPS_PER_ITERATION = 5
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser(prog=SCRIPT_NAME)
+    parser.add_argument('--threads', type=int, default=16, help="concurrent workers")
+    parser.add_argument('--duration', type=float, default=5, help="seconds to run each mode for")
+    parser.add_argument('--mode', choices=['store', 'legacy', 'both'], default='both')
+    return parser.parse_args()
+
+def setup_cluster_config(work_dir):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(PROJECT_ROOT, 'dfs.cfg'))
+    config['default']['database'] = os.path.join(work_dir, 'bench.db')
+    config_file = os.path.join(work_dir, 'dfs.cfg')
+    with open(config_file, 'w') as fp:
+        config.write(fp)
+    os.environ['DFS_CONFIG'] = config_file
+    return config['default']['database']
+
+def create_tables(db_name):
+    import one_time_setup
+    conn = sqlite3.connect(db_name)
+    conn.execute(one_time_setup.get_sql_create_master_table())
+    conn.execute(one_time_setup.get_sql_create_replication_table())
+    conn.close()
+
+def store_iteration(worker_id, count):
+    import metadata_store
+    filename = metadata_store.reserve_unique_filename(f"file_{worker_id}_{count}.txt")
+    metadata_store.update_master_table(filename, 'sn0:5000')
+    metadata_store.return_pnode_of_file(filename)
+    metadata_store.add_replication_records([(filename, 'sn1:5050'), (filename, 'sn2:6000')])
+    metadata_store.get_sns_with_file_copy(filename)
+
+def legacy_execute(db_name, sql_stmt, fetch=False):
+    conn = sqlite3.connect(db_name, timeout=30)
+    cur = conn.cursor()
+    with conn:
+        cur.execute(sql_stmt)
+        data = cur.fetchall() if fetch else None
+    conn.close()
+    return data
+
+def legacy_iteration(db_name, worker_id, count):
+    filename = f"legacy_{worker_id}_{count}.txt"
+    legacy_execute(db_name, f'SELECT filename FROM master_node WHERE filename="{filename}";', fetch=True)
+    legacy_execute(db_name, f'INSERT INTO master_node (filename, primary_node) VALUES ("{filename}", "sn0:5000");')
+    legacy_execute(db_name, f'SELECT primary_node FROM master_node WHERE filename="{filename}";', fetch=True)
+    for node in ['sn1:5050', 'sn2:6000']:
+        legacy_execute(db_name, f'INSERT INTO replication_data (filename, replicated_node) VALUES ("{filename}", "{node}");')
+    legacy_execute(db_name, f'SELECT replicated_node FROM replication_data WHERE filename="{filename}";', fetch=True)
+
+def run_workload(iteration, threads, duration):
+    iterations = [0] * threads
+    errors = [0] * threads
+    latencies = [[] for _ in range(threads)]
+    deadline = time.monotonic() + duration
+
+    def worker(worker_id):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                iteration(worker_id, iterations[worker_id])
+            except sqlite3.Error:
+                errors[worker_id] += 1
+            latencies[worker_id].append(time.perf_counter() - start)
+            iterations[worker_id] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.monotonic()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    all_latencies = sorted(l for worker_latencies in latencies for l in worker_latencies)
+    total_iterations = sum(iterations)
+    return {
+        'threads': threads,
+        'seconds': round(elapsed, 3),
+        'iterations': total_iterations,
+        'errors': sum(errors),
+        'ops_per_sec': round(total_iterations * OPS_PER_ITERATION / elapsed, 1),
+        'p50_iteration_ms': round(percentile(all_latencies, 50) * 1000, 3),
+        'p99_iteration_ms': round(percentile(all_latencies, 99) * 1000, 3)
+    }
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[idx]
+
+def main():
+    args = parse_cmd_args()
+    sys.path.insert(0, PROJECT_ROOT)
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_name = setup_cluster_config(work_dir)
+        create_tables(db_name)
+        if args.mode in ('legacy', 'both'):
+            results['legacy'] = run_workload(
+                lambda worker_id, count: legacy_iteration(db_name, worker_id, count),
+                args.threads, args.duration
+            )
+        if args.mode in ('store', 'both'):
+            results['metadata_store'] = run_workload(store_iteration, args.threads, args.duration)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
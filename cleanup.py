@@ -4,6 +4,7 @@ import shutil
 import sqlite3
 
 import flask_utilities
+import metadata_store
 
 DB_FILE = "dfs.db"
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -29,12 +30,12 @@ def delete_logs():
     logs_path = os.path.join(PROJECT_ROOT, LOGS_DIR)
     silent_dir_delete(logs_path)
 
-def get_all_table_names():
+def get_all_table_names(db_name):
     table_names = []
     sql_stmt = """
         SELECT name FROM sqlite_master WHERE type='table';
     """
-    conn = sqlite3.connect(flask_utilities.get_db_name())
+    conn = sqlite3.connect(db_name)
     cur = conn.cursor()
     with conn:
         cur.execute(sql_stmt)
@@ -43,9 +44,9 @@ def get_all_table_names():
     conn.close()
     return table_names
 
-def delete_from_all_tables():
-    table_names = get_all_table_names()
-    conn = sqlite3.connect(flask_utilities.get_db_name())
+def delete_from_all_tables(db_name):
+    table_names = get_all_table_names(db_name)
+    conn = sqlite3.connect(db_name)
     cur = conn.cursor()
     with conn:
         for table in table_names:
@@ -65,7 +66,8 @@ def clean_received_files():
     silent_dir_delete(dir_path)
 
 def clean_db_fs():
-    delete_from_all_tables()
+    for db_name in metadata_store.get_all_shards():
+        delete_from_all_tables(db_name)
     clean_all_sn_files()
     clean_received_files()
 
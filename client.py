@@ -1,60 +1,121 @@
 import argparse
+import glob
+import math
 import os
 import pprint
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 
+import compression
 import flask_utilities
+import http_pool
+import multipart_stream
 import requests
 
 MASTER_URL = flask_utilities.get_master_endpoint()
 UPLOAD_FILE_ENDPOINT = f'http://{MASTER_URL}/upload'
 DOWNLOAD_FILE_ENDPOINT = f'http://{MASTER_URL}/download'
+UPLOAD_PREFLIGHT_ENDPOINT = f'http://{MASTER_URL}/upload_preflight'
+UPLOAD_LOCATION_ENDPOINT = f'http://{MASTER_URL}/upload_location'
+UPLOAD_COMMIT_ENDPOINT = f'http://{MASTER_URL}/upload_commit'
+DOWNLOAD_LOCATION_ENDPOINT = f'http://{MASTER_URL}/download_location'
+UPLOAD_LOCATIONS_ENDPOINT = f'http://{MASTER_URL}/upload_locations'
+UPLOAD_COMMITS_ENDPOINT = f'http://{MASTER_URL}/upload_commits'
+DOWNLOAD_LOCATIONS_ENDPOINT = f'http://{MASTER_URL}/download_locations'
+STAT_ENDPOINT = f'http://{MASTER_URL}/stat'
+LIST_ENDPOINT = f'http://{MASTER_URL}/list'
+SN_UPLOAD_ENDPOINT = 'http://{node_ip}/upload'
+SN_DOWNLOAD_ENDPOINT = 'http://{node_ip}/download'
 SCRIPT_NAME = os.path.basename(__file__)
 STORAGE_DIR = 'received_files'
+DOWNLOAD_CHUNK_SIZE = 2048
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_RESUME_ATTEMPTS = 5
+# uploads the master streamed to an SN which failed are sent again this many times
+MAX_UPLOAD_RESEND_ATTEMPTS = 2
+DEFAULT_WORKERS = 8
+# files per request to the master's batch endpoints
+BATCH_SIZE = 500
 
+# the per-file messages are replaced by a progress line per file in bulk transfers
+show_file_messages = True
+
+
+def log(message):
+    if show_file_messages:
+        print(message)
 
 def parse_cmd_args():
     parser = argparse.ArgumentParser(prog=SCRIPT_NAME)
     parser.add_argument("--verbose", help="increase output verbosity",
                         action="store_true")
+    parser.add_argument("--direct", help="transfer file data directly to/from the storage nodes",
+                        action="store_true")
+
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="files transferred at a time when getting/putting many files")
 
     subparsers = parser.add_subparsers(help='file get/put help', required=True)
 
     # create the parser for the "get" sub-command
     parser_get = subparsers.add_parser('get', help='get help')
-    parser_get.add_argument('get_filename', help="filepath to retrieve")
+    parser_get.add_argument('get_filename', nargs='+', help="files to retrieve")
+    parser_get.add_argument('--parallel-ranges', type=int, default=1,
+                            help="fetch the file as this many byte ranges in parallel")
+    parser_get.add_argument('--range', dest='byte_range', metavar='START-END',
+                            help="fetch only bytes START to END (inclusive) of the file")
 
     # create the parser for the "put" sub-command
     parser_put = subparsers.add_parser('put', help='put help')
-    parser_put.add_argument('put_filepath', help="filepath to store")
+    parser_put.add_argument('put_filepath', nargs='+', help="files, directories or glob patterns to store")
+    parser_put.add_argument('--compress', metavar='CODEC', choices=compression.get_available_encodings(),
+                            help="send and store the files compressed with CODEC, unless they don't compress")
+
+    # create the parser for the "stat" sub-command
+    parser_stat = subparsers.add_parser('stat', help='stat help')
+    parser_stat.add_argument('stat_filename', nargs='+', help="files to describe")
+
+    # create the parser for the "ls" sub-command
+    parser_ls = subparsers.add_parser('ls', help='ls help')
+    parser_ls.add_argument('ls_prefix', nargs='?', default='', help="list only the files starting with this")
+    parser_ls.add_argument('--limit', type=int, help="list at most this many files")
 
     return parser.parse_args()
 
-def request_file_from_server(filename):
+def request_file_from_server(filename, direct=False, parallel_ranges=1):
+    if direct:
+        response = request_file_from_sn(filename)
+        if response['status_code'] == requests.codes.ok:
+            return response
+        log(f"Direct retrieve failed: {response['message']}. Retrying through the master.")
     try:
         resp_code = 400; resp_msg = "Operation failed."
-        print(f"Initiating retrive {filename} from server.")
+        log(f"Initiating retrive {filename} from server.")
         payload = {
             'filename': filename
         }
 
         flask_utilities.create_storage_dir(dir_path=STORAGE_DIR)
         storage_filepath = os.path.join(STORAGE_DIR, filename)
+        # bytes received so far are kept here so that an interrupted transfer can resume
+        partial_filepath = f"{storage_filepath}.part"
 
-        with open(storage_filepath, "wb") as fp:
-            with closing(requests.get(url=DOWNLOAD_FILE_ENDPOINT, params=payload, stream=True)) as r:
-                file_hash = r.headers['file_hash']
-                resp_code = r.status_code
-                if resp_code == requests.codes.ok:
-                    for chunk in r.iter_content(chunk_size=2048):
-                        fp.write(chunk)
-                    print("File retrieved successfully!")
+        if parallel_ranges > 1:
+            transfer = download_in_parallel_ranges(DOWNLOAD_FILE_ENDPOINT, payload, partial_filepath, parallel_ranges)
+        else:
+            transfer = download_resumable(DOWNLOAD_FILE_ENDPOINT, payload, partial_filepath)
+        resp_code = transfer['status_code']
+        resp_msg = transfer['message']
 
         if resp_code == requests.codes.ok:
-            print("Checking file integrity.")
+            os.replace(partial_filepath, storage_filepath)
+            log("File retrieved successfully!")
+            log("Checking file integrity.")
             is_file_valid = flask_utilities.is_file_integrity_matched(
                     filepath=storage_filepath,
-                    recvd_hash=file_hash
+                    recvd_hash=transfer['file_hash'],
+                    algorithm=transfer['hash_algorithm']
             )
             if is_file_valid:
                 resp_code = 200
@@ -62,9 +123,211 @@ def request_file_from_server(filename):
             else:
                 resp_code = 500
                 resp_msg = f"{storage_filepath} received. File integrity does not match."
+
+    except Exception as e:
+        resp_code = 400; resp_msg = str(e)
+
+    return {
+        "status_code": resp_code,
+        "message": resp_msg
+    }
+
+def request_file_range_from_server(filename, start, end):
+    try:
+        log(f"Initiating retrive of bytes {start}-{end} of {filename} from server.")
+        payload = {'filename': filename}
+        headers = {'Range': f"bytes={start}-{end}"}
+        flask_utilities.create_storage_dir(dir_path=STORAGE_DIR)
+        storage_filepath = os.path.join(STORAGE_DIR, f"{filename}.{start}-{end}")
+        with closing(http_pool.get_session().get(url=DOWNLOAD_FILE_ENDPOINT, params=payload, headers=headers, stream=True)) as r:
+            resp_code = r.status_code
+            if resp_code == requests.codes.partial_content:
+                with open(storage_filepath, "wb") as fp:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        fp.write(chunk)
+                resp_code = 200
+                # the file hash covers the whole file, so a range can't be verified against it
+                resp_msg = f"{storage_filepath} received ({r.headers['Content-Range']})."
+            elif resp_code == requests.codes.requested_range_not_satisfiable:
+                resp_msg = f"Range {start}-{end} is outside of {filename} ({r.headers.get('Content-Range')})."
+            else:
+                resp_msg = r.json().get('message', None)
+    except Exception as e:
+        resp_code = 400; resp_msg = str(e)
+
+    return {
+        "status_code": resp_code,
+        "message": resp_msg
+    }
+
+"""
+Download url into partial_filepath, resuming from the bytes already in it
+Interrupted transfers are resumed with a Range request up to MAX_RESUME_ATTEMPTS times.
+"""
+def download_resumable(url, params, partial_filepath):
+    for attempt in range(MAX_RESUME_ATTEMPTS):
+        offset = os.path.getsize(partial_filepath) if os.path.exists(partial_filepath) else 0
+        # a range is of the original bytes; only a whole file may come compressed
+        headers = {'Range': f"bytes={offset}-"} if offset else get_accept_encoding_headers()
+        try:
+            with closing(http_pool.get_session().get(url=url, params=params, headers=headers, stream=True)) as r:
+                if r.status_code == requests.codes.requested_range_not_satisfiable:
+                    # the partial file is stale or already complete; start over
+                    os.remove(partial_filepath)
+                    continue
+                if r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+                    return {
+                        "status_code": r.status_code,
+                        "message": r.json().get('message', None)
+                    }
+                # a server ignoring the range sends the whole file again
+                mode = "ab" if r.status_code == requests.codes.partial_content else "wb"
+                if mode == "ab":
+                    log(f"Resuming from byte {offset}.")
+                with open(partial_filepath, mode) as fp:
+                    write_response_body(r, fp)
+                return {
+                    "status_code": 200,
+                    "message": None,
+                    "file_hash": r.headers['file_hash'],
+                    "hash_algorithm": r.headers.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+                }
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            log(f"Attempt {attempt + 1}: transfer interrupted ({str(e)}).")
+    return {
+        "status_code": 400,
+        "message": f"Transfer failed after {MAX_RESUME_ATTEMPTS} attempts."
+    }
+
+def get_accept_encoding_headers():
+    return {flask_utilities.ACCEPT_FILE_ENCODING_HEADER: ', '.join(compression.get_available_encodings())}
+
+"""
+Write the body of r to fp, decompressing it if it was sent compressed
+"""
+def write_response_body(r, fp):
+    chunks = r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+    file_encoding = r.headers.get(flask_utilities.FILE_ENCODING_HEADER)
+    if file_encoding:
+        chunks = compression.decompress_stream(chunks, file_encoding)
+    for chunk in chunks:
+        fp.write(chunk)
+
+"""
+Download url as num_ranges byte ranges fetched in parallel into partial_filepath
+Falls back to a single resumable download if the server doesn't serve ranges.
+"""
+def download_in_parallel_ranges(url, params, partial_filepath, num_ranges):
+    with closing(http_pool.get_session().get(url=url, params=params, headers={'Range': "bytes=0-0"}, stream=True)) as r:
+        if r.status_code != requests.codes.partial_content:
+            r.close()
+            return download_resumable(url, params, partial_filepath)
+        file_size = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+        file_hash = r.headers['file_hash']
+        hash_algorithm = r.headers.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+
+    range_size = math.ceil(file_size / num_ranges)
+    ranges = [(start, min(start + range_size, file_size) - 1) for start in range(0, file_size, range_size)]
+    with open(partial_filepath, "wb") as fp:
+        fp.truncate(file_size)
+    with ThreadPoolExecutor(max_workers=num_ranges) as executor:
+        results = list(executor.map(lambda r: download_range(url, params, partial_filepath, *r), ranges))
+    for result in results:
+        if result['status_code'] != requests.codes.ok:
+            return result
+    return {
+        "status_code": 200,
+        "message": None,
+        "file_hash": file_hash,
+        "hash_algorithm": hash_algorithm
+    }
+
+def download_range(url, params, filepath, start, end):
+    written = 0
+    for attempt in range(MAX_RESUME_ATTEMPTS):
+        headers = {'Range': f"bytes={start + written}-{end}"}
+        try:
+            with closing(http_pool.get_session().get(url=url, params=params, headers=headers, stream=True)) as r:
+                if r.status_code != requests.codes.partial_content:
+                    return {
+                        "status_code": r.status_code,
+                        "message": f"Range {start}-{end} not served: {r.status_code}"
+                    }
+                with open(filepath, "r+b") as fp:
+                    fp.seek(start + written)
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        fp.write(chunk)
+                        written += len(chunk)
+                return {"status_code": 200, "message": None}
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            log(f"Attempt {attempt + 1}: range {start}-{end} interrupted ({str(e)}).")
+    return {
+        "status_code": 400,
+        "message": f"Range {start}-{end} failed after {MAX_RESUME_ATTEMPTS} attempts."
+    }
+
+def request_file_from_sn(filename):
+    try:
+        log(f"Initiating direct retrieve {filename} from storage nodes.")
+        resp = http_pool.get_session().get(url=DOWNLOAD_LOCATION_ENDPOINT, params={'filename': filename})
+        location = resp.json()
+        if resp.status_code != requests.codes.ok:
+            return {
+                "status_code": resp.status_code,
+                "message": location.get('message', None)
+            }
+        return download_from_location(filename, location)
+    except Exception as e:
+        return {
+            "status_code": 400,
+            "message": str(e)
+        }
+
+def download_from_location(filename, location):
+    try:
+        flask_utilities.create_storage_dir(dir_path=STORAGE_DIR)
+        storage_filepath = os.path.join(STORAGE_DIR, filename)
+        partial_filepath = f"{storage_filepath}.part"
+
+        if 'blocks' in location:
+            # a file stored in blocks is reassembled from its blocks in order
+            file_hash = location['file_hash']
+            hash_algorithm = location['hash_algorithm']
+            with open(partial_filepath, "wb") as fp:
+                for block in location['blocks']:
+                    payload = {'filename': block['block_name'], 'token': block['token']}
+                    sn_download_url = SN_DOWNLOAD_ENDPOINT.format(node_ip=block['node_address'])
+                    with closing(http_pool.get_session().get(url=sn_download_url, params=payload,
+                                                             headers=get_accept_encoding_headers(), stream=True)) as r:
+                        if r.status_code != requests.codes.ok:
+                            return {
+                                "status_code": r.status_code,
+                                "message": r.json().get('message', None)
+                            }
+                        write_response_body(r, fp)
         else:
-            resp_msg = resp.json().get('message', None)
+            payload = {'filename': location['filename'], 'token': location['token']}
+            sn_download_url = SN_DOWNLOAD_ENDPOINT.format(node_ip=location['node_address'])
+            transfer = download_resumable(sn_download_url, payload, partial_filepath)
+            if transfer['status_code'] != requests.codes.ok:
+                return transfer
+            file_hash = transfer['file_hash']
+            hash_algorithm = transfer['hash_algorithm']
+        os.replace(partial_filepath, storage_filepath)
+        log("File retrieved successfully!")
 
+        log("Checking file integrity.")
+        is_file_valid = flask_utilities.is_file_integrity_matched(
+            filepath=storage_filepath,
+            recvd_hash=file_hash,
+            algorithm=hash_algorithm
+        )
+        if is_file_valid:
+            resp_code = 200
+            resp_msg = f"{storage_filepath} received. File integrity validated."
+        else:
+            resp_code = 500
+            resp_msg = f"{storage_filepath} received. File integrity does not match."
     except Exception as e:
         resp_code = 400; resp_msg = str(e)
 
@@ -73,15 +336,148 @@ def request_file_from_server(filename):
         "message": resp_msg
     }
 
-def put_file_at_server(filepath):
+def put_file_at_sn(filepath, compress_with=None):
     try:
-        print(f"Initiating store {filepath} to server.")
-        file_hash = flask_utilities.calc_file_md5(filepath)
-        files = {'input_file': open(filepath,'rb')}
-        data = {'file_hash': file_hash}
-        resp = requests.post(url=UPLOAD_FILE_ENDPOINT, data=data, files=files)
+        log(f"Initiating direct store {filepath} to storage node.")
+        hash_algorithm = flask_utilities.get_hash_algorithm()
+        file_hash = flask_utilities.calc_file_hash(filepath, hash_algorithm)
+        data = {
+            'filename': os.path.basename(filepath),
+            'file_hash': file_hash,
+            'hash_algorithm': hash_algorithm
+        }
+        resp = http_pool.get_session().post(url=UPLOAD_LOCATION_ENDPOINT, data=data)
+        location = resp.json()
+        if resp.status_code != requests.codes.ok:
+            return {
+                "status_code": resp.status_code,
+                "message": location.get('message', None)
+            }
+        if location.get('deduplicated'):
+            log("File stored successfully! Content was already present.")
+            return {
+                "status_code": resp.status_code,
+                "message": f"File {location['filename']} saved successfully (deduplicated)."
+            }
+
+        result = store_at_location(filepath, file_hash, hash_algorithm, location, compress_with)
+        if result['status_code'] != requests.codes.ok:
+            return result
+
+        data = {
+            'filename': location['filename'],
+            'node': location['node'],
+            'token': location['token'],
+            'file_size': os.path.getsize(filepath),
+            'file_hash': file_hash,
+            'hash_algorithm': hash_algorithm
+        }
+        resp = http_pool.get_session().post(url=UPLOAD_COMMIT_ENDPOINT, data=data)
+        if resp.status_code == requests.codes.ok:
+            log("File stored successfully!")
+        resp_code = resp.status_code
+        resp_msg = resp.json().get('message', None)
+    except Exception as e:
+        resp_code = 400
+        resp_msg = str(e)
+
+    return {
+        "status_code": resp_code,
+        "message": resp_msg
+    }
+
+def store_at_location(filepath, file_hash, hash_algorithm, location, compress_with=None):
+    sn_upload_url = SN_UPLOAD_ENDPOINT.format(node_ip=location['node_address'])
+    data = {
+        'file_hash': file_hash,
+        'hash_algorithm': hash_algorithm,
+        'filename': location['filename'],
+        'token': location['token']
+    }
+    try:
+        resp = post_upload_form(sn_upload_url, data, filepath, compress_with)
+        return {
+            "status_code": resp.status_code,
+            "message": resp.json().get('message', None)
+        }
+    except Exception as e:
+        return {
+            "status_code": 400,
+            "message": str(e)
+        }
+
+"""
+POST filepath as the input_file part of a multipart/form-data body with the fields data
+The file is read, and compressed, as it is sent. The body of a raw file has
+a Content-Length, which lets the master pass it on to an SN as it arrives.
+"""
+def post_upload_form(url, data, filepath, compress_with=None):
+    chunks, file_encoding = open_upload_body(filepath, compress_with)
+    if file_encoding:
+        # the SN can't tell the stored size of a chunked body
+        data = dict(data, file_encoding=file_encoding, size_hint=os.path.getsize(filepath))
+    # the master stores the file under the multipart filename
+    body = multipart_stream.FormBody(data, 'input_file', os.path.basename(filepath), chunks,
+                                     None if file_encoding else os.path.getsize(filepath))
+    return http_pool.get_session().post(url=url, data=body, headers={'Content-Type': body.content_type})
+
+"""
+Chunks of the body to upload filepath with, and their encoding (None if raw)
+With compress_with, the file is compressed chunk by chunk unless its first
+chunk doesn't shrink by enough, as the SNs decide: already compressed or
+random data is sent raw.
+"""
+def open_upload_body(filepath, compress_with=None):
+    if compress_with:
+        with open(filepath, 'rb') as fp:
+            first_chunk = fp.read(UPLOAD_CHUNK_SIZE)
+        if compression.is_compressible(first_chunk, compress_with, flask_utilities.get_compression_max_ratio()):
+            log(f"Sending {filepath} compressed with {compress_with}.")
+            return iter_upload_chunks(filepath, compress_with), compress_with
+        log(f"{filepath} doesn't compress with {compress_with}; sending it raw.")
+    return iter_upload_chunks(filepath), None
+
+def iter_upload_chunks(filepath, compress_with=None):
+    compressor = compression.get_codec(compress_with).compressor() if compress_with else None
+    with open(filepath, 'rb') as fp:
+        for data in iter(lambda: fp.read(UPLOAD_CHUNK_SIZE), b""):
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+    if compressor:
+        data = compressor.flush()
+        if data:
+            yield data
+
+def put_file_at_server(filepath, direct=False, compress_with=None):
+    if direct:
+        response = put_file_at_sn(filepath, compress_with)
+        if response['status_code'] == requests.codes.ok:
+            return response
+        log(f"Direct store failed: {response['message']}. Retrying through the master.")
+    try:
+        log(f"Initiating store {filepath} to server.")
+        hash_algorithm = flask_utilities.get_hash_algorithm()
+        file_hash = flask_utilities.calc_file_hash(filepath, hash_algorithm)
+        data = {'file_hash': file_hash, 'hash_algorithm': hash_algorithm}
+        if flask_utilities.is_dedup_enabled():
+            # skip sending the body if the master already has this content
+            preflight_data = dict(data, filename=os.path.basename(filepath))
+            resp = http_pool.get_session().post(url=UPLOAD_PREFLIGHT_ENDPOINT, data=preflight_data)
+            if resp.status_code == requests.codes.ok and resp.json().get('deduplicated'):
+                log("File stored successfully! Content was already present.")
+                return {
+                    "status_code": resp.status_code,
+                    "message": resp.json().get('message', None)
+                }
+        for attempt in range(1 + MAX_UPLOAD_RESEND_ATTEMPTS):
+            resp = post_upload_form(UPLOAD_FILE_ENDPOINT, data, filepath, compress_with)
+            if resp.status_code != requests.codes.service_unavailable or attempt == MAX_UPLOAD_RESEND_ATTEMPTS:
+                break
+            log(f"{resp.json().get('message')} Sending {filepath} again.")
         if resp.status_code == requests.codes.ok:
-            print("File stored successfully!")
+            log("File stored successfully!")
         resp_code = resp.status_code
         resp_msg = resp.json().get('message', None)
     except Exception as e:
@@ -93,6 +489,191 @@ def put_file_at_server(filepath):
         "message": resp_msg
     }
 
+"""
+Prints a line per finished file: [done/total] file: status message
+"""
+class BulkProgress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def report(self, name, result):
+        with self.lock:
+            self.done += 1
+            print(f"[{self.done}/{self.total}] {name}: {result['status_code']} {result['message']}")
+
+"""
+Files to store for the put arguments
+Glob patterns are expanded and directories are walked recursively.
+"""
+def expand_put_paths(paths):
+    filepaths = []
+    for path in paths:
+        matches = sorted(glob.glob(path, recursive=True)) if glob.has_magic(path) else [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    filepaths.extend(os.path.join(root, filename) for filename in sorted(files))
+            else:
+                filepaths.append(match)
+    return filepaths
+
+def get_batches(items):
+    return [items[start:start + BATCH_SIZE] for start in range(0, len(items), BATCH_SIZE)]
+
+"""
+Store many files, up to workers at a time
+With direct, the placement and the commits of BATCH_SIZE files take one
+request to the master each; a file whose direct store fails is retried
+through the master. Returns the result of every file.
+"""
+def put_files_at_server(filepaths, direct=False, workers=DEFAULT_WORKERS, compress_with=None):
+    progress = BulkProgress(len(filepaths))
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if direct:
+            for batch in get_batches(filepaths):
+                results.extend(put_batch_at_sn(batch, executor, progress, compress_with))
+        else:
+            def put_file(filepath):
+                result = dict(put_file_at_server(filepath, compress_with=compress_with), file=filepath)
+                progress.report(filepath, result)
+                return result
+            results.extend(executor.map(put_file, filepaths))
+    return results
+
+def put_batch_at_sn(filepaths, executor, progress, compress_with=None):
+    hash_algorithm = flask_utilities.get_hash_algorithm()
+    file_hashes = list(executor.map(lambda filepath: flask_utilities.calc_file_hash(filepath, hash_algorithm), filepaths))
+    files = [
+        {
+            'filename': os.path.basename(filepath),
+            'file_hash': file_hash,
+            'hash_algorithm': hash_algorithm,
+            'file_size': os.path.getsize(filepath)
+        }
+        for filepath, file_hash in zip(filepaths, file_hashes)
+    ]
+    try:
+        resp = http_pool.get_session().post(url=UPLOAD_LOCATIONS_ENDPOINT, json={'files': files})
+        resp.raise_for_status()
+        locations = resp.json()['locations']
+    except Exception as e:
+        locations = [{'status_code': 400, 'message': str(e)}] * len(filepaths)
+
+    def store(args):
+        filepath, file_hash, location = args
+        if location['status_code'] != requests.codes.ok:
+            return location
+        if location.get('deduplicated'):
+            return {
+                "status_code": 200,
+                "message": f"File {location['filename']} saved successfully (deduplicated)."
+            }
+        return store_at_location(filepath, file_hash, hash_algorithm, location, compress_with)
+    results = list(executor.map(store, zip(filepaths, file_hashes, locations)))
+
+    to_commit = [idx for idx, result in enumerate(results)
+                 if result['status_code'] == requests.codes.ok and not locations[idx].get('deduplicated')]
+    if to_commit:
+        commits = [
+            {
+                'filename': locations[idx]['filename'],
+                'node': locations[idx]['node'],
+                'token': locations[idx]['token'],
+                'file_size': os.path.getsize(filepaths[idx]),
+                'file_hash': file_hashes[idx],
+                'hash_algorithm': hash_algorithm
+            }
+            for idx in to_commit
+        ]
+        try:
+            resp = http_pool.get_session().post(url=UPLOAD_COMMITS_ENDPOINT, json={'files': commits})
+            resp.raise_for_status()
+            commit_results = resp.json()['results']
+        except Exception as e:
+            commit_results = [{'status_code': 400, 'message': str(e)}] * len(to_commit)
+        for idx, commit_result in zip(to_commit, commit_results):
+            results[idx] = commit_result
+
+    def finish(args):
+        filepath, result = args
+        if result['status_code'] != requests.codes.ok:
+            # e.g. the SN went away; the master picks another one
+            result = put_file_at_server(filepath, compress_with=compress_with)
+        result = dict(result, file=filepath)
+        progress.report(filepath, result)
+        return result
+    return list(executor.map(finish, zip(filepaths, results)))
+
+"""
+Retrieve many files, up to workers at a time
+With direct, the locations of BATCH_SIZE files take one request to the
+master; a file whose direct retrieve fails is retried through the master.
+Returns the result of every file.
+"""
+def request_files_from_server(filenames, direct=False, workers=DEFAULT_WORKERS):
+    progress = BulkProgress(len(filenames))
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in get_batches(filenames):
+            if direct:
+                try:
+                    resp = http_pool.get_session().post(url=DOWNLOAD_LOCATIONS_ENDPOINT, json={'filenames': batch})
+                    resp.raise_for_status()
+                    locations = resp.json()['locations']
+                except Exception as e:
+                    locations = [{'status_code': 400, 'message': str(e)}] * len(batch)
+            else:
+                locations = [None] * len(batch)
+
+            def get_file(args):
+                filename, location = args
+                result = None
+                if location and location['status_code'] == requests.codes.ok:
+                    result = download_from_location(filename, location)
+                if not result or result['status_code'] != requests.codes.ok:
+                    result = request_file_from_server(filename)
+                result = dict(result, file=filename)
+                progress.report(filename, result)
+                return result
+            results.extend(executor.map(get_file, zip(batch, locations)))
+    return results
+
+def stat_file(filename):
+    try:
+        resp = http_pool.get_session().get(url=STAT_ENDPOINT, params={'filename': filename})
+        return dict(resp.json(), status_code=resp.status_code)
+    except Exception as e:
+        return {'status_code': 400, 'message': str(e)}
+
+"""
+Records of the files starting with prefix, fetched a page at a time
+"""
+def list_files(prefix='', limit=None):
+    files = []
+    start_after = ''
+    while start_after is not None and (limit is None or len(files) < limit):
+        params = {'prefix': prefix, 'start_after': start_after}
+        if limit is not None:
+            params['limit'] = limit - len(files)
+        resp = http_pool.get_session().get(url=LIST_ENDPOINT, params=params)
+        resp.raise_for_status()
+        page = resp.json()
+        files.extend(page['files'])
+        start_after = page['next_start_after']
+    return files
+
+def print_bulk_summary(results):
+    failed = [result for result in results if result['status_code'] != requests.codes.ok]
+    pprint.pprint({
+        'files': len(results),
+        'succeeded': len(results) - len(failed),
+        'failed': failed
+    })
+
 def main():
     flask_utilities.create_storage_dir(dir_path=STORAGE_DIR)
     args = parse_cmd_args()
@@ -100,13 +681,40 @@ def main():
         logging.error("Incorrect usage")
         parser.print_help()
         return
+    global show_file_messages
     if hasattr(args, 'get_filename'):
-        response = request_file_from_server(filename=args.get_filename)
-        pprint.pprint(response)
+        if len(args.get_filename) > 1:
+            show_file_messages = False
+            results = request_files_from_server(args.get_filename, direct=args.direct, workers=args.workers)
+            print_bulk_summary(results)
+        elif args.byte_range:
+            start, end = args.byte_range.split('-')
+            response = request_file_range_from_server(filename=args.get_filename[0], start=int(start), end=int(end))
+            pprint.pprint(response)
+        else:
+            response = request_file_from_server(
+                filename=args.get_filename[0],
+                direct=args.direct,
+                parallel_ranges=args.parallel_ranges
+            )
+            pprint.pprint(response)
     elif hasattr(args, 'put_filepath'):
-        flask_utilities.check_filepath_sanity(args.put_filepath)
-        response = put_file_at_server(filepath=args.put_filepath)
-        pprint.pprint(response)
+        filepaths = expand_put_paths(args.put_filepath)
+        for filepath in filepaths:
+            flask_utilities.check_filepath_sanity(filepath)
+        if filepaths == args.put_filepath and len(filepaths) == 1:
+            response = put_file_at_server(filepath=filepaths[0], direct=args.direct, compress_with=args.compress)
+            pprint.pprint(response)
+        else:
+            show_file_messages = False
+            results = put_files_at_server(filepaths, direct=args.direct, workers=args.workers,
+                                          compress_with=args.compress)
+            print_bulk_summary(results)
+    elif hasattr(args, 'stat_filename'):
+        for filename in args.stat_filename:
+            pprint.pprint(stat_file(filename))
+    elif hasattr(args, 'ls_prefix'):
+        pprint.pprint(list_files(prefix=args.ls_prefix, limit=args.limit))
     else:
         logging.error("Incorrect usage")
         parser.print_help()
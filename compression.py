@@ -0,0 +1,135 @@
+"""
+Codecs for compressing file contents on the wire and at rest
+
+zlib is always available; zstd and lz4 are registered when the zstandard and
+lz4 packages are installed. Every codec streams: compressor() returns an
+object with compress(data) and flush(), decompressor() one with
+decompress(data) and flush().
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# data is stored raw unless compressing shrinks it to at most this fraction of its size
+DEFAULT_MAX_COMPRESSED_RATIO = 0.9
+
+CODECS = {}
+
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def compressor(self):
+        return zlib.compressobj(ZLIB_LEVEL)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def decompressor(self):
+        return FlushlessDecompressor(zstandard.ZstdDecompressor().decompressobj())
+
+
+class Lz4Codec:
+    name = 'lz4'
+
+    def compressor(self):
+        return Lz4Compressor()
+
+    def decompressor(self):
+        return FlushlessDecompressor(lz4_frame.LZ4FrameDecompressor())
+
+
+class Lz4Compressor:
+    def __init__(self):
+        self.compressor = lz4_frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b""
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header, self.header = self.header, b""
+        return header + self.compressor.flush()
+
+
+class FlushlessDecompressor:
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+def get_codec(encoding):
+    if encoding not in CODECS:
+        raise Exception(f"Unsupported file encoding {encoding}.")
+    return CODECS[encoding]
+
+def get_available_encodings():
+    return list(CODECS)
+
+"""
+Encodings a peer accepts, from its comma separated accept_file_encoding header
+"""
+def parse_accepted_encodings(header_value):
+    return [encoding.strip() for encoding in (header_value or '').split(',') if encoding.strip()]
+
+def compress_bytes(data, encoding):
+    compressor = get_codec(encoding).compressor()
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_bytes(data, encoding):
+    decompressor = get_codec(encoding).decompressor()
+    return decompressor.decompress(data) + decompressor.flush()
+
+def decompress_stream(chunks, encoding):
+    decompressor = get_codec(encoding).decompressor()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def is_worth_compressing(raw_size, compressed_size, max_ratio=DEFAULT_MAX_COMPRESSED_RATIO):
+    return raw_size > 0 and compressed_size <= raw_size * max_ratio
+
+"""
+Whether data compressed with encoding shrinks enough to be stored compressed
+Used on the first chunk of a stream to detect already compressed or random
+data, which is then stored raw.
+"""
+def is_compressible(sample, encoding, max_ratio=DEFAULT_MAX_COMPRESSED_RATIO):
+    return is_worth_compressing(len(sample), len(compress_bytes(sample, encoding)), max_ratio)
+
+
+register_codec(ZlibCodec())
+if zstandard is not None:
+    register_codec(ZstdCodec())
+if lz4_frame is not None:
+    register_codec(Lz4Codec())
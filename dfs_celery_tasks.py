@@ -1,36 +1,74 @@
-import shutil
-import sqlite3
+import time
+
 import flask_utilities
+import metadata_store
+import metrics
+import replication
 
 from celery import Celery
-
-CELERY_BROKER_URL = 'redis://redis:6379/0'
-CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+from celery.utils.log import get_task_logger
 
 celery = Celery('tasks',
-                broker=CELERY_BROKER_URL,
-                backend=CELERY_RESULT_BACKEND)
+                broker=flask_utilities.get_celery_broker_url(),
+                backend=flask_utilities.get_celery_result_backend())
+celery.conf.broker_transport = flask_utilities.get_celery_broker_transport()
+celery.conf.broker_transport_options = flask_utilities.get_celery_broker_transport_options()
+logger = get_task_logger(__name__)
 
 
-def update_replication_table(filename, replicated_node):
-    sql_stmt = f"""
-        INSERT INTO replication_data (filename, replicated_node)
-        VALUES ("{filename}", "{replicated_node}");
-    """
-    conn = sqlite3.connect(flask_utilities.get_db_name())
-    with conn:
-        conn.execute(sql_stmt)
-    conn.close()
-
 @celery.task(name='dfs_tasks.replicate')
 def replicate(filename, src_node_addr, dest_node_addr):
-    src_node, src_port = src_node_addr.split(':')
-    dest_node, dest_port = dest_node_addr.split(':')
+    return replicate_batch([filename], [src_node_addr, dest_node_addr])
+
+"""
+Copy a batch of files one hop down a replication chain
+chain is [primary, r1, r2, ...]. This task copies the files from chain[0] to
+chain[1] and then hands the batch to the next hop (chain[1] -> chain[2]), so
+every node sends each file out at most once.
+trace_ids are those of the uploads of the files, in the same order, and
+queued_at the time the task was sent; both are for the timing log lines.
+"""
+@celery.task(name='dfs_tasks.replicate_batch')
+def replicate_batch(filenames, chain, trace_ids=None, queued_at=None):
+    src_node_addr, dest_node_addr = chain[0], chain[1]
+    trace_ids = trace_ids or [None] * len(filenames)
+    if queued_at is not None:
+        logger.info(f"Batch of {len(filenames)} files waited {time.time() - queued_at:.3f}s in the broker "
+                    f"(trace ids {trace_ids})")
+
+    replicated, failed, errors = [], [], []
+    for filename, trace_id in zip(filenames, trace_ids):
+        # the copy's requests to the SNs carry the trace id of the upload
+        metrics.set_trace_id(trace_id)
+        start = time.perf_counter()
+        try:
+            replication.replicate_file(filename, src_node_addr, dest_node_addr)
+            replicated.append((filename, trace_id))
+        except Exception as e:
+            failed.append((filename, trace_id))
+            errors.append(f"{filename} ({str(e)})")
+        logger.info(f"[trace {trace_id}] {filename} {src_node_addr} -> {dest_node_addr} "
+                    f"took {time.perf_counter() - start:.3f}s")
+    metrics.set_trace_id(None)
+
+    metadata_store.add_replication_records([(filename, dest_node_addr) for filename, _ in replicated])
+
+    if len(chain) > 2:
+        if replicated:
+            send_next_hop(replicated, chain[1:])
+        if failed:
+            # skip the broken hop; the rest of the chain still gets its copies
+            send_next_hop(failed, [src_node_addr] + chain[2:])
 
-    src_filepath = f"/storage_{src_node}_{src_port}/{filename}"
-    dest_filepath = f"/storage_{dest_node}_{dest_port}/{filename}"
-    shutil.copy(src=src_filepath, dst=dest_filepath)
+    result = f"Successful. {len(replicated)} files : {src_node_addr} —> {dest_node_addr}"
+    if errors:
+        result += f". Failed: {', '.join(errors)}"
+    return result
 
-    update_replication_table(filename, dest_node_addr)
 
-    return f"Successful. {filename} : {src_node_addr} —> {dest_node_addr}"
\ No newline at end of file
+def send_next_hop(files, chain):
+    celery.send_task(
+        'dfs_tasks.replicate_batch',
+        args=[[filename for filename, _ in files], chain],
+        kwargs={'trace_ids': [trace_id for _, trace_id in files], 'queued_at': time.time()}
+    )
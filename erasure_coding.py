@@ -0,0 +1,136 @@
+"""
+Systematic Reed-Solomon code over GF(2^8) for erasure-coded files
+
+A file is cut into stripes of data_fragments units of equal size. Each stripe
+gets parity_fragments parity units, and unit i of every stripe is appended to
+fragment i, so fragments 0..k-1 hold the file itself and k..k+m-1 the parity.
+Any k of the k+m fragments rebuild the file, at (k+m)/k of its size instead of
+the 1+replication_factor copies of replication.
+
+The parity rows form a Cauchy matrix, so every k rows of [I; C] are
+invertible. Units are multiplied by a constant with bytes.translate and added
+(XOR) as big ints, which keeps the per-byte work in C.
+"""
+import functools
+
+GF_POLYNOMIAL = 0x11d
+GF_SIZE = 256
+
+GF_EXP = [0] * (2 * GF_SIZE)
+GF_LOG = [0] * GF_SIZE
+_x = 1
+for _i in range(GF_SIZE - 1):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & GF_SIZE:
+        _x ^= GF_POLYNOMIAL
+for _i in range(GF_SIZE - 1, 2 * GF_SIZE):
+    GF_EXP[_i] = GF_EXP[_i - (GF_SIZE - 1)]
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return GF_EXP[(GF_SIZE - 1) - GF_LOG[a]]
+
+"""
+bytes.translate table multiplying every byte by coef
+"""
+@functools.lru_cache(maxsize=GF_SIZE)
+def get_mul_table(coef):
+    return bytes(gf_mul(coef, x) for x in range(GF_SIZE))
+
+"""
+Sum over GF(256) of coef * unit for the (coef, unit) pairs, as unit_size bytes
+"""
+def combine_units(coefs, units, unit_size):
+    acc = 0
+    for coef, unit in zip(coefs, units):
+        if coef == 0:
+            continue
+        data = unit if coef == 1 else unit.translate(get_mul_table(coef))
+        acc ^= int.from_bytes(data, 'little')
+    return acc.to_bytes(unit_size, 'little')
+
+def invert_matrix(matrix):
+    size = len(matrix)
+    # Gauss-Jordan on [matrix | I]
+    rows = [list(row) + [1 if i == j else 0 for j in range(size)] for i, row in enumerate(matrix)]
+    for col in range(size):
+        pivot = next((r for r in range(col, size) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular.")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        inv_pivot = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv_pivot, value) for value in rows[col]]
+        for r in range(size):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[r], rows[col])]
+    return [row[size:] for row in rows]
+
+
+class ReedSolomon:
+    def __init__(self, data_fragments, parity_fragments):
+        if data_fragments < 1 or parity_fragments < 0 or data_fragments + parity_fragments > GF_SIZE:
+            raise ValueError(f"Unsupported erasure code: {data_fragments} data + {parity_fragments} parity fragments.")
+        self.data_fragments = data_fragments
+        self.parity_fragments = parity_fragments
+        self.parity_rows = [
+            [gf_inv((data_fragments + j) ^ i) for i in range(data_fragments)]
+            for j in range(parity_fragments)
+        ]
+        self.decode_matrices = {}
+
+    @property
+    def total_fragments(self):
+        return self.data_fragments + self.parity_fragments
+
+    def get_row(self, index):
+        if index < self.data_fragments:
+            return [1 if i == index else 0 for i in range(self.data_fragments)]
+        return self.parity_rows[index - self.data_fragments]
+
+    """
+    Parity units of a stripe of data_fragments units of equal size
+    """
+    def encode(self, data_units):
+        unit_size = len(data_units[0])
+        return [combine_units(row, data_units, unit_size) for row in self.parity_rows]
+
+    """
+    All the units, data then parity, of a stripe of up to data_fragments * stripe_unit bytes
+    A short last stripe is padded with zeros, which reads cut off at the file size.
+    """
+    def encode_stripe(self, stripe, stripe_unit):
+        stripe = stripe.ljust(self.data_fragments * stripe_unit, b"\0")
+        data_units = [stripe[i * stripe_unit:(i + 1) * stripe_unit] for i in range(self.data_fragments)]
+        return data_units + self.encode(data_units)
+
+    """
+    Data units of a stripe from any data_fragments of its units
+    units maps fragment index to unit. The data units present are used as
+    they are; only the missing ones are computed.
+    """
+    def decode(self, units):
+        missing = [i for i in range(self.data_fragments) if i not in units]
+        if not missing:
+            return [units[i] for i in range(self.data_fragments)]
+        indices = tuple(sorted(units)[:self.data_fragments])
+        if len(indices) < self.data_fragments:
+            raise Exception(f"{len(units)} fragments can't rebuild a stripe of {self.data_fragments}.")
+        matrix = self.decode_matrices.get(indices)
+        if matrix is None:
+            matrix = self.decode_matrices[indices] = invert_matrix([self.get_row(i) for i in indices])
+        unit_size = len(units[indices[0]])
+        chosen_units = [units[i] for i in indices]
+        data_units = []
+        for i in range(self.data_fragments):
+            data_units.append(units[i] if i in units else combine_units(matrix[i], chosen_units, unit_size))
+        return data_units
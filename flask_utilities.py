@@ -1,71 +1,555 @@
 import argparse
 import configparser
 import hashlib
+import hmac
+import itertools
+import json
+import logging
 import os
 import random
+import signal
 import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import compression
+import metrics
 import requests
 
-CONFIG_FILE = 'dfs.cfg'
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+CONFIG_FILE = os.environ.get('DFS_CONFIG', 'dfs.cfg')
 HEALTH_CHECK_ENDPOINT = "http://{node_ip}/health"
 HEALTH_CHECK_TIMEOUT = 10
-MAX_RETRY_FIND_HEALTHY_SERVER_COUNT = 3
+DEFAULT_HEARTBEAT_INTERVAL = 2
+DEFAULT_DOWN_AFTER_FAILURES = 3
+DEFAULT_MAX_PROBE_BACKOFF = 30
+CONFIG_RELOAD_CHECK_INTERVAL = 1
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_PARALLEL_TRANSFERS = 4
+DEFAULT_TOKEN_TTL = 60
+DEFAULT_PENDING_UPLOAD_TTL = 60 * 60
+DEFAULT_REPLICATION_BATCH_SIZE = 32
+DEFAULT_REPLICATION_BATCH_INTERVAL = 0.5
+DEFAULT_REPLICATION_MAX_CONCURRENCY_PER_NODE = 2
+DEFAULT_HASH_ALGORITHM = 'md5'
+SUPPORTED_HASH_ALGORITHMS = ['md5', 'sha1', 'sha256', 'blake2b', 'blake2s']
+XXHASH_ALGORITHMS = ['xxh64', 'xxh3_64', 'xxh3_128']
+HASH_READ_CHUNK_SIZE = 1024 * 1024
+CHECKSUM_DIR = '.checksums'
+BLOCK_NAME_FORMAT = "{filename}.blk{block_index:05d}"
+FRAGMENT_NAME_FORMAT = "{filename}.frag{fragment_index:03d}"
+DEFAULT_EC_DATA_FRAGMENTS = 3
+DEFAULT_EC_PARITY_FRAGMENTS = 2
+DEFAULT_EC_MIN_FILE_SIZE = 16 * 1024 * 1024
+DEFAULT_EC_STRIPE_UNIT = 1024 * 1024
+DEFAULT_READ_CACHE_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_READ_CACHE_MEMORY_MAX_FILE_SIZE = 1024 * 1024
+DEFAULT_READ_CACHE_DISK_BYTES = 4 * 1024 * 1024 * 1024
+DEFAULT_READ_CACHE_DISK_MAX_FILE_SIZE = 256 * 1024 * 1024
+DEFAULT_READ_CACHE_DISK_DIR = '/tmp/dfs_read_cache'
+DEFAULT_STREAMING_UPLOAD_REPLAY_BUFFER_BYTES = 8 * 1024 * 1024
+DEFAULT_PACKING_MAX_FILE_SIZE = 1024 * 1024
+DEFAULT_PACKING_VOLUME_SIZE = 256 * 1024 * 1024
+DEFAULT_PACKING_COMPACTION_GARBAGE_RATIO = 0.5
+DEFAULT_PACKING_COMPACTION_INTERVAL = 60
+DEFAULT_REBALANCER_INTERVAL = 60
+PLACEMENT_RANDOM = 'random'
+PLACEMENT_HASH_RING = 'hash_ring'
+DEFAULT_RING_VIRTUAL_NODES = 128
+DEFAULT_REBALANCER_TOLERANCE = 0.1
+DEFAULT_REBALANCER_MAX_BYTES_PER_ROUND = 1024 * 1024 * 1024
+DEFAULT_REBALANCER_MAX_BANDWIDTH = 50 * 1024 * 1024
+DEFAULT_REBALANCER_DELETE_DELAY = 30
+DEFAULT_HTTP_CONNECT_TIMEOUT = 3.05
+DEFAULT_HTTP_READ_TIMEOUT = 60
+DEFAULT_HTTP_MAX_CONNECTIONS_PER_NODE = 32
+DEFAULT_PLACEMENT_RESERVED_FREE_BYTES = 100 * 1024 * 1024
+DEFAULT_HEDGING_PERCENTILE = 95
+DEFAULT_HEDGING_MIN_DELAY_MS = 10
+DEFAULT_HEDGING_INITIAL_DELAY_MS = 100
+DEFAULT_CELERY_BROKER_URL = 'redis://redis:6379/0'
+DEFAULT_CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+FILE_ENCODING_HEADER = 'file_encoding'
+ACCEPT_FILE_ENCODING_HEADER = 'accept_file_encoding'
+
+logger = logging.getLogger(__name__)
+
+"""
+dfs.cfg parsed once and kept in memory
+The file's mtime is checked at most once every CONFIG_RELOAD_CHECK_INTERVAL
+seconds and the file is parsed again only when it changed (or on SIGHUP), so
+storage nodes can still be added to a running cluster. A file failing
+check_config is refused: on the first load with a ValueError, on a reload by
+keeping the config loaded before.
+"""
+class ClusterConfig:
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.lock = threading.Lock()
+        self.parser = None
+        self.mtime = None
+        self.last_checked = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self.parser is None or now - self.last_checked >= CONFIG_RELOAD_CHECK_INTERVAL:
+            with self.lock:
+                if self.parser is None or now - self.last_checked >= CONFIG_RELOAD_CHECK_INTERVAL:
+                    self.last_checked = now
+                    mtime = self._get_mtime()
+                    if self.parser is None or mtime != self.mtime:
+                        self._load(mtime)
+        return self.parser
+
+    def reload(self):
+        with self.lock:
+            self._load(self._get_mtime())
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self, mtime):
+        parser = configparser.ConfigParser()
+        parser.read(self.config_file)
+        try:
+            check_config(parser)
+        except ValueError as e:
+            if self.parser is None:
+                raise
+            logger.error(f"Not reloading {self.config_file}: {str(e)}")
+            self.mtime = mtime
+            return
+        # readers always see either the old or the new parser, never a half-read one
+        self.parser = parser
+        self.mtime = mtime
+
+"""
+Raise a ValueError if settings of config can't work together
+"""
+def check_config(config):
+    if config.getboolean('erasure_coding', 'enabled', fallback=False):
+        total_fragments = (config.getint('erasure_coding', 'data_fragments', fallback=DEFAULT_EC_DATA_FRAGMENTS)
+                           + config.getint('erasure_coding', 'parity_fragments', fallback=DEFAULT_EC_PARITY_FRAGMENTS))
+        num_nodes = len(parse_storage_nodes(config))
+        if total_fragments > num_nodes:
+            raise ValueError(f"Erasure coding stores {total_fragments} fragments on distinct storage nodes, "
+                             f"but [storage_nodes] lists {num_nodes}.")
+
+
+_cluster_config = ClusterConfig(CONFIG_FILE)
+
+def get_config():
+    return _cluster_config.get()
+
+def install_config_reload_handler():
+    def reload_config(signum, frame):
+        _cluster_config.reload()
+    try:
+        signal.signal(signal.SIGHUP, reload_config)
+    except (AttributeError, ValueError):
+        # no SIGHUP on this platform, or not called from the main thread
+        pass
 
 def get_all_storage_nodes():
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    return parse_storage_nodes(get_config())
+
+def parse_storage_nodes(config):
     storage_nodes = config['storage_nodes']['machine_list_docker'].split(',\n')
     return storage_nodes
 
+def get_celery_broker_url():
+    config = get_config()
+    return config.get('celery', 'broker_url', fallback=DEFAULT_CELERY_BROKER_URL)
+
+"""
+Return the Celery result backend URL, or None to not store task results
+"""
+def get_celery_result_backend():
+    config = get_config()
+    return config.get('celery', 'result_backend', fallback=DEFAULT_CELERY_RESULT_BACKEND).strip() or None
+
+"""
+Return the kombu transport class (module:Class) to use instead of the one named
+by the broker_url scheme, or None
+"""
+def get_celery_broker_transport():
+    config = get_config()
+    return config.get('celery', 'broker_transport', fallback='').strip() or None
+
+def get_celery_broker_transport_options():
+    config = get_config()
+    return json.loads(config.get('celery', 'broker_transport_options', fallback='{}'))
+
 def get_replication_factor():
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    config = get_config()
     return config['default'].getint('replication_factor')
 
 def get_master_endpoint():
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    config = get_config()
     master_config = config['master']
     return master_config['server_endpoint']
 
+def get_pending_upload_ttl():
+    config = get_config()
+    return config.getint('master', 'pending_upload_ttl', fallback=DEFAULT_PENDING_UPLOAD_TTL)
+
 def get_db_name():
-    config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    config = get_config()
     return config['default']['database']
 
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+"""
+SQLite files the metadata is split over; [default] database if none are listed
+"""
+def get_metadata_shards():
+    config = get_config()
+    return parse_list(config.get('metadata', 'shards', fallback='')) or [get_db_name()]
+
+"""
+Shards before the list was last changed, while reshard.py moves the rows; else []
+"""
+def get_metadata_previous_shards():
+    config = get_config()
+    return parse_list(config.get('metadata', 'previous_shards', fallback=''))
+
+def is_chunking_enabled():
+    config = get_config()
+    return config.getboolean('chunking', 'enabled', fallback=False)
+
+def get_block_size():
+    config = get_config()
+    return config.getint('chunking', 'block_size', fallback=DEFAULT_BLOCK_SIZE)
+
+def get_chunking_min_file_size():
+    config = get_config()
+    return config.getint('chunking', 'min_file_size', fallback=DEFAULT_BLOCK_SIZE)
+
+def get_max_parallel_transfers():
+    config = get_config()
+    return config.getint('chunking', 'parallel_transfers', fallback=DEFAULT_PARALLEL_TRANSFERS)
+
+def get_block_name(filename, block_index):
+    return BLOCK_NAME_FORMAT.format(filename=filename, block_index=block_index)
+
+def is_erasure_coding_enabled():
+    config = get_config()
+    return config.getboolean('erasure_coding', 'enabled', fallback=False)
+
+def get_ec_data_fragments():
+    config = get_config()
+    return config.getint('erasure_coding', 'data_fragments', fallback=DEFAULT_EC_DATA_FRAGMENTS)
+
+def get_ec_parity_fragments():
+    config = get_config()
+    return config.getint('erasure_coding', 'parity_fragments', fallback=DEFAULT_EC_PARITY_FRAGMENTS)
+
+def get_ec_min_file_size():
+    config = get_config()
+    return config.getint('erasure_coding', 'min_file_size', fallback=DEFAULT_EC_MIN_FILE_SIZE)
+
+def get_ec_stripe_unit():
+    config = get_config()
+    return config.getint('erasure_coding', 'stripe_unit', fallback=DEFAULT_EC_STRIPE_UNIT)
+
+def get_fragment_name(filename, fragment_index):
+    return FRAGMENT_NAME_FORMAT.format(filename=filename, fragment_index=fragment_index)
+
+"""
+Encode the file read from fp into one fragment file per fragment of codec
+Returns the hash of the file and the hashes of the fragments.
+"""
+def write_erasure_coded_fragments(fp, codec, stripe_unit, fragment_files, algorithm=None):
+    file_hasher = new_hasher(algorithm)
+    fragment_hashers = [new_hasher(algorithm) for _ in fragment_files]
+    for stripe in iter(lambda: fp.read(codec.data_fragments * stripe_unit), b""):
+        file_hasher.update(stripe)
+        for fragment_index, unit in enumerate(codec.encode_stripe(stripe, stripe_unit)):
+            fragment_hashers[fragment_index].update(unit)
+            fragment_files[fragment_index].write(unit)
+    return file_hasher.hexdigest(), [hasher.hexdigest() for hasher in fragment_hashers]
+
+"""
+Blocks overlapping the byte range [start, stop) of a chunked file
+Returns (block, slice_start, slice_stop) tuples, the slice being the part of
+the block's data which falls in the range.
+"""
+def get_block_slices(blocks, start, stop):
+    block_slices = []
+    block_offset = 0
+    for block in blocks:
+        block_end = block_offset + block['block_size']
+        if block_end > start and block_offset < stop:
+            block_slices.append((block, max(start - block_offset, 0), min(stop, block_end) - block_offset))
+        block_offset = block_end
+    return block_slices
+
+def get_heartbeat_interval():
+    config = get_config()
+    return config.getfloat('health', 'heartbeat_interval', fallback=DEFAULT_HEARTBEAT_INTERVAL)
+
+def get_health_check_timeout():
+    config = get_config()
+    return config.getfloat('health', 'probe_timeout', fallback=HEALTH_CHECK_TIMEOUT)
+
+def get_down_after_failures():
+    config = get_config()
+    return config.getint('health', 'down_after_failures', fallback=DEFAULT_DOWN_AFTER_FAILURES)
+
+def get_max_probe_backoff():
+    config = get_config()
+    return config.getfloat('health', 'max_backoff', fallback=DEFAULT_MAX_PROBE_BACKOFF)
+
+def get_replication_batch_size():
+    config = get_config()
+    return config.getint('replication', 'batch_size', fallback=DEFAULT_REPLICATION_BATCH_SIZE)
+
+def get_replication_batch_interval():
+    config = get_config()
+    return config.getfloat('replication', 'batch_interval', fallback=DEFAULT_REPLICATION_BATCH_INTERVAL)
+
+def get_replication_max_concurrency_per_node():
+    config = get_config()
+    return config.getint('replication', 'max_concurrency_per_node',
+                         fallback=DEFAULT_REPLICATION_MAX_CONCURRENCY_PER_NODE)
+
+def get_replication_max_bandwidth_per_node():
+    config = get_config()
+    return config.getint('replication', 'max_bandwidth_per_node', fallback=0)
+
+def get_replication_storage_root():
+    config = get_config()
+    return config.get('replication', 'storage_root', fallback='/')
+
+def get_replication_slots_dir():
+    config = get_config()
+    return config.get('replication', 'slots_dir', fallback='/tmp/dfs_replication_slots')
+
+def get_http_connect_timeout():
+    config = get_config()
+    return config.getfloat('http', 'connect_timeout', fallback=DEFAULT_HTTP_CONNECT_TIMEOUT)
+
+def get_http_read_timeout():
+    config = get_config()
+    return config.getfloat('http', 'read_timeout', fallback=DEFAULT_HTTP_READ_TIMEOUT)
+
+def get_http_max_connections_per_node():
+    config = get_config()
+    return config.getint('http', 'max_connections_per_node', fallback=DEFAULT_HTTP_MAX_CONNECTIONS_PER_NODE)
+
+def is_http_pool_blocking():
+    config = get_config()
+    return config.getboolean('http', 'pool_block', fallback=True)
+
+def get_placement_reserved_free_bytes():
+    config = get_config()
+    return config.getint('placement', 'reserved_free_bytes', fallback=DEFAULT_PLACEMENT_RESERVED_FREE_BYTES)
+
+def get_placement_strategy():
+    config = get_config()
+    return config.get('placement', 'strategy', fallback=PLACEMENT_RANDOM)
+
+def is_hash_ring_placement():
+    return get_placement_strategy() == PLACEMENT_HASH_RING
+
+def get_ring_virtual_nodes():
+    config = get_config()
+    return config.getint('placement', 'virtual_nodes', fallback=DEFAULT_RING_VIRTUAL_NODES)
+
+def is_read_cache_enabled():
+    config = get_config()
+    return config.getboolean('read_cache', 'enabled', fallback=False)
+
+def get_read_cache_memory_bytes():
+    config = get_config()
+    return config.getint('read_cache', 'memory_bytes', fallback=DEFAULT_READ_CACHE_MEMORY_BYTES)
+
+def get_read_cache_memory_max_file_size():
+    config = get_config()
+    return config.getint('read_cache', 'memory_max_file_size', fallback=DEFAULT_READ_CACHE_MEMORY_MAX_FILE_SIZE)
+
+def get_read_cache_disk_bytes():
+    config = get_config()
+    return config.getint('read_cache', 'disk_bytes', fallback=DEFAULT_READ_CACHE_DISK_BYTES)
+
+def get_read_cache_disk_max_file_size():
+    config = get_config()
+    return config.getint('read_cache', 'disk_max_file_size', fallback=DEFAULT_READ_CACHE_DISK_MAX_FILE_SIZE)
+
+def get_read_cache_disk_dir():
+    config = get_config()
+    return config.get('read_cache', 'disk_dir', fallback=DEFAULT_READ_CACHE_DISK_DIR)
+
+def is_streaming_upload_enabled():
+    config = get_config()
+    return config.getboolean('streaming_upload', 'enabled', fallback=False)
+
+def get_streaming_upload_replay_buffer_bytes():
+    config = get_config()
+    return config.getint('streaming_upload', 'replay_buffer_bytes',
+                         fallback=DEFAULT_STREAMING_UPLOAD_REPLAY_BUFFER_BYTES)
+
+def is_packing_enabled():
+    config = get_config()
+    return config.getboolean('packing', 'enabled', fallback=False)
+
+def get_packing_max_file_size():
+    config = get_config()
+    return config.getint('packing', 'max_file_size', fallback=DEFAULT_PACKING_MAX_FILE_SIZE)
+
+def get_packing_volume_size():
+    config = get_config()
+    return config.getint('packing', 'volume_size', fallback=DEFAULT_PACKING_VOLUME_SIZE)
+
+def get_packing_compaction_garbage_ratio():
+    config = get_config()
+    return config.getfloat('packing', 'compaction_garbage_ratio', fallback=DEFAULT_PACKING_COMPACTION_GARBAGE_RATIO)
+
+def get_packing_compaction_interval():
+    config = get_config()
+    return config.getfloat('packing', 'compaction_interval', fallback=DEFAULT_PACKING_COMPACTION_INTERVAL)
+
+def get_rebalancer_interval():
+    config = get_config()
+    return config.getfloat('rebalancer', 'interval', fallback=DEFAULT_REBALANCER_INTERVAL)
+
+def get_rebalancer_tolerance():
+    config = get_config()
+    return config.getfloat('rebalancer', 'tolerance', fallback=DEFAULT_REBALANCER_TOLERANCE)
+
+def get_rebalancer_max_bytes_per_round():
+    config = get_config()
+    return config.getint('rebalancer', 'max_bytes_per_round', fallback=DEFAULT_REBALANCER_MAX_BYTES_PER_ROUND)
+
+def get_rebalancer_max_bandwidth():
+    config = get_config()
+    return config.getint('rebalancer', 'max_bandwidth', fallback=DEFAULT_REBALANCER_MAX_BANDWIDTH)
+
+def get_rebalancer_delete_delay():
+    config = get_config()
+    return config.getfloat('rebalancer', 'delete_delay', fallback=DEFAULT_REBALANCER_DELETE_DELAY)
+
+def is_hedging_enabled():
+    config = get_config()
+    return config.getboolean('hedging', 'enabled', fallback=False)
+
+def get_hedging_percentile():
+    config = get_config()
+    return config.getfloat('hedging', 'percentile', fallback=DEFAULT_HEDGING_PERCENTILE)
+
+def get_hedging_min_delay():
+    config = get_config()
+    return config.getfloat('hedging', 'min_delay_ms', fallback=DEFAULT_HEDGING_MIN_DELAY_MS) / 1000
+
+def get_hedging_initial_delay():
+    config = get_config()
+    return config.getfloat('hedging', 'initial_delay_ms', fallback=DEFAULT_HEDGING_INITIAL_DELAY_MS) / 1000
+
+"""
+Codec new files are compressed with at rest, or None to store them raw
+"""
+def get_compression_codec():
+    config = get_config()
+    codec = config.get('compression', 'codec', fallback='').strip()
+    if codec in ('', 'none'):
+        return None
+    return codec
+
+def get_compression_max_ratio():
+    config = get_config()
+    return config.getfloat('compression', 'max_ratio', fallback=compression.DEFAULT_MAX_COMPRESSED_RATIO)
+
+def is_dedup_enabled():
+    config = get_config()
+    return config.getboolean('dedup', 'enabled', fallback=False)
+
+def get_hash_algorithm():
+    config = get_config()
+    return config.get('integrity', 'hash_algorithm', fallback=DEFAULT_HASH_ALGORITHM)
+
+def get_host_address_of_node(sn_node):
+    config = get_config()
+    host_node_mapping = json.loads(config['docker_host_node_mapping']['mapping'])
+    node_host_mapping = {node: host for host, node in host_node_mapping.items()}
+    # outside docker-compose the node address is reachable as is
+    return node_host_mapping.get(sn_node, sn_node)
+
+def get_token_secret():
+    config = get_config()
+    return config['security']['token_secret']
+
+def get_token_ttl():
+    config = get_config()
+    return config.getint('security', 'token_ttl', fallback=DEFAULT_TOKEN_TTL)
+
+def is_token_required():
+    config = get_config()
+    return config.getboolean('security', 'require_token', fallback=False)
+
+def _sign_transfer(operation, sn_node, filename, expires_at):
+    message = f"{operation}:{sn_node}:{filename}:{expires_at}"
+    return hmac.new(get_token_secret().encode(), message.encode(), hashlib.sha256).hexdigest()
+
+"""
+Short-lived token allowing `operation` (upload/download/delete, or inventory
+with an empty filename) of filename on sn_node
+Signed with the secret shared by the master and the storage nodes
+"""
+def generate_transfer_token(operation, sn_node, filename):
+    expires_at = int(time.time()) + get_token_ttl()
+    signature = _sign_transfer(operation, sn_node, filename, expires_at)
+    return f"{expires_at}.{signature}"
+
+def is_transfer_token_valid(token, operation, sn_node, filename):
+    try:
+        expires_at, signature = token.split('.', 1)
+        expires_at = int(expires_at)
+    except (AttributeError, ValueError):
+        return False
+    if expires_at < time.time():
+        return False
+    expected_signature = _sign_transfer(operation, sn_node, filename, expires_at)
+    return hmac.compare_digest(signature, expected_signature)
+
 def generate_random_str(str_len):
     allowed_chars = string.ascii_letters + string.digits
     return ''.join(random.choice(allowed_chars) for i in range(str_len))
 
 def is_sn_healthy(sn_ip):
+    return get_sn_load(sn_ip) is not None
+
+"""
+Probe the /health endpoint of an SN
+Returns the load the SN reports (free space, requests in flight, latency),
+or None if it is unreachable or unhealthy.
+"""
+def get_sn_load(sn_ip):
+    from http_pool import get_session
     health_check_url = HEALTH_CHECK_ENDPOINT.format(node_ip=sn_ip)
     try:
-        resp = requests.get(url=health_check_url, timeout=HEALTH_CHECK_TIMEOUT)
+        with metrics.stage_timer('health_probe'):
+            resp = get_session().get(url=health_check_url, timeout=get_health_check_timeout())
         if resp.status_code == requests.codes.ok:
-            return True
+            return resp.json()
     except Exception as e:
         pass
-    return False
+    return None
 
-def select_healthy_sn(exclude_sns=None):
-    from flask import current_app
-    all_storage_nodes = get_all_storage_nodes()
-    available_sns = list(set(all_storage_nodes) - set(exclude_sns))
-    retry_count = 0
-
-    # try only MAX_RETRY_FIND_HEALTHY_SERVER_COUNT times to get a server
-    while retry_count < MAX_RETRY_FIND_HEALTHY_SERVER_COUNT:
-        random_server = random.choice(available_sns)
-        available_sns.remove(random_server)
-
-        current_app.logger.debug(f"Count {retry_count + 1}. Selected {random_server}. Checking health.")
-
-        if is_sn_healthy(random_server):
-            return random_server
-        retry_count += 1
-
-    raise Exception("No available storage nodes.")
+def get_sn_loads(sn_ips):
+    if not sn_ips:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(sn_ips)) as executor:
+        loads = list(executor.map(get_sn_load, sn_ips))
+    return {sn_ip: load for sn_ip, load in zip(sn_ips, loads) if load is not None}
 
 def parse_cmd_args():
     parser = argparse.ArgumentParser()
@@ -75,24 +559,146 @@ def parse_cmd_args():
     args = parser.parse_args()
     return args
 
-def is_file_integrity_matched(filepath, recvd_hash):
-    new_hash = calc_file_md5(filepath)
+def is_file_integrity_matched(filepath, recvd_hash, algorithm=None):
+    new_hash = calc_file_hash(filepath, algorithm)
     if new_hash != recvd_hash:
         raise Exception("File integrity check failed!")
     return True
 
-def calc_file_md5(filepath):
-    md5_hash = hashlib.md5()
+def new_hasher(algorithm=None):
+    algorithm = algorithm or get_hash_algorithm()
+    if algorithm in XXHASH_ALGORITHMS:
+        if xxhash is None:
+            raise Exception(f"Hash algorithm {algorithm} needs the xxhash package.")
+        return getattr(xxhash, algorithm)()
+    if algorithm not in SUPPORTED_HASH_ALGORITHMS:
+        raise Exception(f"Unsupported hash algorithm {algorithm}.")
+    return hashlib.new(algorithm)
+
+def calc_bytes_hash(data, algorithm=None):
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+def calc_file_hash(filepath, algorithm=None):
+    hasher = new_hasher(algorithm)
     with open(filepath, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
-    return md5_hash.hexdigest()
+        for byte_block in iter(lambda: f.read(HASH_READ_CHUNK_SIZE), b""):
+            hasher.update(byte_block)
+    return hasher.hexdigest()
+
+def calc_bytes_md5(data):
+    return calc_bytes_hash(data, 'md5')
+
+def calc_file_md5(filepath):
+    return calc_file_hash(filepath, 'md5')
+
+"""
+Stream fp to filepath, hashing the bytes on the way to disk
+The data is written to a temporary file which is renamed into place only if
+the digest matches expected_hash, so a corrupt upload never becomes visible.
+encoding: fp is already compressed with it; it is stored as it is and
+decompressed on the side, since the hash is of the original content.
+compress_with: fp is raw and is stored compressed with this codec, unless its
+first chunk doesn't compress (already compressed or random data).
+Returns the size of the original content and the encoding it is stored with.
+"""
+def save_stream_with_hash(fp, filepath, expected_hash, algorithm=None, encoding=None, compress_with=None):
+    tmp_filepath = f"{filepath}.part"
+    try:
+        with open(tmp_filepath, "wb") as out:
+            file_size, encoding = write_stream_with_hash(fp, out, expected_hash, algorithm, encoding, compress_with)
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+    return file_size, encoding
+
+"""
+Copy fp to the file object out as save_stream_with_hash stores it
+Raises if the digest doesn't match expected_hash; out then holds the bad data.
+"""
+def write_stream_with_hash(fp, out, expected_hash, algorithm=None, encoding=None, compress_with=None):
+    hasher = new_hasher(algorithm)
+    file_size = 0
+    clock = metrics.StageClock()
+    try:
+        byte_blocks = iter(lambda: fp.read(HASH_READ_CHUNK_SIZE), b"")
+        if encoding:
+            decompressor = compression.get_codec(encoding).decompressor()
+            for byte_block in byte_blocks:
+                clock.lap('sn_save_receive')
+                out.write(byte_block)
+                clock.lap('sn_save_write')
+                data = decompressor.decompress(byte_block)
+                clock.lap('sn_save_decompress')
+                hasher.update(data)
+                clock.lap('sn_save_hash')
+                file_size += len(data)
+            data = decompressor.flush()
+            hasher.update(data)
+            file_size += len(data)
+        else:
+            first_block = next(byte_blocks, b"")
+            compressor = None
+            if compress_with and compression.is_compressible(first_block, compress_with, get_compression_max_ratio()):
+                encoding = compress_with
+                compressor = compression.get_codec(encoding).compressor()
+            for byte_block in itertools.chain([first_block], byte_blocks):
+                clock.lap('sn_save_receive')
+                hasher.update(byte_block)
+                clock.lap('sn_save_hash')
+                file_size += len(byte_block)
+                if compressor:
+                    byte_block = compressor.compress(byte_block)
+                    clock.lap('sn_save_compress')
+                out.write(byte_block)
+                clock.lap('sn_save_write')
+            if compressor:
+                out.write(compressor.flush())
+    finally:
+        clock.observe()
+    if hasher.hexdigest() != expected_hash:
+        raise Exception("File integrity check failed!")
+    return file_size, encoding
+
+def get_checksum_filepath(storage_dir, filename):
+    return os.path.join(storage_dir, CHECKSUM_DIR, f"{filename}.json")
+
+"""
+Persist the checksum of a stored file
+file_hash and file_size are of the original content; encoding is the codec
+the stored bytes are compressed with, if any.
+"""
+def write_checksum_file(storage_dir, filename, algorithm, file_hash, file_size, encoding=None):
+    checksum_filepath = get_checksum_filepath(storage_dir, filename)
+    create_storage_dir(os.path.dirname(checksum_filepath))
+    checksum = make_checksum(algorithm, file_hash, file_size, encoding)
+    with open(f"{checksum_filepath}.part", "w") as fp:
+        json.dump(checksum, fp)
+    os.replace(f"{checksum_filepath}.part", checksum_filepath)
+
+def make_checksum(algorithm, file_hash, file_size, encoding=None):
+    checksum = {'hash_algorithm': algorithm, 'file_hash': file_hash, 'file_size': file_size}
+    if encoding:
+        checksum['encoding'] = encoding
+    return checksum
+
+"""
+Return the checksum stored with the file if there is one
+Else return None
+"""
+def read_checksum_file(storage_dir, filename):
+    try:
+        with open(get_checksum_filepath(storage_dir, filename)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
 
 def check_filepath_sanity(filepath):
     if not os.path.isfile(filepath):
             raise Exception("File not valid.")
 
 def create_storage_dir(dir_path):
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+    # concurrent requests may create it at the same time
+    os.makedirs(dir_path, exist_ok=True)
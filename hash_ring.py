@@ -0,0 +1,63 @@
+"""
+Consistent-hash ring over the storage nodes
+
+Each node is hashed onto the ring at virtual_nodes points. The nodes of a key
+are the distinct nodes met walking clockwise from the key's hash: the first
+is where its primary goes, the next ones its replicas. Since a node owns many
+small arcs, the keys spread evenly, and adding or removing one of N nodes
+moves only the ~1/N of the keys on its arcs.
+
+Anyone with the node list (the master, the SNs, a client with dfs.cfg) finds
+the same nodes for a file without asking the metadata store.
+"""
+import bisect
+import functools
+import hashlib
+
+import flask_utilities
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, nodes, virtual_nodes):
+        points = sorted((hash_key(f"{node}#{i}"), node) for node in set(nodes) for i in range(virtual_nodes))
+        self.positions = [position for position, _ in points]
+        self.ring_nodes = [node for _, node in points]
+        self.num_nodes = len(set(nodes))
+
+    """
+    The first count distinct nodes clockwise from key, primary first
+    """
+    def get_nodes(self, key, count=None):
+        count = self.num_nodes if count is None else min(count, self.num_nodes)
+        nodes = []
+        if not count:
+            return nodes
+        start = bisect.bisect(self.positions, hash_key(key))
+        for i in range(len(self.positions)):
+            node = self.ring_nodes[(start + i) % len(self.positions)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+
+@functools.lru_cache(maxsize=8)
+def get_ring(nodes, virtual_nodes):
+    return HashRing(nodes, virtual_nodes)
+
+"""
+Ring of the configured storage nodes, rebuilt when the list changes
+"""
+def get_cluster_ring():
+    return get_ring(tuple(flask_utilities.get_all_storage_nodes()), flask_utilities.get_ring_virtual_nodes())
+
+"""
+Nodes the ring places key on: the primary and replication_factor replicas
+"""
+def get_file_nodes(key):
+    return get_cluster_ring().get_nodes(key, 1 + flask_utilities.get_replication_factor())
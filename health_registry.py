@@ -0,0 +1,156 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import flask_utilities
+
+NODE_UP = 'up'
+NODE_SUSPECT = 'suspect'
+NODE_DOWN = 'down'
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class NodeHealth:
+    def __init__(self, node):
+        self.node = node
+        self.state = NODE_SUSPECT
+        self.last_seen = None
+        self.last_probed = None
+        self.consecutive_failures = 0
+        self.next_probe_at = 0
+        self.load = None
+
+    def to_dict(self):
+        return {
+            'node': self.node,
+            'state': self.state,
+            'last_seen': self.last_seen,
+            'last_probed': self.last_probed,
+            'consecutive_failures': self.consecutive_failures,
+            'load': self.load
+        }
+
+
+"""
+Master-side view of the storage nodes' health
+A background thread probes the SNs' /health endpoint every heartbeat_interval
+seconds so that the request path only reads the cached state.
+A node which fails a probe is suspect and is avoided; after down_after_failures
+consecutive failures it is down and probed with exponential backoff.
+probe(sn) returns the load reported by the node, or None if it is unhealthy;
+the placement decisions use the load of the last successful probe.
+"""
+class HealthRegistry:
+    def __init__(self, probe=flask_utilities.get_sn_load):
+        self.probe = probe
+        self.nodes = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        # populate the registry before the first request looks at it
+        self.run_heartbeat_round(force=True)
+        self.thread = threading.Thread(target=self._heartbeat_loop, name='sn-heartbeat', daemon=True)
+        self.thread.start()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(flask_utilities.get_heartbeat_interval())
+            try:
+                self.run_heartbeat_round()
+            except Exception:
+                pass
+
+    def run_heartbeat_round(self, force=False):
+        due_nodes = self.get_due_nodes(force)
+        if not due_nodes:
+            return
+        with ThreadPoolExecutor(max_workers=len(due_nodes)) as executor:
+            results = list(executor.map(self.probe, due_nodes))
+        self.record_probe_results(zip(due_nodes, results))
+
+    def get_due_nodes(self, force=False):
+        # storage nodes may be added to the config at any time
+        all_storage_nodes = flask_utilities.get_all_storage_nodes()
+        now = time.time()
+        with self.lock:
+            for sn in all_storage_nodes:
+                self.nodes.setdefault(sn, NodeHealth(sn))
+            for sn in set(self.nodes) - set(all_storage_nodes):
+                del self.nodes[sn]
+            return [sn for sn, health in self.nodes.items() if force or health.next_probe_at <= now]
+
+    def record_probe_results(self, results):
+        for sn, load in results:
+            if load is not None:
+                self.record_success(sn, load)
+            else:
+                self.record_failure(sn)
+
+    def record_success(self, sn, load=None):
+        now = time.time()
+        with self.lock:
+            health = self.nodes.setdefault(sn, NodeHealth(sn))
+            health.state = NODE_UP
+            health.last_seen = now
+            health.last_probed = now
+            health.consecutive_failures = 0
+            health.next_probe_at = now
+            if load is not None:
+                health.load = load
+
+    def record_failure(self, sn):
+        now = time.time()
+        with self.lock:
+            health = self.nodes.setdefault(sn, NodeHealth(sn))
+            health.last_probed = now
+            health.consecutive_failures += 1
+            if health.consecutive_failures >= flask_utilities.get_down_after_failures():
+                health.state = NODE_DOWN
+                # back off exponentially from the heartbeat interval up to max_backoff
+                extra_failures = health.consecutive_failures - flask_utilities.get_down_after_failures()
+                backoff = flask_utilities.get_heartbeat_interval() * (2 ** extra_failures)
+                health.next_probe_at = now + min(backoff, flask_utilities.get_max_probe_backoff())
+            else:
+                health.state = NODE_SUSPECT
+                health.next_probe_at = now
+
+    def is_healthy(self, sn):
+        with self.lock:
+            health = self.nodes.get(sn)
+            if health:
+                return health.state == NODE_UP
+        # a node not seen before is probed once on the request path
+        load = self.probe(sn)
+        self.record_probe_results([(sn, load)])
+        return load is not None
+
+    def get_state(self, sn):
+        with self.lock:
+            health = self.nodes.get(sn)
+            return health.state if health else None
+
+    def get_healthy_nodes(self):
+        with self.lock:
+            return [sn for sn, health in self.nodes.items() if health.state == NODE_UP]
+
+    def get_node_loads(self):
+        with self.lock:
+            return {sn: health.load for sn, health in self.nodes.items() if health.state == NODE_UP}
+
+    def get_status(self):
+        with self.lock:
+            return [health.to_dict() for health in self.nodes.values()]
+
+
+def get_health_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                registry = HealthRegistry()
+                registry.start()
+                _registry = registry
+    return _registry
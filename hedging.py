@@ -0,0 +1,237 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import flask_utilities
+import metrics
+
+LATENCY_WINDOW = 1000
+# below this many samples the p95 is too noisy; the configured initial delay is used
+MIN_LATENCY_SAMPLES = 20
+HEDGE_MAX_WORKERS = 64
+
+
+"""
+Time to first byte of the last LATENCY_WINDOW reads
+"""
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+# only these answers win a read; any other makes it fall back on the next node
+WINNING_STATUSES = (200, 206)
+
+
+def close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def release_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().release()
+
+
+"""
+Outcome of the nodes of a read which didn't win it
+The last error answer is kept, and returned if no node wins (so that e.g. a
+404 of every node is passed on); the answers it replaces are closed. Only if
+no node answered at all is the last exception raised.
+"""
+class FailedReads:
+    def __init__(self, close):
+        self.close = close
+        self.answer = None
+        self.error = None
+
+    def add_answer(self, sn_node, resp):
+        self.discard()
+        self.answer = (sn_node, resp)
+
+    def add_error(self, error):
+        self.error = error
+
+    def discard(self):
+        if self.answer is not None:
+            self.close(self.answer[1])
+            self.answer = None
+
+    def get_result(self):
+        if self.answer is not None:
+            return self.answer
+        raise self.error
+
+
+"""
+Reads which fall back on a replica when the chosen node is slow to answer
+If the response headers of the first node don't arrive within the hedge
+delay (the p95 of the recent times to first byte), the same request is sent
+to the next node as well. The first response wins and the other one is
+closed, so a node in a GC pause or on a saturated disk costs one p95 instead
+of its whole stall. A node failing or answering anything but 200/206 doesn't
+win; the next candidate is asked instead.
+"""
+class HedgedReader:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix='hedged-read')
+        self.ttfb = LatencyTracker()
+        self.stats = {'reads': 0, 'hedges_fired': 0, 'hedges_won': 0}
+        self.lock = threading.Lock()
+
+    def get_hedge_delay(self):
+        p95 = self.ttfb.percentile(flask_utilities.get_hedging_percentile())
+        if p95 is None:
+            return flask_utilities.get_hedging_initial_delay()
+        return max(p95, flask_utilities.get_hedging_min_delay())
+
+    def _count(self, counter):
+        with self.lock:
+            self.stats[counter] += 1
+
+    def _timed_send(self, send, sn_node):
+        start = time.monotonic()
+        resp = send(sn_node)
+        self.ttfb.record(time.monotonic() - start)
+        return resp
+
+    """
+    Send a streaming request to candidate_sns[0], hedged with candidate_sns[1]
+    send(sn_node) makes the request and returns the response as soon as its
+    headers arrive. Returns (sn_node, response) of the node which answered.
+    """
+    def read(self, candidate_sns, send):
+        self._count('reads')
+        remaining = list(candidate_sns)
+        failed = FailedReads(lambda resp: resp.close())
+        if not flask_utilities.is_hedging_enabled() or len(candidate_sns) < 2:
+            for sn_node in remaining:
+                try:
+                    resp = self._timed_send(send, sn_node)
+                except Exception as e:
+                    failed.add_error(e)
+                    continue
+                if resp.status_code in WINNING_STATUSES:
+                    failed.discard()
+                    return sn_node, resp
+                failed.add_answer(sn_node, resp)
+            return failed.get_result()
+
+        futures = {}
+        hedges = set()
+
+        def submit(is_hedge=False):
+            sn_node = remaining.pop(0)
+            future = metrics.submit_in_context(self.executor, self._timed_send, send, sn_node)
+            futures[future] = sn_node
+            if is_hedge:
+                self._count('hedges_fired')
+                hedges.add(future)
+
+        submit()
+        while futures:
+            timeout = self.get_hedge_delay() if remaining and len(futures) == 1 else None
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # slow: ask a replica too and take whichever answers first
+                submit(is_hedge=True)
+                continue
+            for future in done:
+                sn_node = futures.pop(future)
+                if future.exception() is not None:
+                    failed.add_error(future.exception())
+                elif future.result().status_code not in WINNING_STATUSES:
+                    failed.add_answer(sn_node, future.result())
+                else:
+                    for loser in futures:
+                        loser.add_done_callback(close_response)
+                    failed.discard()
+                    if future in hedges:
+                        self._count('hedges_won')
+                    return sn_node, future.result()
+            if not futures and remaining:
+                # failed: fall back on the next node
+                submit()
+        return failed.get_result()
+
+    async def _timed_send_async(self, send, sn_node):
+        start = time.monotonic()
+        resp = await send(sn_node)
+        self.ttfb.record(time.monotonic() - start)
+        return resp
+
+    """
+    read() on an event loop: send(sn_node) is a coroutine function returning
+    an aiohttp response, and the responses which lose are released
+    """
+    async def read_async(self, candidate_sns, send):
+        self._count('reads')
+        remaining = list(candidate_sns)
+        failed = FailedReads(lambda resp: resp.release())
+        if not flask_utilities.is_hedging_enabled() or len(candidate_sns) < 2:
+            for sn_node in remaining:
+                try:
+                    resp = await self._timed_send_async(send, sn_node)
+                except Exception as e:
+                    failed.add_error(e)
+                    continue
+                if resp.status in WINNING_STATUSES:
+                    failed.discard()
+                    return sn_node, resp
+                failed.add_answer(sn_node, resp)
+            return failed.get_result()
+
+        futures = {}
+        hedges = set()
+
+        def submit(is_hedge=False):
+            sn_node = remaining.pop(0)
+            future = asyncio.ensure_future(self._timed_send_async(send, sn_node))
+            futures[future] = sn_node
+            if is_hedge:
+                self._count('hedges_fired')
+                hedges.add(future)
+
+        submit()
+        while futures:
+            timeout = self.get_hedge_delay() if remaining and len(futures) == 1 else None
+            done, _ = await asyncio.wait(list(futures), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                submit(is_hedge=True)
+                continue
+            for future in done:
+                sn_node = futures.pop(future)
+                if future.exception() is not None:
+                    failed.add_error(future.exception())
+                elif future.result().status not in WINNING_STATUSES:
+                    failed.add_answer(sn_node, future.result())
+                else:
+                    for loser in futures:
+                        loser.add_done_callback(release_response)
+                    failed.discard()
+                    if future in hedges:
+                        self._count('hedges_won')
+                    return sn_node, future.result()
+            if not futures and remaining:
+                submit()
+        return failed.get_result()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['enabled'] = flask_utilities.is_hedging_enabled()
+        stats['hedge_delay_ms'] = round(self.get_hedge_delay() * 1000, 3)
+        return stats
@@ -0,0 +1,108 @@
+import os
+import threading
+
+import flask_utilities
+import metrics
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# number of per-node pools kept; more nodes than this evicts the least recently used pool
+MAX_NODE_POOLS = 64
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+"""
+Connection pool which counts the TCP connections it opens
+A pooled connection whose socket was closed by the server is reconnected in
+place, so counting new connection objects would hide the lost keep-alives.
+"""
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    tcp_connects = 0
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        connect = conn.connect
+
+        def counting_connect():
+            self.tcp_connects += 1
+            return connect()
+        conn.connect = counting_connect
+        return conn
+
+class CountingHTTPSConnectionPool(CountingHTTPConnectionPool, HTTPSConnectionPool):
+    pass
+
+
+"""
+HTTPAdapter which applies the configured [http] timeouts
+to the requests that don't pass their own
+It also sends the trace id of the request being handled on to the next node.
+"""
+class PooledHTTPAdapter(HTTPAdapter):
+    def send(self, request, timeout=None, **kwargs):
+        trace_id = metrics.get_trace_id()
+        if trace_id and metrics.TRACE_ID_HEADER not in request.headers:
+            request.headers[metrics.TRACE_ID_HEADER] = trace_id
+        if timeout is None:
+            timeout = (flask_utilities.get_http_connect_timeout(), flask_utilities.get_http_read_timeout())
+        return super().send(request, timeout=timeout, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+
+def create_session():
+    adapter = PooledHTTPAdapter(
+        pool_connections=MAX_NODE_POOLS,
+        pool_maxsize=flask_utilities.get_http_max_connections_per_node(),
+        pool_block=flask_utilities.is_http_pool_blocking()
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+"""
+Process-wide requests session with a keep-alive connection pool per node
+Pools hold at most [http] max_connections_per_node connections; with
+pool_block a request waits for a free connection instead of opening one more.
+A forked child (e.g. a Celery prefork worker) gets its own session since
+sockets can't be shared with the parent.
+"""
+def get_session():
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = create_session()
+                _session_pid = pid
+    return _session
+
+def get_pool_stats():
+    adapter = get_session().get_adapter('http://')
+    pools = adapter.poolmanager.pools
+    stats = []
+    for key in list(pools.keys()):
+        try:
+            pool = pools[key]
+        except KeyError:
+            continue
+        stats.append({
+            'node': f"{pool.host}:{pool.port}",
+            'requests': pool.num_requests,
+            'connections_opened': pool.tcp_connects,
+            'connections_reused': max(pool.num_requests - pool.tcp_connects, 0),
+            # a pool_block queue is pre-filled with None placeholders
+            'idle_connections': sum(1 for conn in pool.pool.queue if conn) if pool.pool else 0,
+            'max_connections': adapter._pool_maxsize
+        })
+    return stats
@@ -1,17 +1,71 @@
 import os
-import sqlite3
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, closing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
 
 import flask_utilities
+import hash_ring
+import hedging
+import http_pool
+import master_core
+import metadata_store
+import metrics
+import multipart_stream
+import read_cache
 import requests
-from flask import Flask, Response, jsonify, request, stream_with_context
+from health_registry import NODE_UP, get_health_registry
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.wsgi import wrap_file
 
 MY_NODE = os.environ['NODE']
 MY_PORT = os.environ['PORT']
 FILE_DOWNLOAD_ENDPOINT = "http://{node_ip}/download"
 FILE_UPLOAD_ENDPOINT = "http://{node_ip}/upload"
+FILE_DELETE_ENDPOINT = "http://{node_ip}/delete"
+FILE_STAT_ENDPOINT = "http://{node_ip}/stat"
 MAX_RETRY_FILE_SAVE_TO_SN_COUNT = 3
+BLOCK_TRANSFER_TIMEOUT = (3.05, 60)
+PROXIED_REQUEST_HEADERS = ['Range', 'If-Range', flask_utilities.ACCEPT_FILE_ENCODING_HEADER]
+PROXIED_RESPONSE_HEADERS = ['Content-Length', 'Content-Type', 'Content-Range', 'Accept-Ranges', 'file_hash',
+                            flask_utilities.FILE_ENCODING_HEADER]
 
 app = Flask(__name__)
+# HTTP/1.0 closes the connection after every response, defeating the callers' keep-alive pools
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+flask_utilities.install_config_reload_handler()
+hedged_reader = hedging.HedgedReader()
+
+# read from the registry and the pools when /metrics is scraped
+NODE_UP_GAUGE = metrics.Gauge('dfs_node_up', "1 if the heartbeat sees the storage node up, else 0.")
+POOL_REQUESTS = metrics.Gauge('dfs_http_pool_requests_total', "Requests sent to each storage node.", 'counter')
+POOL_CONNECTS = metrics.Gauge('dfs_http_pool_connections_opened_total',
+                              "TCP connections opened to each storage node.", 'counter')
+POOL_IDLE = metrics.Gauge('dfs_http_pool_idle_connections', "Keep-alive connections idle in each pool.")
+
+
+@app.before_request
+def start_request_timer():
+    g.request_timer_start = time.perf_counter()
+    # sent on to the storage nodes, which hand it to the replication of the file
+    metrics.set_trace_id(request.headers.get(metrics.TRACE_ID_HEADER) or metrics.new_trace_id())
+
+@app.after_request
+def observe_request(resp):
+    if 'request_timer_start' in g:
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - g.request_timer_start,
+            endpoint=request.endpoint or 'unknown',
+            status=resp.status_code
+        )
+    resp.headers[metrics.TRACE_ID_HEADER] = metrics.get_trace_id() or ''
+    return resp
 
 
 # test URL
@@ -20,18 +74,73 @@ def test():
     return 'Master is working!'
 
 
+@app.route('/sn_health', methods=['GET'])
+def sn_health():
+    resp = jsonify({'storage_nodes': get_health_registry().get_status()})
+    resp.status_code = 200
+    return resp
+
+
 @app.route('/upload', methods=['POST'])
 def upload():
+    if flask_utilities.is_streaming_upload_enabled():
+        boundary = multipart_stream.get_boundary(request)
+        if boundary and master_core.can_stream_upload(request.content_length):
+            return upload_streaming(boundary)
+    filename = None
     try:
         fp = request.files['input_file']
         file_hash = request.form['file_hash']
+        hash_algorithm = request.form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        file_encoding = request.form.get('file_encoding')
         filename = fp.filename
+
+        with metrics.stage_timer('master_upload_dedup_check'):
+            deduplicated_filename = master_core.add_content_reference(filename, hash_algorithm, file_hash)
+        if deduplicated_filename:
+            return deduplicated_response(deduplicated_filename)
+
         # filename is the primary key; avoid collision
-        filename = generate_unique_filename(filename)
+        # the name stays reserved until the upload succeeds or fails
+        with metrics.stage_timer('master_upload_reserve_name'):
+            filename = metadata_store.reserve_unique_filename(filename)
+
+        file_size = get_upload_size(fp)
+        # fragments and blocks are hashed and served raw, so a compressed upload is stored whole
+        if not file_encoding and master_core.should_erasure_code(file_size):
+            with metrics.stage_timer('master_upload_erasure_coded'):
+                resp_code, resp_msg = upload_erasure_coded(
+                    fp=fp,
+                    filename=filename,
+                    file_hash=file_hash,
+                    hash_algorithm=hash_algorithm,
+                    file_size=file_size
+                )
+            metrics.STAGE_BYTES.inc(file_size, stage='master_upload_erasure_coded')
+            resp = jsonify({'message': resp_msg})
+            resp.status_code = resp_code
+            return resp
+
+        if not file_encoding and master_core.should_store_in_blocks(file_size):
+            with metrics.stage_timer('master_upload_blocks'):
+                resp_code, resp_msg = upload_in_blocks(
+                    fp=fp,
+                    filename=filename,
+                    file_hash=file_hash,
+                    hash_algorithm=hash_algorithm
+                )
+            metrics.STAGE_BYTES.inc(file_size, stage='master_upload_blocks')
+            resp = jsonify({'message': resp_msg})
+            resp.status_code = resp_code
+            return resp
+
         data = {
             'file_hash': file_hash,
+            'hash_algorithm': hash_algorithm,
             'filename': filename
         }
+        if file_encoding:
+            data['file_encoding'] = file_encoding
 
         resp_code = 500
         resp_msg = "Something went wrong while processing."
@@ -39,80 +148,98 @@ def upload():
 
         exclude_sns = []
         while retry_count < MAX_RETRY_FILE_SAVE_TO_SN_COUNT:
-            sn_node = flask_utilities.select_healthy_sn(exclude_sns=exclude_sns)
+            with metrics.stage_timer('master_upload_select_sn'):
+                sn_node = select_healthy_sn(exclude_sns=exclude_sns, num_bytes=file_size, filename=filename)
             app.logger.debug(f"Attempt {retry_count+1}: Trying to store {filename} to SN {sn_node}.")
             file_upload_url = FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node)
+            data['token'] = flask_utilities.generate_transfer_token('upload', sn_node, filename)
+            fp.stream.seek(0)   # rewind in case a previous attempt consumed the stream
             files = {'input_file': fp}
-            resp = requests.post(url=file_upload_url, files=files, data=data)
+            try:
+                with metrics.stage_timer('master_upload_sn_post'):
+                    resp = http_pool.get_session().post(url=file_upload_url, files=files, data=data)
+                metrics.STAGE_BYTES.inc(file_size, stage='master_upload_sn_post')
+            except requests.exceptions.ConnectionError as e:
+                app.logger.error(f"Storing {filename} to SN {sn_node} failed: {str(e)}")
+                get_health_registry().record_failure(sn_node)
+                resp_code, resp_msg = None, None
+                retry_count += 1
+                exclude_sns.append(sn_node)
+                continue
             resp_code = resp.status_code
             resp_msg = resp.json()['message']
             if resp_code == requests.codes.ok:
                 app.logger.info(f"{filename} saved to {sn_node}")
                 app.logger.debug("Updating master table")
-                update_master_table(
-                    filename=filename,
-                    primary_node=f"{sn_node}"
-                )
+                with metrics.stage_timer('master_upload_metadata'):
+                    master_core.record_upload(filename, sn_node, resp.json().get('file_size'), file_hash,
+                                              hash_algorithm)
                 app.logger.debug("Updated master table")
                 break
             retry_count += 1
-            exclude_sns.append(sn_code)
+            exclude_sns.append(sn_node)
 
         if resp_code != requests.codes.ok:
             if not resp_code:   resp_code = 500
             if not resp_msg:    resp_msg = f"{MAX_RETRY_FILE_SAVE_TO_SN_COUNT} attempts to save file to SN failed."
+            metadata_store.release_filename(filename)
     except Exception as e:
         resp_code = 500
         resp_msg = str(e)
+        if filename:
+            metadata_store.release_filename(filename)
 
     resp = jsonify({'message': resp_msg})
     resp.status_code = resp_code
     return resp
 
-@app.route('/download', methods=['GET'])
+@app.route('/download', methods=['GET', 'HEAD'])
 def download():
     try:
         filename = request.args['filename']
         filename = os.path.basename(filename)
-        payload = {'filename': filename}
+        if request.method == 'HEAD':
+            return head_response(filename)
+        lookup_start = time.perf_counter()
+        if flask_utilities.is_hash_ring_placement():
+            resp = download_from_ring(filename, lookup_start)
+            if resp is not None:
+                return resp
+        stored = master_core.lookup_download(filename)
+        if stored is None:
+            resp_msg = f"{filename} does not exist in the file system."
+            app.logger.error(resp_msg)
+            resp = jsonify({'message': resp_msg})
+            resp.status_code = 404
+            return resp
+        # a deduplicated name reads the file it references
+        filename, pnode = stored['filename'], stored['pnode']
 
-        resp_code = 500
-        resp_msg = "Something went wrong while processing."
+        # hot files are answered without the SNs; the primary node tells a stale entry
+        if flask_utilities.is_read_cache_enabled():
+            cached = read_cache.get_read_cache().get(filename, pnode)
+            if cached:
+                metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+                return send_cached(filename, *cached)
 
-        pnode = return_pnode_of_file(filename)
+        # blocks and fragments carry their own locations and replicas
+        if stored['chunked_file']:
+            metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+            return download_in_blocks(filename=filename, chunked_file=stored['chunked_file'], pnode=pnode)
+        if stored['ec_file']:
+            metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+            return download_erasure_coded(filename=filename, ec_file=stored['ec_file'], pnode=pnode)
 
-        if not pnode:
-            resp_code = 404
-            resp_msg = f"{filename} does not exist in the file system."
+        candidate_sns = get_read_candidates(filename, pnode)
+        metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+        if not candidate_sns:
+            resp_code = 500
+            resp_msg = f"No healthy SN containing {filename} found!"
             app.logger.error(resp_msg)
             resp = jsonify({'message': resp_msg})
             resp.status_code = resp_code
             return resp
-        
-        else:
-            app.logger.debug(f"Checking if primary node {pnode} containing {filename} is healthy.")
-            is_pnode_healthy = flask_utilities.is_sn_healthy(pnode)
-            if not is_pnode_healthy:
-                app.logger.error(f"Primary node {pnode} unhealthy. Trying to retrieve {filename} from replicated copies.")
-                node = find_healthy_sn_with_file(filename)
-                if not node:
-                    resp_code = 500
-                    resp_msg = f"No healthy SN containing {filename} found!"
-                    app.logger.error(msg)
-                    resp = jsonify({'message': resp_msg})
-                    resp.status_code = resp_code
-                    return resp
-            else:
-                app.logger.debug(f"Primary node {pnode} found healthy for {filename}.")
-                node = pnode
-
-            file_retrieve_url = FILE_DOWNLOAD_ENDPOINT.format(node_ip=node)
-            resp = requests.get(url=file_retrieve_url, params=payload, stream=True)
-            new_resp = Response(stream_with_context(resp.iter_content(chunk_size=2048)))
-            new_resp.headers['Content-Length'] = resp.headers['Content-Length']
-            new_resp.headers['Content-Type'] = resp.headers['Content-Type']
-            new_resp.headers['file_hash'] = resp.headers['file_hash']
-            return new_resp
+        return proxy_sn_download(filename, candidate_sns, pnode)
     except Exception as e:
         resp_code = 500
         resp_msg = str(e)
@@ -120,80 +247,959 @@ def download():
         resp.status_code = resp_code
         return resp
 
-def update_master_table(filename, primary_node):
-    sql_stmt = f"""
-        INSERT INTO master_node (filename, primary_node)
-        VALUES ("{filename}", "{primary_node}");
-    """
-    conn = sqlite3.connect(flask_utilities.get_db_name())
-    with conn:
-        conn.execute(sql_stmt)
-    conn.close()
-
-def generate_unique_filename(filename):
-    sql_stmt = f"""
-        SELECT filename FROM master_node
-        WHERE filename="{filename}";
-    """
-    conn = sqlite3.connect(flask_utilities.get_db_name())
-    cur = conn.cursor()
-    with conn:
-        cur.execute(sql_stmt)
-        data = cur.fetchone()
-        if data:
-            filename, ext = filename.rsplit('.', 1)
-            filename = f"{filename}_{flask_utilities.generate_random_str(5)}.{ext}"
-    conn.close()
-    return filename
-
-"""
-Return primary node of file if it exists
-Else return None
-"""
-def return_pnode_of_file(filename):
-    pnode = None
-    sql_stmt = f"""
-        SELECT primary_node FROM master_node
-        WHERE filename="{filename}";
-    """
-    conn = sqlite3.connect(flask_utilities.get_db_name())
-    cur = conn.cursor()
-    with conn:
-        cur.execute(sql_stmt)
-        data = cur.fetchone()
-        if data:
-            pnode = data[0]
-    conn.close()
-    return pnode
-
-def get_sns_with_file_copy(filename):
-    all_sns_with_replica = []
-    sql_stmt = f"""
-        SELECT replicated_node FROM replication_data
-        WHERE filename="{filename}";
-    """
-    conn = sqlite3.connect(flask_utilities.get_db_name())
-    cur = conn.cursor()
-    with conn:
-        cur.execute(sql_stmt)
-        data = cur.fetchall() # -> [('sn0:5000',), ('sn3:6050',)]
-        if data:
-            all_sns_with_replica = [row[0] for row in data] # -> ['sn0', 'sn3']
-    conn.close()
-    return all_sns_with_replica
-
-def find_healthy_sn_with_file(filename):
-    all_sns_with_replica = get_sns_with_file_copy(filename)
-    app.logger.debug(f"Found servers with replica of {filename}: {all_sns_with_replica}")
-    for count, sn_ip in enumerate(all_sns_with_replica):
-        app.logger.debug(f"Attempt {count+1}. Checking health for {sn_ip}. Has file replica for {filename}.")
-        if flask_utilities.is_sn_healthy(sn_ip):
-            return sn_ip
-    return None
+@app.route('/upload_location', methods=['POST'])
+def upload_location():
+    try:
+        filename = os.path.basename(request.form['filename'])
+        if 'file_hash' in request.form:
+            deduplicated_filename = master_core.add_content_reference(
+                filename,
+                request.form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM),
+                request.form['file_hash']
+            )
+            if deduplicated_filename:
+                resp = jsonify({'filename': deduplicated_filename, 'deduplicated': True})
+                resp.status_code = 200
+                return resp
+        # filename is the primary key; avoid collision
+        # the name stays reserved until the upload succeeds or fails
+        filename = metadata_store.reserve_unique_filename(filename)
+        try:
+            sn_node = select_healthy_sn(filename=filename)
+            location = {
+                'filename': filename,
+                'node': sn_node,
+                'node_address': flask_utilities.get_host_address_of_node(sn_node),
+                'token': flask_utilities.generate_transfer_token('upload', sn_node, filename)
+            }
+        except Exception:
+            # no upload will commit the name
+            metadata_store.release_filename(filename)
+            raise
+        app.logger.debug(f"Handing out {sn_node} to store {filename} directly.")
+        resp = jsonify(location)
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+@app.route('/upload_commit', methods=['POST'])
+def upload_commit():
+    try:
+        filename = request.form['filename']
+        sn_node = request.form['node']
+        # the upload token proves that this master placed the file on that SN
+        if not flask_utilities.is_transfer_token_valid(request.form['token'], 'upload', sn_node, filename):
+            resp = jsonify({'message': f"Missing or invalid transfer token for {filename}."})
+            resp.status_code = 403
+            return resp
+        # the client's word isn't enough; the SN says what it actually stored
+        checksum = get_sn_checksum(sn_node, filename)
+        error = master_core.check_committed_upload(
+            filename=filename,
+            sn_node=sn_node,
+            checksum=checksum,
+            file_size=request.form.get('file_size', type=int),
+            file_hash=request.form.get('file_hash'),
+            hash_algorithm=request.form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        )
+        if error:
+            resp = jsonify({'message': error})
+            resp.status_code = 409
+            return resp
+        master_core.record_upload(
+            filename=filename,
+            sn_node=sn_node,
+            file_size=checksum['file_size'],
+            file_hash=checksum['file_hash'],
+            hash_algorithm=checksum['hash_algorithm']
+        )
+        app.logger.info(f"{filename} saved directly to {sn_node}")
+        resp = jsonify({'message': f"File {filename} saved successfully."})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+@app.route('/download_location', methods=['GET'])
+def download_location():
+    try:
+        resp_code, location = get_download_location(request.args['filename'])
+        resp = jsonify(location)
+        resp.status_code = resp_code
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+"""
+Locations of many files in one request
+The body is {"filenames": [...]}; the answer has one /download_location
+result per file, in the same order, with its status_code.
+"""
+@app.route('/download_locations', methods=['POST'])
+def download_locations():
+    try:
+        locations = []
+        for filename in request.get_json()['filenames']:
+            try:
+                resp_code, location = get_download_location(filename)
+            except Exception as e:
+                resp_code, location = 500, {'message': str(e)}
+            location['status_code'] = resp_code
+            locations.append(location)
+        resp = jsonify({'locations': locations})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+"""
+Placement of many files in one request
+The body is {"files": [{"filename", "file_hash", "hash_algorithm", "file_size"}, ...]};
+the names are reserved in one transaction and the answer has one
+/upload_location result per file, in the same order.
+"""
+@app.route('/upload_locations', methods=['POST'])
+def upload_locations():
+    try:
+        files = request.get_json()['files']
+        locations = [None] * len(files)
+        to_reserve = []
+        for idx, file in enumerate(files):
+            filename = os.path.basename(file['filename'])
+            if 'file_hash' in file:
+                deduplicated_filename = master_core.add_content_reference(
+                    filename,
+                    file.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM),
+                    file['file_hash']
+                )
+                if deduplicated_filename:
+                    locations[idx] = {'status_code': 200, 'filename': deduplicated_filename, 'deduplicated': True}
+                    continue
+            to_reserve.append((idx, filename))
+
+        reserved_filenames = metadata_store.reserve_unique_filenames([filename for _, filename in to_reserve])
+        for (idx, _), filename in zip(to_reserve, reserved_filenames):
+            try:
+                sn_node = select_healthy_sn(num_bytes=files[idx].get('file_size', 0), filename=filename)
+            except Exception as e:
+                metadata_store.release_filename(filename)
+                locations[idx] = {'status_code': 500, 'message': str(e)}
+                continue
+            locations[idx] = {
+                'status_code': 200,
+                'filename': filename,
+                'node': sn_node,
+                'node_address': flask_utilities.get_host_address_of_node(sn_node),
+                'token': flask_utilities.generate_transfer_token('upload', sn_node, filename)
+            }
+        app.logger.debug(f"Handed out locations for {len(files)} files.")
+        resp = jsonify({'locations': locations})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+"""
+Commit many direct uploads in one transaction
+The body is {"files": [{"filename", "node", "token", "file_hash", "hash_algorithm"}, ...]};
+the answer has a status_code and message per file, in the same order. The
+files are checked with their SNs, max_parallel_transfers at a time.
+"""
+@app.route('/upload_commits', methods=['POST'])
+def upload_commits():
+    try:
+        files = request.get_json()['files']
+        results = [None] * len(files)
+        to_check = []
+        for idx, file in enumerate(files):
+            filename = file['filename']
+            if not flask_utilities.is_transfer_token_valid(file['token'], 'upload', file['node'], filename):
+                results[idx] = {'status_code': 403, 'message': f"Missing or invalid transfer token for {filename}."}
+                continue
+            to_check.append(idx)
+
+        def check_upload(idx):
+            file = files[idx]
+            checksum = get_sn_checksum(file['node'], file['filename'])
+            error = master_core.check_committed_upload(
+                filename=file['filename'],
+                sn_node=file['node'],
+                checksum=checksum,
+                file_size=file.get('file_size'),
+                file_hash=file.get('file_hash'),
+                hash_algorithm=file.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+            )
+            return checksum, error
+
+        master_records = []
+        content_records = []
+        if to_check:
+            with ThreadPoolExecutor(max_workers=flask_utilities.get_max_parallel_transfers()) as executor:
+                futures = [metrics.submit_in_context(executor, check_upload, idx) for idx in to_check]
+            for idx, future in zip(to_check, futures):
+                filename = files[idx]['filename']
+                try:
+                    checksum, error = future.result()
+                except Exception as e:
+                    results[idx] = {'status_code': 500, 'message': str(e)}
+                    continue
+                if error:
+                    results[idx] = {'status_code': 409, 'message': error}
+                    continue
+                master_records.append((
+                    filename,
+                    files[idx]['node'],
+                    checksum['file_size'],
+                    checksum['file_hash'],
+                    checksum['hash_algorithm']
+                ))
+                content_records.append((checksum['hash_algorithm'], checksum['file_hash'], filename))
+                results[idx] = {'status_code': 200, 'message': f"File {filename} saved successfully."}
+        metadata_store.update_master_tables(master_records)
+        if flask_utilities.is_dedup_enabled():
+            metadata_store.register_contents(content_records)
+        app.logger.info(f"{len(master_records)} files saved directly to the SNs")
+        resp = jsonify({'results': results})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+"""
+Cheap check before the client sends the body of a PUT
+If the content is already stored, the file is saved as a reference to it.
+"""
+@app.route('/upload_preflight', methods=['POST'])
+def upload_preflight():
+    try:
+        filename = os.path.basename(request.form['filename'])
+        hash_algorithm = request.form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        deduplicated_filename = master_core.add_content_reference(filename, hash_algorithm, request.form['file_hash'])
+        if deduplicated_filename:
+            resp = jsonify(master_core.get_deduplicated_answer(deduplicated_filename))
+        else:
+            resp = jsonify({'message': "Content not stored yet. Upload the file.", 'deduplicated': False})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+"""
+Timings of the master, node health and connection pools in the Prometheus text format
+"""
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    for node in flask_utilities.get_all_storage_nodes():
+        NODE_UP_GAUGE.set(1 if get_health_registry().get_state(node) == NODE_UP else 0, node=node)
+    for pool in http_pool.get_pool_stats():
+        POOL_REQUESTS.set(pool['requests'], node=pool['node'])
+        POOL_CONNECTS.set(pool['connections_opened'], node=pool['node'])
+        POOL_IDLE.set(pool['idle_connections'], node=pool['node'])
+    master_core.update_read_gauges(hedged_reader)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    resp = jsonify(dict(master_core.get_read_stats(hedged_reader), http_pools=http_pool.get_pool_stats()))
+    resp.status_code = 200
+    return resp
+
+"""
+Size, hash, creation time and location of a file, from the metadata only
+"""
+@app.route('/stat', methods=['GET'])
+def stat():
+    try:
+        filename = os.path.basename(request.args['filename'])
+        file_stat = master_core.get_file_stat(filename)
+        if file_stat is None:
+            resp_msg = f"{filename} does not exist in the file system."
+            app.logger.error(resp_msg)
+            resp = jsonify({'message': resp_msg})
+            resp.status_code = 404
+            return resp
+        resp = jsonify(file_stat)
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+"""
+Records of the files whose names start with prefix, in name order, a page at a time
+"""
+@app.route('/list', methods=['GET'])
+def list_files():
+    try:
+        resp = jsonify(master_core.list_files(
+            prefix=request.args.get('prefix', ''),
+            start_after=request.args.get('start_after', ''),
+            limit=request.args.get('limit', type=int)
+        ))
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+"""
+Delete a file and the copies stored for it
+A deduplicated name only drops its reference to the stored content.
+"""
+@app.route('/delete', methods=['DELETE'])
+def delete():
+    try:
+        filename = os.path.basename(request.args['filename'])
+        try:
+            copies = metadata_store.delete_file(filename)
+        except ValueError as e:
+            resp = jsonify({'message': str(e)})
+            resp.status_code = 409
+            return resp
+        if copies is None:
+            resp_msg = f"{filename} does not exist in the file system."
+            app.logger.error(resp_msg)
+            resp = jsonify({'message': resp_msg})
+            resp.status_code = 404
+            return resp
+        delete_stored_copies(copies)
+        resp = jsonify({'message': f"File {filename} deleted successfully."})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': str(e)})
+        resp.status_code = 500
+    return resp
+
+def deduplicated_response(filename):
+    resp = jsonify(master_core.get_deduplicated_answer(filename))
+    resp.status_code = 200
+    return resp
+
+def select_healthy_sn(exclude_sns=None, num_bytes=0, filename=None):
+    return master_core.select_write_node(get_health_registry().get_node_loads(), exclude_sns, num_bytes, filename)
+
+"""
+Store an upload, reading its file part from the client while it is sent on
+to the SN
+Nothing of the file is spooled; its first replay_buffer_bytes are kept so
+that an SN failing while they are all of it sent so far is replaced by
+another one. A larger upload whose SN fails is answered 503 for the client
+to send it again.
+"""
+def upload_streaming(boundary):
+    filename = None
+    reader = multipart_stream.MultipartReader(request.stream, boundary)
+    try:
+        form, file_part = reader.read_fields()
+        if file_part is None or file_part[0] != 'input_file':
+            raise ValueError("The form fields must be followed by the input_file part.")
+        file_hash = form['file_hash']
+        hash_algorithm = form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        file_encoding = form.get('file_encoding')
+        filename = file_part[1]
+
+        with metrics.stage_timer('master_upload_dedup_check'):
+            deduplicated_filename = master_core.add_content_reference(filename, hash_algorithm, file_hash)
+        if deduplicated_filename:
+            return deduplicated_response(deduplicated_filename)
+
+        with metrics.stage_timer('master_upload_reserve_name'):
+            filename = metadata_store.reserve_unique_filename(filename)
+
+        data = {
+            'file_hash': file_hash,
+            'hash_algorithm': hash_algorithm,
+            'filename': filename,
+            # for the SN to tell small files, as it gets no Content-Length
+            'size_hint': request.content_length
+        }
+        if file_encoding:
+            data['file_encoding'] = file_encoding
+        replay = multipart_stream.UploadReplay(reader, flask_utilities.get_streaming_upload_replay_buffer_bytes())
+        resp_code = 500
+        resp_msg = f"{MAX_RETRY_FILE_SAVE_TO_SN_COUNT} attempts to save file to SN failed."
+        exclude_sns = []
+        for retry_count in range(MAX_RETRY_FILE_SAVE_TO_SN_COUNT):
+            if retry_count and not replay.can_replay():
+                resp_code = requests.codes.service_unavailable
+                resp_msg = (f"Storing {filename} failed after more than the {replay.max_bytes} bytes kept to retry "
+                            f"were sent; send it again.")
+                break
+            with metrics.stage_timer('master_upload_select_sn'):
+                sn_node = select_healthy_sn(exclude_sns=exclude_sns, num_bytes=request.content_length,
+                                            filename=filename)
+            app.logger.debug(f"Attempt {retry_count+1}: Streaming {filename} to SN {sn_node}.")
+            data['token'] = flask_utilities.generate_transfer_token('upload', sn_node, filename)
+            sn_boundary = multipart_stream.new_boundary()
+            body = replay.iter_body(multipart_stream.form_head(sn_boundary, data, 'input_file', filename),
+                                    multipart_stream.form_tail(sn_boundary))
+            try:
+                with metrics.stage_timer('master_upload_sn_post'):
+                    resp = http_pool.get_session().post(
+                        url=FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node),
+                        data=body,
+                        headers={'Content-Type': multipart_stream.get_content_type(sn_boundary)}
+                    )
+            except requests.exceptions.ConnectionError as e:
+                if replay.error:
+                    # the client went away, not the SN
+                    raise replay.error
+                app.logger.error(f"Streaming {filename} to SN {sn_node} failed: {str(e)}")
+                get_health_registry().record_failure(sn_node)
+                exclude_sns.append(sn_node)
+                continue
+            resp_code = resp.status_code
+            resp_msg = resp.json()['message']
+            if resp_code == requests.codes.ok:
+                metrics.STAGE_BYTES.inc(replay.read_bytes, stage='master_upload_sn_post')
+                app.logger.info(f"{filename} streamed to {sn_node}")
+                with metrics.stage_timer('master_upload_metadata'):
+                    master_core.record_upload(filename, sn_node, resp.json().get('file_size'), file_hash,
+                                              hash_algorithm)
+                break
+            exclude_sns.append(sn_node)
+
+        if resp_code != requests.codes.ok:
+            metadata_store.release_filename(filename)
+    except Exception as e:
+        resp_code = 500
+        resp_msg = str(e)
+        if filename:
+            metadata_store.release_filename(filename)
+    finally:
+        reader.drain()
+
+    resp = jsonify({'message': resp_msg})
+    resp.status_code = resp_code
+    return resp
+
+"""
+Read filename from the nodes the hash ring places it on, without the metadata
+Returns None, for the metadata lookup to take over, if none of them is up or
+the one answering doesn't have the file: it was placed elsewhere or moved, or
+the name is a deduplicated, chunked or erasure-coded file.
+"""
+def download_from_ring(filename, lookup_start):
+    registry = get_health_registry()
+    ring_sns = hash_ring.get_file_nodes(filename)
+    candidate_sns = [sn for sn in ring_sns if registry.is_healthy(sn)]
+    if not candidate_sns:
+        return None
+    if flask_utilities.is_read_cache_enabled():
+        # any version: names are never reused, and the metadata isn't looked up to tell
+        cached = read_cache.get_read_cache().get(filename)
+        if cached:
+            metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+            return send_cached(filename, *cached)
+    metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+    return proxy_sn_download(filename, candidate_sns, ring_sns[0], fall_through_on_missing=True)
+
+"""
+Stream filename from the first of candidate_sns to answer with it, hedged with the next
+pnode tags the read cache entry the file may fill. If no node has the file, the
+answer of the last one is passed on; with fall_through_on_missing, a 404 is not
+passed on and None is returned instead.
+"""
+def proxy_sn_download(filename, candidate_sns, pnode, fall_through_on_missing=False):
+    # pass byte ranges through so that partial reads move only the requested bytes
+    headers = {header: request.headers[header] for header in PROXIED_REQUEST_HEADERS
+                if header in request.headers}
+
+    def send(sn_node):
+        payload = {
+            'filename': filename,
+            'token': flask_utilities.generate_transfer_token('download', sn_node, filename)
+        }
+        file_retrieve_url = FILE_DOWNLOAD_ENDPOINT.format(node_ip=sn_node)
+        return http_pool.get_session().get(url=file_retrieve_url, params=payload, headers=headers, stream=True)
+
+    # until the headers of the SN's answer, hedges included
+    with metrics.stage_timer('master_download_first_byte'):
+        node, resp = hedged_reader.read(candidate_sns, send)
+    if fall_through_on_missing and resp.status_code == requests.codes.not_found:
+        resp.close()
+        app.logger.debug(f"{filename} is not on its ring node {node}; looking it up.")
+        return None
+    app.logger.debug(f"Streaming {filename} from {node}")
+    body = stream_sn_response(resp, 'master_download_stream')
+    # only the original bytes of a whole file are cached
+    if master_core.is_cacheable_response(resp.status_code, resp.headers):
+        body = cache_on_read(
+            filename=filename,
+            pnode=pnode,
+            chunks=body,
+            size=int(resp.headers['Content-Length']),
+            file_hash=resp.headers['file_hash'],
+            hash_algorithm=resp.headers.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        )
+    new_resp = Response(stream_with_context(body), status=resp.status_code)
+    for header in PROXIED_RESPONSE_HEADERS:
+        if header in resp.headers:
+            new_resp.headers[header] = resp.headers[header]
+    new_resp.headers['hash_algorithm'] = resp.headers.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+    return new_resp
+
+def stream_sn_response(resp, stage):
+    start = time.perf_counter()
+    num_bytes = 0
+    # closing an unfinished response drops its connection instead of returning it to the pool
+    with closing(resp):
+        for data in resp.iter_content(chunk_size=2048):
+            num_bytes += len(data)
+            yield data
+    metrics.observe_stage(stage, time.perf_counter() - start, num_bytes)
+
+"""
+Answer a GET from a read cache entry, honouring its Range header
+"""
+def send_cached(filename, entry, fp):
+    if fp is None:
+        resp = Response(entry.data, mimetype='application/octet-stream')
+    else:
+        resp = Response(wrap_file(request.environ, fp), mimetype='application/octet-stream', direct_passthrough=True)
+        resp.content_length = entry.size
+    resp.headers['file_hash'] = entry.file_hash
+    resp.headers['hash_algorithm'] = entry.hash_algorithm
+    try:
+        resp.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+    except RequestedRangeNotSatisfiable:
+        resp.close()
+        resp = range_not_satisfiable(filename, entry.size)
+    return resp
+
+def range_not_satisfiable(filename, file_size):
+    answer, status, headers = master_core.get_range_not_satisfiable(filename, file_size)
+    resp = jsonify(answer)
+    resp.status_code = status
+    resp.headers.extend(headers)
+    return resp
+
+"""
+Chunks of a whole-file read, kept in the read cache on their way to the client
+"""
+def cache_on_read(filename, pnode, chunks, size, file_hash, hash_algorithm):
+    if not flask_utilities.is_read_cache_enabled():
+        return chunks
+    return read_cache.get_read_cache().fill(filename, pnode, chunks, size, file_hash, hash_algorithm)
+
+"""
+Where to read filename from directly
+Returns the status code and the /download_location answer.
+"""
+def get_download_location(filename):
+    filename = os.path.basename(filename)
+    stored = master_core.lookup_download(filename)
+    if stored is None:
+        return 404, {'message': f"{filename} does not exist in the file system."}
+    filename, pnode, chunked_file = stored['filename'], stored['pnode'], stored['chunked_file']
+
+    if stored['ec_file']:
+        # the fragments are decoded by the master; the client falls back on /download
+        return 409, {'message': f"{filename} is erasure coded and can only be read through the master."}
+
+    if chunked_file:
+        blocks = []
+        for block in metadata_store.get_file_blocks(filename):
+            node = select_sn_for_download(block['block_name'], block['node']) or block['node']
+            blocks.append({
+                'block_name': block['block_name'],
+                'node': node,
+                'node_address': flask_utilities.get_host_address_of_node(node),
+                'block_hash': block['block_hash'],
+                'token': flask_utilities.generate_transfer_token('download', node, block['block_name'])
+            })
+        return 200, {
+            'filename': filename,
+            'file_hash': chunked_file['file_hash'],
+            'hash_algorithm': chunked_file['hash_algorithm'],
+            'blocks': blocks
+        }
+
+    node = select_sn_for_download(filename, pnode)
+    if not node:
+        return 500, {'message': f"No healthy SN containing {filename} found!"}
+    return 200, {
+        'filename': filename,
+        'node': node,
+        'node_address': flask_utilities.get_host_address_of_node(node),
+        'token': flask_utilities.generate_transfer_token('download', node, filename)
+    }
+
+"""
+Answer to HEAD /download from the metadata, without reading from an SN
+"""
+def head_response(filename):
+    headers = master_core.get_head_headers(filename)
+    if headers is None:
+        return Response(status=404)
+    return Response(status=200, headers=headers)
+
+"""
+Healthy nodes holding a copy of filename, in the order to read from them
+Reads are spread across the primary and the replicas by their load.
+"""
+def get_read_candidates(filename, pnode):
+    registry = get_health_registry()
+    healthy_sns = [sn for sn in master_core.get_copy_nodes(filename, pnode) if registry.is_healthy(sn)]
+    return master_core.order_read_candidates(filename, pnode, healthy_sns, registry.get_node_loads())
+
+def select_sn_for_download(filename, pnode):
+    candidate_sns = get_read_candidates(filename, pnode)
+    app.logger.debug(f"Healthy SNs with {filename}: {candidate_sns}")
+    return candidate_sns[0] if candidate_sns else None
+
+def get_upload_size(fp):
+    fp.stream.seek(0, os.SEEK_END)
+    file_size = fp.stream.tell()
+    fp.stream.seek(0)
+    return file_size
+
+"""
+Store a file as Reed-Solomon fragments on distinct storage nodes
+The fragments are encoded stripe by stripe into temporary files and then
+sent to their nodes in parallel. A node failing its fragment is replaced by a
+node not holding one yet. The fragments are not replicated.
+"""
+def upload_erasure_coded(fp, filename, file_hash, hash_algorithm, file_size):
+    codec, stripe_unit, fragment_size, nodes, spare_nodes = master_core.plan_erasure_coding(
+        get_health_registry().get_node_loads(), file_size)
+    spare_nodes_lock = threading.Lock()
+
+    def store_fragment(fragment_index, fragment_file, fragment_hash):
+        fragment_name = flask_utilities.get_fragment_name(filename, fragment_index)
+        sn_node = nodes[fragment_index]
+        while True:
+            fragment_file.seek(0)
+            if upload_fragment(fragment_name, fragment_file, fragment_hash, hash_algorithm, sn_node):
+                return master_core.get_fragment_record(fragment_index, fragment_name, sn_node, fragment_size,
+                                                       fragment_hash)
+            with spare_nodes_lock:
+                if not spare_nodes:
+                    raise Exception(f"No storage node left to store fragment {fragment_name}.")
+                sn_node = spare_nodes.pop(0)
+
+    with ExitStack() as stack:
+        fragment_files = [stack.enter_context(tempfile.TemporaryFile()) for _ in range(codec.total_fragments)]
+        with metrics.stage_timer('master_ec_encode'):
+            encoded_file_hash, fragment_hashes = flask_utilities.write_erasure_coded_fragments(
+                fp.stream, codec, stripe_unit, fragment_files, hash_algorithm)
+        if encoded_file_hash != file_hash:
+            raise Exception("File integrity check failed!")
+
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=codec.total_fragments) as executor:
+                futures = [
+                    metrics.submit_in_context(executor, store_fragment, fragment_index, fragment_file, fragment_hash)
+                    for fragment_index, (fragment_file, fragment_hash)
+                    in enumerate(zip(fragment_files, fragment_hashes))
+                ]
+                fragments = [future.result() for future in futures]
+            return 200, master_core.record_erasure_coded_upload(filename, file_size, file_hash, hash_algorithm,
+                                                                codec, stripe_unit, fragments)
+        except Exception:
+            # the executor has waited for every fragment; the ones stored would never be referenced
+            delete_stored_copies([(fragment['fragment_name'], fragment['node']) for fragment in
+                                  (future.result() for future in futures if not future.exception())])
+            raise
+
+def upload_fragment(fragment_name, fragment_file, fragment_hash, hash_algorithm, sn_node):
+    payload = {
+        'file_hash': fragment_hash,
+        'hash_algorithm': hash_algorithm,
+        'filename': fragment_name,
+        'token': flask_utilities.generate_transfer_token('upload', sn_node, fragment_name),
+        'replicate': 'false'
+    }
+    files = {'input_file': (fragment_name, fragment_file)}
+    file_upload_url = FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node)
+    try:
+        resp = http_pool.get_session().post(url=file_upload_url, files=files, data=payload)
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Storing fragment {fragment_name} to SN {sn_node} failed: {str(e)}")
+        get_health_registry().record_failure(sn_node)
+        return False
+    if resp.status_code != requests.codes.ok:
+        app.logger.error(f"Storing fragment {fragment_name} to SN {sn_node} failed: {resp.status_code}")
+        return False
+    return True
+
+"""
+Stream an erasure-coded file, or the requested range of it
+The data fragments are read if their nodes answer, so a healthy file is only
+concatenated; a missing one is replaced by a parity fragment and the stripes
+are decoded. Only the stripes overlapping the range are read.
+"""
+def download_erasure_coded(filename, ec_file, pnode=None):
+    file_size = ec_file['file_size']
+    stripe_unit = ec_file['stripe_unit']
+    byte_range = master_core.get_byte_range(request.headers.get('Range'), file_size)
+    if byte_range is None:
+        return range_not_satisfiable(filename, file_size)
+    start, stop = byte_range
+    codec, stripe_size, first_stripe, end_stripe = master_core.get_stripe_span(ec_file, start, stop)
+    with metrics.stage_timer('master_download_first_byte'):
+        streams = open_fragment_streams(
+            fragments=metadata_store.get_file_fragments(filename),
+            num_needed=codec.data_fragments,
+            start=first_stripe * stripe_unit,
+            stop=end_stripe * stripe_unit
+        )
+    if any(fragment_index >= codec.data_fragments for fragment_index in streams):
+        app.logger.warning(f"Degraded read of {filename} from fragments {sorted(streams)}")
+
+    def generate():
+        try:
+            for stripe_index in range(first_stripe, end_stripe):
+                units = {fragment_index: read_unit(resp, stripe_unit) for fragment_index, resp in streams.items()}
+                stripe = b"".join(codec.decode(units))
+                yield master_core.slice_stripe(stripe, stripe_index, stripe_size, start, stop)
+        finally:
+            for resp in streams.values():
+                resp.close()
+
+    status, headers = master_core.get_range_headers(file_size, ec_file['file_hash'], ec_file['hash_algorithm'],
+                                                    start, stop)
+    body = generate()
+    if status == requests.codes.ok and pnode:
+        body = cache_on_read(filename, pnode, body, file_size, ec_file['file_hash'], ec_file['hash_algorithm'])
+    return Response(stream_with_context(body), status=status, headers=headers)
+
+"""
+Open streaming reads of bytes [start, stop) of num_needed fragments in parallel
+Fragments are tried in index order, data fragments first; every one which
+can't be read is replaced by the next. Returns {fragment_index: response}.
+"""
+def open_fragment_streams(fragments, num_needed, start, stop):
+    headers = {'Range': f"bytes={start}-{stop - 1}"}
+    pending = list(fragments)
+    streams = {}
+    with ThreadPoolExecutor(max_workers=num_needed) as executor:
+        while len(streams) < num_needed:
+            batch = pending[:num_needed - len(streams)]
+            del pending[:len(batch)]
+            if len(batch) < num_needed - len(streams):
+                for resp in streams.values():
+                    resp.close()
+                raise Exception(f"Only {len(streams) + len(batch)} fragments readable, {num_needed} needed.")
+            futures = [(fragment, metrics.submit_in_context(executor, open_fragment_stream, fragment, headers))
+                       for fragment in batch]
+            for fragment, future in futures:
+                resp = future.result()
+                if resp is not None:
+                    streams[fragment['fragment_index']] = resp
+    return streams
+
+def open_fragment_stream(fragment, headers):
+    fragment_name, sn_node = fragment['fragment_name'], fragment['node']
+    if not get_health_registry().is_healthy(sn_node):
+        return None
+    payload = {
+        'filename': fragment_name,
+        'token': flask_utilities.generate_transfer_token('download', sn_node, fragment_name)
+    }
+    file_retrieve_url = FILE_DOWNLOAD_ENDPOINT.format(node_ip=sn_node)
+    try:
+        resp = http_pool.get_session().get(url=file_retrieve_url, params=payload, headers=headers, stream=True)
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Reading fragment {fragment_name} from SN {sn_node} failed: {str(e)}")
+        get_health_registry().record_failure(sn_node)
+        return None
+    if resp.status_code not in (requests.codes.ok, requests.codes.partial_content):
+        app.logger.error(f"Reading fragment {fragment_name} from SN {sn_node} failed: {resp.status_code}")
+        resp.close()
+        return None
+    return resp
+
+def read_unit(resp, size):
+    chunks = []
+    while size:
+        data = resp.raw.read(size)
+        if not data:
+            raise Exception("Fragment stream ended before the end of the stripe.")
+        chunks.append(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+def upload_in_blocks(fp, filename, file_hash, hash_algorithm):
+    block_size = flask_utilities.get_block_size()
+    max_parallel = flask_utilities.get_max_parallel_transfers()
+    block_nodes = master_core.get_block_nodes(get_health_registry().get_node_loads(), num_bytes=block_size)
+    # start from a random node so that the first block of every file doesn't land on the same SN
+    first_sn_idx = random.randrange(len(block_nodes))
+    file_hasher = flask_utilities.new_hasher(hash_algorithm)
+    file_size = 0
+    futures = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            block_index = 0
+            for data in iter(lambda: fp.stream.read(block_size), b""):
+                file_hasher.update(data)
+                file_size += len(data)
+                # don't hold more than max_parallel blocks in memory at once
+                pending = [future for future in futures if not future.done()]
+                if len(pending) >= max_parallel:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                block_name = flask_utilities.get_block_name(filename, block_index)
+                candidate_sns = master_core.get_block_candidates(block_nodes, first_sn_idx, block_index)
+                futures.append(metrics.submit_in_context(executor, upload_block, block_index, block_name, data,
+                                                         hash_algorithm, candidate_sns))
+                block_index += 1
+            blocks = [future.result() for future in futures]
+
+        if file_hasher.hexdigest() != file_hash:
+            raise Exception("File integrity check failed!")
+
+        return 200, master_core.record_chunked_upload(filename, file_size, file_hash, hash_algorithm, block_size,
+                                                      blocks)
+    except Exception:
+        # the executor has waited for every block; the ones stored would never be referenced
+        delete_stored_copies([(block['block_name'], block['node'])
+                              for block in (future.result() for future in futures if not future.exception())])
+        raise
+
+def upload_block(block_index, block_name, data, hash_algorithm, candidate_sns):
+    block_hash = flask_utilities.calc_bytes_hash(data, hash_algorithm)
+    payload = {
+        'file_hash': block_hash,
+        'hash_algorithm': hash_algorithm,
+        'filename': block_name
+    }
+    for count, sn_node in enumerate(candidate_sns[:MAX_RETRY_FILE_SAVE_TO_SN_COUNT]):
+        app.logger.debug(f"Attempt {count+1}: Trying to store block {block_name} to SN {sn_node}.")
+        file_upload_url = FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node)
+        payload['token'] = flask_utilities.generate_transfer_token('upload', sn_node, block_name)
+        files = {'input_file': (block_name, data)}
+        try:
+            resp = http_pool.get_session().post(url=file_upload_url, files=files, data=payload, timeout=BLOCK_TRANSFER_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            app.logger.error(f"Storing block {block_name} to SN {sn_node} failed: {str(e)}")
+            get_health_registry().record_failure(sn_node)
+            continue
+        if resp.status_code == requests.codes.ok:
+            return master_core.get_block_record(block_index, block_name, sn_node, len(data), block_hash)
+    raise Exception(f"{MAX_RETRY_FILE_SAVE_TO_SN_COUNT} attempts to save block {block_name} to SN failed.")
+
+"""
+Delete the (name, node) copies of a deleted file, or an upload stored before it failed
+A copy which can't be deleted is only logged, for the delete or the upload's own error to be answered.
+"""
+def delete_stored_copies(copies):
+    for name, sn_node in copies:
+        params = {
+            'filename': name,
+            'token': flask_utilities.generate_transfer_token('delete', sn_node, name)
+        }
+        try:
+            resp = http_pool.get_session().delete(url=FILE_DELETE_ENDPOINT.format(node_ip=sn_node), params=params,
+                                                  timeout=BLOCK_TRANSFER_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            app.logger.error(f"Deleting {name} from SN {sn_node} failed: {str(e)}")
+            continue
+        if resp.status_code not in (requests.codes.ok, requests.codes.not_found):
+            app.logger.error(f"Deleting {name} from SN {sn_node} failed: {resp.status_code}")
+        else:
+            app.logger.info(f"Deleted {name} from SN {sn_node}.")
+
+"""
+Checksum of filename as stored on sn_node (its hash, hash algorithm and
+original size), or None if the SN doesn't hold it
+"""
+def get_sn_checksum(sn_node, filename):
+    params = {
+        'filename': filename,
+        'token': flask_utilities.generate_transfer_token('stat', sn_node, filename)
+    }
+    resp = http_pool.get_session().get(url=FILE_STAT_ENDPOINT.format(node_ip=sn_node), params=params,
+                                       timeout=BLOCK_TRANSFER_TIMEOUT)
+    if resp.status_code == requests.codes.not_found:
+        return None
+    if resp.status_code != requests.codes.ok:
+        raise Exception(f"SN {sn_node} answered {resp.status_code} to the stat of {filename}.")
+    return resp.json()
+
+"""
+Release the names of uploads which never finished, every PENDING_UPLOAD_REAP_INTERVAL seconds
+"""
+def pending_upload_reaper():
+    while True:
+        time.sleep(master_core.PENDING_UPLOAD_REAP_INTERVAL)
+        try:
+            master_core.release_expired_reservations()
+        except Exception as e:
+            app.logger.error(f"Releasing expired reservations failed: {str(e)}")
+
+def download_in_blocks(filename, chunked_file, pnode=None):
+    max_parallel = flask_utilities.get_max_parallel_transfers()
+    blocks = metadata_store.get_file_blocks(filename)
+    hash_algorithm = chunked_file['hash_algorithm']
+    file_size = chunked_file['file_size']
+
+    # only the blocks overlapping the requested range are fetched
+    byte_range = master_core.get_byte_range(request.headers.get('Range'), file_size)
+    if byte_range is None:
+        return range_not_satisfiable(filename, file_size)
+    start, stop = byte_range
+
+    block_slices = flask_utilities.get_block_slices(blocks, start, stop)
+
+    def generate():
+        # keep up to max_parallel blocks in flight, but yield them in order
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            pending_slices = iter(block_slices)
+            futures = deque(
+                (metrics.submit_in_context(executor, fetch_block, block, hash_algorithm), slice_start, slice_stop)
+                for block, slice_start, slice_stop in islice(pending_slices, max_parallel)
+            )
+            while futures:
+                future, slice_start, slice_stop = futures.popleft()
+                data = future.result()
+                next_slice = next(pending_slices, None)
+                if next_slice:
+                    block, next_start, next_stop = next_slice
+                    futures.append((metrics.submit_in_context(executor, fetch_block, block, hash_algorithm),
+                                    next_start, next_stop))
+                yield data[slice_start:slice_stop]
+
+    status, headers = master_core.get_range_headers(file_size, chunked_file['file_hash'], hash_algorithm, start, stop)
+    body = generate()
+    if status == requests.codes.ok and pnode:
+        body = cache_on_read(filename, pnode, body, file_size, chunked_file['file_hash'], hash_algorithm)
+    return Response(stream_with_context(body), status=status, headers=headers)
+
+def fetch_block(block, hash_algorithm):
+    block_name = block['block_name']
+    payload = {'filename': block_name}
+    candidate_sns = get_read_candidates(block_name, block['node'])
+    for count, sn_node in enumerate(candidate_sns):
+        app.logger.debug(f"Attempt {count+1}: Trying to retrieve block {block_name} from SN {sn_node}.")
+        file_retrieve_url = FILE_DOWNLOAD_ENDPOINT.format(node_ip=sn_node)
+        payload['token'] = flask_utilities.generate_transfer_token('download', sn_node, block_name)
+        try:
+            resp = http_pool.get_session().get(url=file_retrieve_url, params=payload, timeout=BLOCK_TRANSFER_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            app.logger.error(f"Retrieving block {block_name} from SN {sn_node} failed: {str(e)}")
+            get_health_registry().record_failure(sn_node)
+            continue
+        if resp.status_code == requests.codes.ok:
+            if flask_utilities.calc_bytes_hash(resp.content, hash_algorithm) == block['block_hash']:
+                return resp.content
+            app.logger.error(f"Block {block_name} on SN {sn_node} failed integrity check.")
+    raise Exception(f"No healthy SN containing block {block_name} found!")
+
+threading.Thread(target=pending_upload_reaper, name='pending-upload-reaper', daemon=True).start()
 
 if __name__ == '__main__':
-    flask_utilities.create_storage_dir(dir_path=STORAGE_DIR)
+    # the master keeps no file data, so it has no storage dir
     app.config['NODE'] = MY_NODE
     app.config['PORT'] = MY_PORT
-    app.config['STORAGE_DIR'] = f"storage_{app.config['NODE']}_{app.config['PORT']}"
     app.run(host="0.0.0.0", port=MY_PORT)
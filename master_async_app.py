@@ -0,0 +1,980 @@
+"""
+Asyncio master server
+Serves the /test, /upload, /download, /stat, /list, /metrics and /stats routes
+of master_app on an ASGI event loop, so that a slow SN transfer holds a coroutine instead of a
+worker thread. Where files go and what is recorded about them is decided in
+master_core, which master_app calls too; only the transfers differ. All the
+SN traffic goes through one aiohttp session whose connection pool keeps
+connections to every SN alive (at most [http] max_connections_per_node
+each), and the SN health probes of a heartbeat round run concurrently on the
+same loop.
+
+$ uvicorn master_async_app:app --host 0.0.0.0 --port 8820 --workers 4
+"""
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import deque
+from contextlib import ExitStack, asynccontextmanager
+from functools import partial
+from itertools import islice
+
+import aiohttp
+import flask_utilities
+import hash_ring
+import hedging
+import master_core
+import metadata_store
+import metrics
+import multipart_stream
+import read_cache
+from health_registry import NODE_UP, HealthRegistry
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+FILE_DOWNLOAD_ENDPOINT = "http://{node_ip}/download"
+FILE_UPLOAD_ENDPOINT = "http://{node_ip}/upload"
+FILE_DELETE_ENDPOINT = "http://{node_ip}/delete"
+MAX_RETRY_FILE_SAVE_TO_SN_COUNT = 3
+STREAM_CHUNK_SIZE = 64 * 1024
+PROXIED_REQUEST_HEADERS = ['Range', 'If-Range', flask_utilities.ACCEPT_FILE_ENCODING_HEADER]
+PROXIED_RESPONSE_HEADERS = ['Content-Length', 'Content-Type', 'Content-Range', 'Accept-Ranges', 'file_hash',
+                            flask_utilities.FILE_ENCODING_HEADER]
+
+logger = logging.getLogger('master_async_app')
+
+http_session = None
+health_registry = HealthRegistry()
+hedged_reader = hedging.HedgedReader()
+NODE_UP_GAUGE = metrics.Gauge('dfs_node_up', "1 if the heartbeat sees the storage node up, else 0.")
+
+
+"""
+Trace id and timing of every request
+The endpoint runs in a task which copies this context, trace id included.
+"""
+async def observe_request(request, call_next):
+    start = time.perf_counter()
+    metrics.set_trace_id(request.headers.get(metrics.TRACE_ID_HEADER) or metrics.new_trace_id())
+    resp = await call_next(request)
+    endpoint = request.scope.get('endpoint')
+    metrics.REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        endpoint=endpoint.__name__ if endpoint else 'unknown',
+        status=resp.status_code
+    )
+    resp.headers[metrics.TRACE_ID_HEADER] = metrics.get_trace_id()
+    return resp
+
+"""
+aiohttp hook sending the trace id of the request being handled on to the SNs
+"""
+async def add_trace_id_header(session, trace_config_ctx, params):
+    trace_id = metrics.get_trace_id()
+    if trace_id and metrics.TRACE_ID_HEADER not in params.headers:
+        params.headers[metrics.TRACE_ID_HEADER] = trace_id
+
+
+"""
+Run a blocking call (SQLite, hashing) in the loop's thread pool
+"""
+async def run_sync(func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+# test URL
+async def test(request):
+    return PlainTextResponse('Master is working!')
+
+
+async def sn_health(request):
+    return JSONResponse({'storage_nodes': health_registry.get_status()}, status_code=200)
+
+
+async def metrics_endpoint(request):
+    for node in flask_utilities.get_all_storage_nodes():
+        NODE_UP_GAUGE.set(1 if health_registry.get_state(node) == NODE_UP else 0, node=node)
+    master_core.update_read_gauges(hedged_reader)
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def stats(request):
+    return JSONResponse(master_core.get_read_stats(hedged_reader), status_code=200)
+
+
+"""
+Size, hash, creation time and location of a file, from the metadata only
+"""
+async def stat(request):
+    try:
+        filename = os.path.basename(request.query_params['filename'])
+        file_stat = await run_sync(master_core.get_file_stat, filename)
+        if file_stat is None:
+            resp_msg = f"{filename} does not exist in the file system."
+            logger.error(resp_msg)
+            return JSONResponse({'message': resp_msg}, status_code=404)
+        return JSONResponse(file_stat, status_code=200)
+    except Exception as e:
+        return JSONResponse({'message': str(e)}, status_code=500)
+
+
+"""
+Records of the files whose names start with prefix, in name order, a page at a time
+"""
+async def list_files(request):
+    try:
+        try:
+            limit = int(request.query_params['limit'])
+        except (KeyError, ValueError):
+            limit = None
+        page = await run_sync(
+            master_core.list_files,
+            prefix=request.query_params.get('prefix', ''),
+            start_after=request.query_params.get('start_after', ''),
+            limit=limit
+        )
+        return JSONResponse(page, status_code=200)
+    except Exception as e:
+        return JSONResponse({'message': str(e)}, status_code=500)
+
+"""
+Delete a file and the copies stored for it, as master_app does
+"""
+async def delete(request):
+    try:
+        filename = os.path.basename(request.query_params['filename'])
+        try:
+            copies = await run_sync(metadata_store.delete_file, filename)
+        except ValueError as e:
+            return JSONResponse({'message': str(e)}, status_code=409)
+        if copies is None:
+            resp_msg = f"{filename} does not exist in the file system."
+            logger.error(resp_msg)
+            return JSONResponse({'message': resp_msg}, status_code=404)
+        await delete_stored_copies(copies)
+        return JSONResponse({'message': f"File {filename} deleted successfully."}, status_code=200)
+    except Exception as e:
+        return JSONResponse({'message': str(e)}, status_code=500)
+
+
+async def upload(request):
+    if flask_utilities.is_streaming_upload_enabled():
+        boundary = multipart_stream.parse_boundary(request.headers.get('content-type'))
+        content_length = get_content_length(request)
+        if boundary and master_core.can_stream_upload(content_length):
+            return await upload_streaming(request, boundary, content_length)
+    filename = None
+    try:
+        async with request.form() as form:
+            fp = form['input_file']
+            file_hash = form['file_hash']
+            hash_algorithm = form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+            file_encoding = form.get('file_encoding')
+            filename = fp.filename
+
+            with metrics.stage_timer('master_upload_dedup_check'):
+                deduplicated_filename = await run_sync(master_core.add_content_reference, filename, hash_algorithm,
+                                                       file_hash)
+            if deduplicated_filename:
+                return JSONResponse(master_core.get_deduplicated_answer(deduplicated_filename), status_code=200)
+
+            # filename is the primary key; avoid collision
+            # the name stays reserved until the upload succeeds or fails
+            with metrics.stage_timer('master_upload_reserve_name'):
+                filename = await run_sync(metadata_store.reserve_unique_filename, filename)
+
+            file_size = await run_sync(get_file_size, fp.file)
+            # fragments and blocks are hashed and served raw, so a compressed upload is stored whole
+            if not file_encoding and master_core.should_erasure_code(file_size):
+                with metrics.stage_timer('master_upload_erasure_coded'):
+                    resp_code, resp_msg = await upload_erasure_coded(
+                        fp=fp,
+                        filename=filename,
+                        file_hash=file_hash,
+                        hash_algorithm=hash_algorithm,
+                        file_size=file_size
+                    )
+                metrics.STAGE_BYTES.inc(file_size, stage='master_upload_erasure_coded')
+                return JSONResponse({'message': resp_msg}, status_code=resp_code)
+
+            if not file_encoding and master_core.should_store_in_blocks(file_size):
+                with metrics.stage_timer('master_upload_blocks'):
+                    resp_code, resp_msg = await upload_in_blocks(
+                        fp=fp,
+                        filename=filename,
+                        file_hash=file_hash,
+                        hash_algorithm=hash_algorithm
+                    )
+                metrics.STAGE_BYTES.inc(file_size, stage='master_upload_blocks')
+                return JSONResponse({'message': resp_msg}, status_code=resp_code)
+
+            resp_code, resp_msg = await upload_to_sn(fp, filename, file_hash, hash_algorithm, file_size, file_encoding)
+            if resp_code != 200:
+                await run_sync(metadata_store.release_filename, filename)
+    except Exception as e:
+        resp_code = 500
+        resp_msg = str(e)
+        if filename:
+            await run_sync(metadata_store.release_filename, filename)
+
+    return JSONResponse({'message': resp_msg}, status_code=resp_code)
+
+"""
+Store an upload, reading its file part from the client while it is sent on
+to the SN, as master_app does
+The multipart body is parsed by multipart_stream in the loop's thread pool.
+"""
+async def upload_streaming(request, boundary, content_length):
+    filename = None
+    reader = multipart_stream.MultipartReader(BlockingStream(request.stream(), asyncio.get_event_loop()), boundary)
+    try:
+        form, file_part = await run_sync(reader.read_fields)
+        if file_part is None or file_part[0] != 'input_file':
+            raise ValueError("The form fields must be followed by the input_file part.")
+        file_hash = form['file_hash']
+        hash_algorithm = form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        file_encoding = form.get('file_encoding')
+        filename = file_part[1]
+
+        with metrics.stage_timer('master_upload_dedup_check'):
+            deduplicated_filename = await run_sync(master_core.add_content_reference, filename, hash_algorithm,
+                                                   file_hash)
+        if deduplicated_filename:
+            return JSONResponse(master_core.get_deduplicated_answer(deduplicated_filename), status_code=200)
+
+        with metrics.stage_timer('master_upload_reserve_name'):
+            filename = await run_sync(metadata_store.reserve_unique_filename, filename)
+
+        data = {
+            'file_hash': file_hash,
+            'hash_algorithm': hash_algorithm,
+            'filename': filename,
+            # for the SN to tell small files, as it gets no Content-Length
+            'size_hint': content_length
+        }
+        if file_encoding:
+            data['file_encoding'] = file_encoding
+        replay = multipart_stream.UploadReplay(reader, flask_utilities.get_streaming_upload_replay_buffer_bytes())
+        resp_code = 500
+        resp_msg = f"{MAX_RETRY_FILE_SAVE_TO_SN_COUNT} attempts to save file to SN failed."
+        exclude_sns = []
+        for retry_count in range(MAX_RETRY_FILE_SAVE_TO_SN_COUNT):
+            if retry_count and not replay.can_replay():
+                resp_code = 503
+                resp_msg = (f"Storing {filename} failed after more than the {replay.max_bytes} bytes kept to retry "
+                            f"were sent; send it again.")
+                break
+            with metrics.stage_timer('master_upload_select_sn'):
+                sn_node = select_healthy_sn(exclude_sns=exclude_sns, num_bytes=content_length, filename=filename)
+            logger.debug(f"Attempt {retry_count+1}: Streaming {filename} to SN {sn_node}.")
+            data['token'] = flask_utilities.generate_transfer_token('upload', sn_node, filename)
+            sn_boundary = multipart_stream.new_boundary()
+            body = iter_in_thread(replay.iter_body(multipart_stream.form_head(sn_boundary, data, 'input_file', filename),
+                                                   multipart_stream.form_tail(sn_boundary)))
+            try:
+                with metrics.stage_timer('master_upload_sn_post'):
+                    async with http_session.post(
+                        FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node),
+                        data=body,
+                        headers={'Content-Type': multipart_stream.get_content_type(sn_boundary)}
+                    ) as resp:
+                        resp_code = resp.status
+                        resp_json = await resp.json()
+                        resp_msg = resp_json['message']
+            except aiohttp.ClientConnectionError as e:
+                if replay.error:
+                    # the client went away, not the SN
+                    raise replay.error
+                logger.error(f"Streaming {filename} to SN {sn_node} failed: {str(e)}")
+                health_registry.record_failure(sn_node)
+                exclude_sns.append(sn_node)
+                continue
+            if resp_code == 200:
+                metrics.STAGE_BYTES.inc(replay.read_bytes, stage='master_upload_sn_post')
+                logger.info(f"{filename} streamed to {sn_node}")
+                with metrics.stage_timer('master_upload_metadata'):
+                    await run_sync(master_core.record_upload, filename, sn_node, resp_json.get('file_size'),
+                                   file_hash, hash_algorithm)
+                break
+            exclude_sns.append(sn_node)
+
+        if resp_code != 200:
+            await run_sync(metadata_store.release_filename, filename)
+    except Exception as e:
+        resp_code = 500
+        resp_msg = str(e)
+        if filename:
+            await run_sync(metadata_store.release_filename, filename)
+    finally:
+        try:
+            await run_sync(reader.drain)
+        except ClientDisconnect:
+            # the rest of the body will never come; the answer goes nowhere either
+            logger.debug(f"The client went away before the end of the upload of {filename}.")
+
+    return JSONResponse({'message': resp_msg}, status_code=resp_code)
+
+def get_content_length(request):
+    try:
+        return int(request.headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+
+"""
+Body of an ASGI request as a blocking stream, for multipart_stream to parse
+in the loop's thread pool
+read() waits for the next chunk of the body on the loop, so it must not be
+called from the loop itself.
+"""
+class BlockingStream:
+    def __init__(self, chunks, loop):
+        self.chunks = chunks
+        self.loop = loop
+        self.buffer = b''
+
+    async def _next_chunk(self):
+        async for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return b''
+
+    def read(self, size):
+        if not self.buffer:
+            self.buffer = asyncio.run_coroutine_threadsafe(self._next_chunk(), self.loop).result()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+"""
+Chunks of a blocking iterator, each taken from it in the loop's thread pool
+"""
+async def iter_in_thread(chunks):
+    while True:
+        chunk = await run_sync(next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+async def download(request):
+    try:
+        filename = request.query_params['filename']
+        filename = os.path.basename(filename)
+        if request.method == 'HEAD':
+            return await head_response(filename)
+        lookup_start = time.perf_counter()
+        if flask_utilities.is_hash_ring_placement():
+            resp = await download_from_ring(request, filename, lookup_start)
+            if resp is not None:
+                return resp
+        stored = await run_sync(master_core.lookup_download, filename)
+        if stored is None:
+            resp_msg = f"{filename} does not exist in the file system."
+            logger.error(resp_msg)
+            return JSONResponse({'message': resp_msg}, status_code=404)
+        # a deduplicated name reads the file it references
+        filename, pnode = stored['filename'], stored['pnode']
+
+        # hot files are answered without the SNs; the primary node tells a stale entry
+        if flask_utilities.is_read_cache_enabled():
+            cached = read_cache.get_read_cache().get(filename, pnode)
+            if cached:
+                metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+                return send_cached(request, filename, *cached)
+
+        # blocks and fragments carry their own locations and replicas
+        if stored['chunked_file']:
+            metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+            return await download_in_blocks(request, filename, stored['chunked_file'], pnode)
+        if stored['ec_file']:
+            metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+            return await download_erasure_coded(request, filename, stored['ec_file'], pnode)
+
+        candidate_sns = await get_read_candidates(filename, pnode)
+        metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+        if not candidate_sns:
+            resp_msg = f"No healthy SN containing {filename} found!"
+            logger.error(resp_msg)
+            return JSONResponse({'message': resp_msg}, status_code=500)
+        return await proxy_sn_download(request, filename, candidate_sns, pnode)
+    except Exception as e:
+        return JSONResponse({'message': str(e)}, status_code=500)
+
+"""
+Read filename from the nodes the hash ring places it on, without the metadata
+Returns None, for the metadata lookup to take over, if none of them is up or
+the one answering doesn't have the file.
+"""
+async def download_from_ring(request, filename, lookup_start):
+    ring_sns = hash_ring.get_file_nodes(filename)
+    candidate_sns = [sn for sn in ring_sns if await is_healthy(sn)]
+    if not candidate_sns:
+        return None
+    if flask_utilities.is_read_cache_enabled():
+        # any version: names are never reused, and the metadata isn't looked up to tell
+        cached = read_cache.get_read_cache().get(filename)
+        if cached:
+            metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+            return send_cached(request, filename, *cached)
+    metrics.observe_stage('master_download_lookup', time.perf_counter() - lookup_start)
+    return await proxy_sn_download(request, filename, candidate_sns, ring_sns[0], fall_through_on_missing=True)
+
+"""
+Stream filename from the first of candidate_sns to answer with it, hedged with the next
+pnode tags the read cache entry the file may fill. If no node has the file, the
+answer of the last one is passed on; with fall_through_on_missing, a 404 is not
+passed on and None is returned instead.
+"""
+async def proxy_sn_download(request, filename, candidate_sns, pnode, fall_through_on_missing=False):
+    # pass byte ranges through so that partial reads move only the requested bytes
+    headers = {header: request.headers[header] for header in PROXIED_REQUEST_HEADERS
+                if header in request.headers}
+
+    async def send(sn_node):
+        payload = {
+            'filename': filename,
+            'token': flask_utilities.generate_transfer_token('download', sn_node, filename)
+        }
+        return await http_session.get(FILE_DOWNLOAD_ENDPOINT.format(node_ip=sn_node), params=payload,
+                                      headers=headers)
+
+    # until the headers of the SN's answer, hedges included
+    with metrics.stage_timer('master_download_first_byte'):
+        node, sn_resp = await hedged_reader.read_async(candidate_sns, send)
+    if fall_through_on_missing and sn_resp.status == 404:
+        sn_resp.release()
+        logger.debug(f"{filename} is not on its ring node {node}; looking it up.")
+        return None
+    body = stream_sn_response(sn_resp)
+    # only the original bytes of a whole file are cached
+    if master_core.is_cacheable_response(sn_resp.status, sn_resp.headers):
+        body = cache_on_read(
+            filename=filename,
+            pnode=pnode,
+            chunks=body,
+            size=int(sn_resp.headers['Content-Length']),
+            file_hash=sn_resp.headers['file_hash'],
+            hash_algorithm=sn_resp.headers.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        )
+    resp_headers = {header: sn_resp.headers[header] for header in PROXIED_RESPONSE_HEADERS
+                    if header in sn_resp.headers}
+    resp_headers['hash_algorithm'] = sn_resp.headers.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+    return StreamingResponse(body, status_code=sn_resp.status, headers=resp_headers)
+
+async def stream_sn_response(sn_resp):
+    start = time.perf_counter()
+    num_bytes = 0
+    try:
+        async for chunk in sn_resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+            num_bytes += len(chunk)
+            yield chunk
+        metrics.observe_stage('master_download_stream', time.perf_counter() - start, num_bytes)
+    finally:
+        # hands the connection back to the pool
+        sn_resp.release()
+
+"""
+Answer a GET from a read cache entry, honouring its Range header
+"""
+def send_cached(request, filename, entry, fp):
+    byte_range = master_core.get_byte_range(request.headers.get('Range'), entry.size)
+    if byte_range is None:
+        if fp is not None:
+            fp.close()
+        answer, status, headers = master_core.get_range_not_satisfiable(filename, entry.size)
+        return JSONResponse(answer, status_code=status, headers=headers)
+    start, stop = byte_range
+    status, headers = master_core.get_range_headers(entry.size, entry.file_hash, entry.hash_algorithm, start, stop)
+    if fp is None:
+        return Response(entry.data[start:stop], status_code=status, headers=headers)
+    return StreamingResponse(iter_cached_file(fp, start, stop), status_code=status, headers=headers)
+
+async def iter_cached_file(fp, start, stop):
+    try:
+        await run_sync(fp.seek, start)
+        remaining = stop - start
+        while remaining:
+            data = await run_sync(fp.read, min(STREAM_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+"""
+Chunks of a whole-file read, kept in the read cache on their way to the client
+"""
+async def cache_on_read(filename, pnode, chunks, size, file_hash, hash_algorithm):
+    cache_fill = None
+    if flask_utilities.is_read_cache_enabled():
+        cache_fill = read_cache.get_read_cache().begin_fill(filename, pnode, size, file_hash, hash_algorithm)
+    if cache_fill is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+    is_complete = False
+    try:
+        async for chunk in chunks:
+            cache_fill.add(chunk)
+            yield chunk
+        is_complete = True
+    finally:
+        cache_fill.finish(is_complete)
+
+"""
+Answer to HEAD /download from the metadata, without reading from an SN
+"""
+async def head_response(filename):
+    headers = await run_sync(master_core.get_head_headers, filename)
+    if headers is None:
+        return Response(status_code=404)
+    return Response(status_code=200, headers=headers)
+
+def range_not_satisfiable(filename, file_size):
+    answer, status, headers = master_core.get_range_not_satisfiable(filename, file_size)
+    return JSONResponse(answer, status_code=status, headers=headers)
+
+def select_healthy_sn(exclude_sns=None, num_bytes=0, filename=None):
+    return master_core.select_write_node(health_registry.get_node_loads(), exclude_sns, num_bytes, filename)
+
+async def is_healthy(sn):
+    if health_registry.get_state(sn) is None:
+        # a node not seen before is probed once on the request path
+        health_registry.record_probe_results([(sn, await probe_sn(sn))])
+    return health_registry.get_state(sn) == NODE_UP
+
+"""
+Healthy nodes holding a copy of filename, in the order to read from them
+Reads are spread across the primary and the replicas by their load.
+"""
+async def get_read_candidates(filename, pnode):
+    copy_nodes = await run_sync(master_core.get_copy_nodes, filename, pnode)
+    healthy_sns = [sn for sn in copy_nodes if await is_healthy(sn)]
+    return master_core.order_read_candidates(filename, pnode, healthy_sns, health_registry.get_node_loads())
+
+async def iter_upload_file(fp):
+    await fp.seek(0)
+    while True:
+        data = await fp.read(STREAM_CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+async def upload_to_sn(fp, filename, file_hash, hash_algorithm, file_size, file_encoding=None):
+    resp_code = 500
+    resp_msg = "Something went wrong while processing."
+    exclude_sns = []
+    for retry_count in range(MAX_RETRY_FILE_SAVE_TO_SN_COUNT):
+        with metrics.stage_timer('master_upload_select_sn'):
+            sn_node = select_healthy_sn(exclude_sns=exclude_sns, num_bytes=file_size, filename=filename)
+        logger.debug(f"Attempt {retry_count+1}: Trying to store {filename} to SN {sn_node}.")
+        data = aiohttp.FormData()
+        data.add_field('file_hash', file_hash)
+        data.add_field('hash_algorithm', hash_algorithm)
+        data.add_field('filename', filename)
+        if file_encoding:
+            data.add_field('file_encoding', file_encoding)
+        data.add_field('token', flask_utilities.generate_transfer_token('upload', sn_node, filename))
+        # the file is re-read from the start on every attempt
+        data.add_field('input_file', iter_upload_file(fp), filename=filename,
+                       content_type='application/octet-stream')
+        try:
+            with metrics.stage_timer('master_upload_sn_post'):
+                async with http_session.post(FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node), data=data) as resp:
+                    resp_code = resp.status
+                    resp_json = await resp.json()
+                    resp_msg = resp_json['message']
+                    resp_file_size = resp_json.get('file_size')
+            metrics.STAGE_BYTES.inc(file_size, stage='master_upload_sn_post')
+        except aiohttp.ClientConnectionError as e:
+            logger.error(f"Storing {filename} to SN {sn_node} failed: {str(e)}")
+            health_registry.record_failure(sn_node)
+            resp_code, resp_msg = 500, f"{MAX_RETRY_FILE_SAVE_TO_SN_COUNT} attempts to save file to SN failed."
+            exclude_sns.append(sn_node)
+            continue
+        if resp_code == 200:
+            logger.info(f"{filename} saved to {sn_node}")
+            with metrics.stage_timer('master_upload_metadata'):
+                await run_sync(master_core.record_upload, filename, sn_node, resp_file_size, file_hash,
+                               hash_algorithm)
+            break
+        exclude_sns.append(sn_node)
+    return resp_code, resp_msg
+
+def get_file_size(fileobj):
+    fileobj.seek(0, os.SEEK_END)
+    file_size = fileobj.tell()
+    fileobj.seek(0)
+    return file_size
+
+"""
+Store a file as Reed-Solomon fragments on distinct storage nodes, as master_app does
+"""
+async def upload_erasure_coded(fp, filename, file_hash, hash_algorithm, file_size):
+    codec, stripe_unit, fragment_size, nodes, spare_nodes = master_core.plan_erasure_coding(
+        health_registry.get_node_loads(), file_size)
+
+    async def store_fragment(fragment_index, fragment_file, fragment_hash):
+        fragment_name = flask_utilities.get_fragment_name(filename, fragment_index)
+        sn_node = nodes[fragment_index]
+        while not await upload_fragment(fragment_name, fragment_file, fragment_hash, hash_algorithm, sn_node):
+            if not spare_nodes:
+                raise Exception(f"No storage node left to store fragment {fragment_name}.")
+            sn_node = spare_nodes.pop(0)
+        return master_core.get_fragment_record(fragment_index, fragment_name, sn_node, fragment_size, fragment_hash)
+
+    with ExitStack() as stack:
+        fragment_files = [stack.enter_context(tempfile.TemporaryFile()) for _ in range(codec.total_fragments)]
+        await fp.seek(0)
+        with metrics.stage_timer('master_ec_encode'):
+            encoded_file_hash, fragment_hashes = await run_sync(
+                flask_utilities.write_erasure_coded_fragments, fp.file, codec, stripe_unit, fragment_files,
+                hash_algorithm)
+        if encoded_file_hash != file_hash:
+            raise Exception("File integrity check failed!")
+        tasks = [
+            asyncio.ensure_future(store_fragment(fragment_index, fragment_file, fragment_hash))
+            for fragment_index, (fragment_file, fragment_hash) in enumerate(zip(fragment_files, fragment_hashes))
+        ]
+        try:
+            fragments = await asyncio.gather(*tasks)
+            return 200, await run_sync(master_core.record_erasure_coded_upload, filename, file_size, file_hash,
+                                       hash_algorithm, codec, stripe_unit, fragments)
+        except Exception:
+            # wait for the fragments still in flight; the ones stored would never be referenced
+            await asyncio.wait(tasks)
+            await delete_stored_copies([(fragment['fragment_name'], fragment['node']) for fragment in
+                                        (task.result() for task in tasks if not task.exception())])
+            raise
+
+async def iter_fragment_file(fragment_file):
+    await run_sync(fragment_file.seek, 0)
+    while True:
+        data = await run_sync(fragment_file.read, STREAM_CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+
+async def upload_fragment(fragment_name, fragment_file, fragment_hash, hash_algorithm, sn_node):
+    payload = aiohttp.FormData()
+    payload.add_field('file_hash', fragment_hash)
+    payload.add_field('hash_algorithm', hash_algorithm)
+    payload.add_field('filename', fragment_name)
+    payload.add_field('token', flask_utilities.generate_transfer_token('upload', sn_node, fragment_name))
+    payload.add_field('replicate', 'false')
+    payload.add_field('input_file', iter_fragment_file(fragment_file), filename=fragment_name,
+                      content_type='application/octet-stream')
+    try:
+        async with http_session.post(FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node), data=payload) as resp:
+            if resp.status == 200:
+                return True
+            logger.error(f"Storing fragment {fragment_name} to SN {sn_node} failed: {resp.status}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Storing fragment {fragment_name} to SN {sn_node} failed: {str(e)}")
+        health_registry.record_failure(sn_node)
+    return False
+
+"""
+Stream an erasure-coded file, or the requested range of it, as master_app does
+"""
+async def download_erasure_coded(request, filename, ec_file, pnode=None):
+    file_size = ec_file['file_size']
+    stripe_unit = ec_file['stripe_unit']
+    byte_range = master_core.get_byte_range(request.headers.get('Range'), file_size)
+    if byte_range is None:
+        return range_not_satisfiable(filename, file_size)
+    start, stop = byte_range
+    codec, stripe_size, first_stripe, end_stripe = master_core.get_stripe_span(ec_file, start, stop)
+    fragments = await run_sync(metadata_store.get_file_fragments, filename)
+    with metrics.stage_timer('master_download_first_byte'):
+        streams = await open_fragment_streams(fragments, codec.data_fragments,
+                                              first_stripe * stripe_unit, end_stripe * stripe_unit)
+    if any(fragment_index >= codec.data_fragments for fragment_index in streams):
+        logger.warning(f"Degraded read of {filename} from fragments {sorted(streams)}")
+
+    async def generate():
+        try:
+            for stripe_index in range(first_stripe, end_stripe):
+                units = dict(zip(streams, await asyncio.gather(
+                    *(resp.content.readexactly(stripe_unit) for resp in streams.values()))))
+                if all(i in units for i in range(codec.data_fragments)):
+                    stripe = b"".join(units[i] for i in range(codec.data_fragments))
+                else:
+                    # decoding is CPU bound; keep it off the loop
+                    stripe = b"".join(await run_sync(codec.decode, units))
+                yield master_core.slice_stripe(stripe, stripe_index, stripe_size, start, stop)
+        finally:
+            for resp in streams.values():
+                resp.release()
+
+    status, headers = master_core.get_range_headers(file_size, ec_file['file_hash'], ec_file['hash_algorithm'],
+                                                    start, stop)
+    body = generate()
+    if status == 200 and pnode:
+        body = cache_on_read(filename, pnode, body, file_size, ec_file['file_hash'], ec_file['hash_algorithm'])
+    return StreamingResponse(body, status_code=status, headers=headers)
+
+"""
+Open streaming reads of bytes [start, stop) of num_needed fragments concurrently, as master_app does
+"""
+async def open_fragment_streams(fragments, num_needed, start, stop):
+    headers = {'Range': f"bytes={start}-{stop - 1}"}
+    pending = list(fragments)
+    streams = {}
+    while len(streams) < num_needed:
+        batch = pending[:num_needed - len(streams)]
+        del pending[:len(batch)]
+        if len(batch) < num_needed - len(streams):
+            for resp in streams.values():
+                resp.release()
+            raise Exception(f"Only {len(streams) + len(batch)} fragments readable, {num_needed} needed.")
+        responses = await asyncio.gather(*(open_fragment_stream(fragment, headers) for fragment in batch))
+        for fragment, resp in zip(batch, responses):
+            if resp is not None:
+                streams[fragment['fragment_index']] = resp
+    return streams
+
+async def open_fragment_stream(fragment, headers):
+    fragment_name, sn_node = fragment['fragment_name'], fragment['node']
+    if not await is_healthy(sn_node):
+        return None
+    payload = {
+        'filename': fragment_name,
+        'token': flask_utilities.generate_transfer_token('download', sn_node, fragment_name)
+    }
+    try:
+        resp = await http_session.get(FILE_DOWNLOAD_ENDPOINT.format(node_ip=sn_node), params=payload, headers=headers)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Reading fragment {fragment_name} from SN {sn_node} failed: {str(e)}")
+        health_registry.record_failure(sn_node)
+        return None
+    if resp.status not in (200, 206):
+        logger.error(f"Reading fragment {fragment_name} from SN {sn_node} failed: {resp.status}")
+        resp.release()
+        return None
+    return resp
+
+async def upload_in_blocks(fp, filename, file_hash, hash_algorithm):
+    block_size = flask_utilities.get_block_size()
+    max_parallel = flask_utilities.get_max_parallel_transfers()
+    block_nodes = master_core.get_block_nodes(health_registry.get_node_loads(), num_bytes=block_size)
+    # start from a random node so that the first block of every file doesn't land on the same SN
+    first_sn_idx = random.randrange(len(block_nodes))
+    file_hasher = flask_utilities.new_hasher(hash_algorithm)
+    file_size = 0
+    tasks = []
+
+    try:
+        await fp.seek(0)
+        block_index = 0
+        while True:
+            data = await fp.read(block_size)
+            if not data:
+                break
+            await run_sync(file_hasher.update, data)
+            file_size += len(data)
+            # don't hold more than max_parallel blocks in memory at once
+            pending = [task for task in tasks if not task.done()]
+            if len(pending) >= max_parallel:
+                await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            block_name = flask_utilities.get_block_name(filename, block_index)
+            candidate_sns = master_core.get_block_candidates(block_nodes, first_sn_idx, block_index)
+            tasks.append(asyncio.ensure_future(upload_block(block_index, block_name, data, hash_algorithm,
+                                                            candidate_sns)))
+            block_index += 1
+        blocks = await asyncio.gather(*tasks)
+
+        if file_hasher.hexdigest() != file_hash:
+            raise Exception("File integrity check failed!")
+
+        return 200, await run_sync(master_core.record_chunked_upload, filename, file_size, file_hash, hash_algorithm,
+                                   block_size, blocks)
+    except Exception:
+        # wait for the blocks still in flight; the ones stored would never be referenced
+        if tasks:
+            await asyncio.wait(tasks)
+        await delete_stored_copies([(block['block_name'], block['node'])
+                                    for block in (task.result() for task in tasks if not task.exception())])
+        raise
+
+async def upload_block(block_index, block_name, data, hash_algorithm, candidate_sns):
+    block_hash = await run_sync(flask_utilities.calc_bytes_hash, data, hash_algorithm)
+    for count, sn_node in enumerate(candidate_sns[:MAX_RETRY_FILE_SAVE_TO_SN_COUNT]):
+        logger.debug(f"Attempt {count+1}: Trying to store block {block_name} to SN {sn_node}.")
+        payload = aiohttp.FormData()
+        payload.add_field('file_hash', block_hash)
+        payload.add_field('hash_algorithm', hash_algorithm)
+        payload.add_field('filename', block_name)
+        payload.add_field('token', flask_utilities.generate_transfer_token('upload', sn_node, block_name))
+        payload.add_field('input_file', data, filename=block_name, content_type='application/octet-stream')
+        try:
+            async with http_session.post(FILE_UPLOAD_ENDPOINT.format(node_ip=sn_node), data=payload) as resp:
+                if resp.status == 200:
+                    return master_core.get_block_record(block_index, block_name, sn_node, len(data), block_hash)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Storing block {block_name} to SN {sn_node} failed: {str(e)}")
+            health_registry.record_failure(sn_node)
+    raise Exception(f"{MAX_RETRY_FILE_SAVE_TO_SN_COUNT} attempts to save block {block_name} to SN failed.")
+
+"""
+Delete the (name, node) copies of a deleted file, or an upload stored before it failed, as master_app does
+"""
+async def delete_stored_copies(copies):
+    async def delete_copy(name, sn_node):
+        params = {
+            'filename': name,
+            'token': flask_utilities.generate_transfer_token('delete', sn_node, name)
+        }
+        try:
+            async with http_session.delete(FILE_DELETE_ENDPOINT.format(node_ip=sn_node), params=params) as resp:
+                if resp.status not in (200, 404):
+                    logger.error(f"Deleting {name} from SN {sn_node} failed: {resp.status}")
+                    return
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Deleting {name} from SN {sn_node} failed: {str(e)}")
+            return
+        logger.info(f"Deleted {name} from SN {sn_node}.")
+
+    await asyncio.gather(*(delete_copy(name, sn_node) for name, sn_node in copies))
+
+async def download_in_blocks(request, filename, chunked_file, pnode=None):
+    max_parallel = flask_utilities.get_max_parallel_transfers()
+    blocks = await run_sync(metadata_store.get_file_blocks, filename)
+    hash_algorithm = chunked_file['hash_algorithm']
+    file_size = chunked_file['file_size']
+
+    # only the blocks overlapping the requested range are fetched
+    byte_range = master_core.get_byte_range(request.headers.get('Range'), file_size)
+    if byte_range is None:
+        return range_not_satisfiable(filename, file_size)
+    start, stop = byte_range
+
+    block_slices = flask_utilities.get_block_slices(blocks, start, stop)
+
+    async def generate():
+        # keep up to max_parallel blocks in flight, but yield them in order
+        pending_slices = iter(block_slices)
+        tasks = deque(
+            (asyncio.ensure_future(fetch_block(block, hash_algorithm)), slice_start, slice_stop)
+            for block, slice_start, slice_stop in islice(pending_slices, max_parallel)
+        )
+        try:
+            while tasks:
+                task, slice_start, slice_stop = tasks.popleft()
+                data = await task
+                next_slice = next(pending_slices, None)
+                if next_slice:
+                    block, next_start, next_stop = next_slice
+                    tasks.append((asyncio.ensure_future(fetch_block(block, hash_algorithm)), next_start, next_stop))
+                yield data[slice_start:slice_stop]
+        finally:
+            for task, _, _ in tasks:
+                task.cancel()
+
+    status, headers = master_core.get_range_headers(file_size, chunked_file['file_hash'], hash_algorithm, start, stop)
+    body = generate()
+    if status == 200 and pnode:
+        body = cache_on_read(filename, pnode, body, file_size, chunked_file['file_hash'], hash_algorithm)
+    return StreamingResponse(body, status_code=status, headers=headers)
+
+async def fetch_block(block, hash_algorithm):
+    block_name = block['block_name']
+    candidate_sns = await get_read_candidates(block_name, block['node'])
+    for count, sn_node in enumerate(candidate_sns):
+        logger.debug(f"Attempt {count+1}: Trying to retrieve block {block_name} from SN {sn_node}.")
+        payload = {
+            'filename': block_name,
+            'token': flask_utilities.generate_transfer_token('download', sn_node, block_name)
+        }
+        try:
+            async with http_session.get(FILE_DOWNLOAD_ENDPOINT.format(node_ip=sn_node), params=payload) as resp:
+                if resp.status != 200:
+                    continue
+                data = await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Retrieving block {block_name} from SN {sn_node} failed: {str(e)}")
+            health_registry.record_failure(sn_node)
+            continue
+        if await run_sync(flask_utilities.calc_bytes_hash, data, hash_algorithm) == block['block_hash']:
+            return data
+        logger.error(f"Block {block_name} on SN {sn_node} failed integrity check.")
+    raise Exception(f"No healthy SN containing block {block_name} found!")
+
+
+async def probe_sn(sn):
+    timeout = aiohttp.ClientTimeout(total=flask_utilities.get_health_check_timeout())
+    try:
+        async with http_session.get(flask_utilities.HEALTH_CHECK_ENDPOINT.format(node_ip=sn), timeout=timeout) as resp:
+            if resp.status == 200:
+                return await resp.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        pass
+    return None
+
+async def run_heartbeat_round(force=False):
+    due_nodes = health_registry.get_due_nodes(force)
+    results = await asyncio.gather(*(probe_sn(sn) for sn in due_nodes))
+    health_registry.record_probe_results(zip(due_nodes, results))
+
+async def heartbeat_loop():
+    while True:
+        await asyncio.sleep(flask_utilities.get_heartbeat_interval())
+        try:
+            await run_heartbeat_round()
+        except Exception as e:
+            logger.error(f"Heartbeat round failed: {str(e)}")
+
+async def pending_upload_reaper():
+    while True:
+        await asyncio.sleep(master_core.PENDING_UPLOAD_REAP_INTERVAL)
+        try:
+            await run_sync(master_core.release_expired_reservations)
+        except Exception as e:
+            logger.error(f"Releasing expired reservations failed: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app):
+    global http_session
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=flask_utilities.get_http_max_connections_per_node())
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=flask_utilities.get_http_connect_timeout(),
+        sock_read=flask_utilities.get_http_read_timeout()
+    )
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(add_trace_id_header)
+    http_session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config])
+    # populate the registry before the first request looks at it
+    await run_heartbeat_round(force=True)
+    heartbeat_task = asyncio.ensure_future(heartbeat_loop())
+    reaper_task = asyncio.ensure_future(pending_upload_reaper())
+    try:
+        yield
+    finally:
+        heartbeat_task.cancel()
+        reaper_task.cancel()
+        await http_session.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/test', test),
+        Route('/sn_health', sn_health, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/stats', stats, methods=['GET']),
+        Route('/upload', upload, methods=['POST']),
+        Route('/download', download, methods=['GET', 'HEAD']),
+        Route('/stat', stat, methods=['GET']),
+        Route('/list', list_files, methods=['GET']),
+        Route('/delete', delete, methods=['DELETE']),
+    ],
+    middleware=[Middleware(BaseHTTPMiddleware, dispatch=observe_request)],
+    lifespan=lifespan
+)
+flask_utilities.install_config_reload_handler()
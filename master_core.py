@@ -0,0 +1,389 @@
+"""
+Placement and metadata decisions of the master
+
+master_app (Flask, a thread per request) and master_async_app (asyncio) both
+call these and only move the bytes to and from the storage nodes
+themselves, so the two masters place, record and serve files the same way.
+Nothing here talks to a storage node; health comes in as node_loads, the
+loads of the healthy nodes as the health registry reports them.
+"""
+import logging
+import os
+import time
+
+import erasure_coding
+import flask_utilities
+import metadata_store
+import metrics
+import placement
+import read_cache
+from werkzeug.http import http_date, parse_range_header
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+# seconds between two passes releasing the expired reservations
+PENDING_UPLOAD_REAP_INTERVAL = 60
+
+# read from the hedged reader and the read cache when /metrics is scraped
+HEDGED_READS = metrics.Gauge('dfs_hedged_reads_total', "Reads, hedges fired and hedges won.", 'counter')
+READ_CACHE_EVENTS = metrics.Gauge('dfs_read_cache_events_total',
+                                  "Hits, misses, fills, evictions and invalidations of the read cache.", 'counter')
+READ_CACHE_BYTES = metrics.Gauge('dfs_read_cache_bytes', "Bytes held by each tier of the read cache.")
+
+
+def invalidate_read_cache(filenames):
+    read_cache.get_read_cache().invalidate(filenames)
+
+metadata_store.add_change_listener(invalidate_read_cache)
+
+"""
+/stats of the reads: the hedged reader's and the read cache's
+"""
+def get_read_stats(hedged_reader):
+    return {
+        'hedged_reads': hedged_reader.get_stats(),
+        'read_cache': read_cache.get_read_cache().get_stats()
+    }
+
+def update_read_gauges(hedged_reader):
+    hedged_stats = hedged_reader.get_stats()
+    for counter in ('reads', 'hedges_fired', 'hedges_won'):
+        HEDGED_READS.set(hedged_stats[counter], outcome=counter)
+    cache_stats = read_cache.get_read_cache().get_stats()
+    READ_CACHE_EVENTS.set(cache_stats['misses'], event='misses')
+    READ_CACHE_EVENTS.set(cache_stats['invalidations'], event='invalidations')
+    for tier in read_cache.TIERS:
+        for event in ('hits', 'fills', 'evictions'):
+            READ_CACHE_EVENTS.set(cache_stats[event][tier], event=event, tier=tier)
+        READ_CACHE_BYTES.set(cache_stats['bytes'][tier], tier=tier)
+
+
+def add_content_reference(filename, hash_algorithm, file_hash):
+    if not flask_utilities.is_dedup_enabled():
+        return None
+    deduplicated_filename = metadata_store.add_content_reference(filename, hash_algorithm, file_hash)
+    if deduplicated_filename:
+        logger.info(f"{deduplicated_filename} deduplicated; content {hash_algorithm}:{file_hash} already stored.")
+    return deduplicated_filename
+
+def register_content(hash_algorithm, file_hash, filename):
+    if flask_utilities.is_dedup_enabled():
+        metadata_store.register_content(hash_algorithm, file_hash, filename)
+
+def get_deduplicated_answer(filename):
+    return {
+        'message': f"File {filename} saved successfully (deduplicated).",
+        'filename': filename,
+        'deduplicated': True
+    }
+
+
+"""
+Node to store num_bytes of filename on
+"""
+def select_write_node(node_loads, exclude_sns=None, num_bytes=0, filename=None):
+    node_loads = dict(node_loads)
+    for sn in exclude_sns or []:
+        node_loads.pop(sn, None)
+    if not node_loads:
+        raise Exception("No available storage nodes.")
+    selected_sn = placement.choose_write_node(node_loads, num_bytes, key=filename)
+    if not selected_sn:
+        raise Exception(f"No storage node has {num_bytes} bytes of free space.")
+    logger.debug(f"Selected {selected_sn} out of healthy SNs {list(node_loads)}.")
+    return selected_sn
+
+"""
+Nodes the blocks of a file are spread over, each with room for num_bytes
+"""
+def get_block_nodes(node_loads, num_bytes=0):
+    if not node_loads:
+        raise Exception("No available storage nodes.")
+    # keep the config order so that block placement is stable
+    block_nodes = [sn for sn in flask_utilities.get_all_storage_nodes()
+                   if sn in node_loads and placement.has_free_space(node_loads[sn], num_bytes)]
+    if not block_nodes:
+        raise Exception(f"No storage node has {num_bytes} bytes of free space.")
+    return block_nodes
+
+"""
+Nodes to try for block block_index, in order
+The blocks go round-robin over block_nodes from first_node_index; the next
+nodes are the fallbacks.
+"""
+def get_block_candidates(block_nodes, first_node_index, block_index):
+    sn_idx = (first_node_index + block_index) % len(block_nodes)
+    return block_nodes[sn_idx:] + block_nodes[:sn_idx]
+
+def should_store_in_blocks(file_size):
+    if not flask_utilities.is_chunking_enabled():
+        return False
+    return file_size > 0 and file_size >= flask_utilities.get_chunking_min_file_size()
+
+def should_erasure_code(file_size):
+    if not flask_utilities.is_erasure_coding_enabled():
+        return False
+    return file_size > 0 and file_size >= flask_utilities.get_ec_min_file_size()
+
+"""
+Whether an upload of content_length bytes can be passed on as it arrives
+The multipart body is a little larger than the file, so an upload which may
+have to be split into blocks or fragments is spooled as before.
+"""
+def can_stream_upload(content_length):
+    if content_length is None:
+        return False
+    return not should_erasure_code(content_length) and not should_store_in_blocks(content_length)
+
+"""
+Code and nodes of a file of file_size bytes to be erasure coded
+Returns (codec, stripe_unit, fragment_size, nodes, spare_nodes): fragment i
+goes to nodes[i], and a node failing its fragment is replaced by the next of
+spare_nodes.
+"""
+def plan_erasure_coding(node_loads, file_size):
+    codec = erasure_coding.ReedSolomon(flask_utilities.get_ec_data_fragments(),
+                                       flask_utilities.get_ec_parity_fragments())
+    stripe_unit = flask_utilities.get_ec_stripe_unit()
+    fragment_size = -(-file_size // (codec.data_fragments * stripe_unit)) * stripe_unit
+    nodes = placement.choose_replica_nodes(node_loads, len(node_loads), num_bytes=fragment_size)
+    if len(nodes) < codec.total_fragments:
+        raise Exception(f"Erasure coding needs {codec.total_fragments} storage nodes with room for "
+                        f"{fragment_size} bytes, {len(nodes)} available.")
+    return codec, stripe_unit, fragment_size, nodes[:codec.total_fragments], nodes[codec.total_fragments:]
+
+def get_block_record(block_index, block_name, sn_node, block_size, block_hash):
+    return {
+        'block_index': block_index,
+        'block_name': block_name,
+        'node': sn_node,
+        'block_size': block_size,
+        'block_hash': block_hash
+    }
+
+def get_fragment_record(fragment_index, fragment_name, sn_node, fragment_size, fragment_hash):
+    return {
+        'fragment_index': fragment_index,
+        'fragment_name': fragment_name,
+        'node': sn_node,
+        'fragment_size': fragment_size,
+        'fragment_hash': fragment_hash
+    }
+
+
+"""
+Why a direct upload of filename to sn_node can't be committed, or None
+checksum is what the SN's /stat reports of the file (None if it doesn't hold
+it); the size and hash the commit claims, if given, must match it.
+"""
+def check_committed_upload(filename, sn_node, checksum, file_size, file_hash, hash_algorithm):
+    if checksum is None:
+        return f"{filename} is not stored on SN {sn_node}."
+    if file_size is not None and checksum['file_size'] != file_size:
+        return f"{filename} is {checksum['file_size']} bytes on SN {sn_node}, not {file_size}."
+    if file_hash and (checksum['hash_algorithm'] != hash_algorithm or checksum['file_hash'] != file_hash):
+        return f"The {hash_algorithm} hash of {filename} on SN {sn_node} doesn't match the commit."
+    return None
+
+"""
+Release the names reserved longer than pending_upload_ttl ago
+"""
+def release_expired_reservations():
+    released = metadata_store.release_expired_filenames(time.time() - flask_utilities.get_pending_upload_ttl())
+    if released:
+        logger.info(f"Released {len(released)} names whose upload never finished: {released}")
+    return released
+
+"""
+Record filename as stored whole on sn_node
+"""
+def record_upload(filename, sn_node, file_size, file_hash, hash_algorithm):
+    metadata_store.update_master_table(
+        filename=filename,
+        primary_node=sn_node,
+        file_size=file_size,
+        file_hash=file_hash,
+        hash_algorithm=hash_algorithm
+    )
+    # a direct upload's commit may not carry the hash
+    if file_hash:
+        register_content(hash_algorithm, file_hash, filename)
+
+def record_chunked_upload(filename, file_size, file_hash, hash_algorithm, block_size, blocks):
+    logger.debug(f"Updating block tables for {filename}: {len(blocks)} blocks")
+    metadata_store.update_chunked_file_tables(
+        filename=filename,
+        file_size=file_size,
+        file_hash=file_hash,
+        hash_algorithm=hash_algorithm,
+        block_size=block_size,
+        blocks=blocks
+    )
+    register_content(hash_algorithm, file_hash, filename)
+    logger.info(f"{filename} saved as {len(blocks)} blocks across {len({b['node'] for b in blocks})} SNs")
+    return f"File {filename} saved successfully in {len(blocks)} blocks."
+
+def record_erasure_coded_upload(filename, file_size, file_hash, hash_algorithm, codec, stripe_unit, fragments):
+    logger.debug(f"Updating fragment tables for {filename}: {len(fragments)} fragments")
+    metadata_store.update_erasure_coded_file_tables(
+        filename=filename,
+        file_size=file_size,
+        file_hash=file_hash,
+        hash_algorithm=hash_algorithm,
+        data_fragments=codec.data_fragments,
+        parity_fragments=codec.parity_fragments,
+        stripe_unit=stripe_unit,
+        fragments=fragments
+    )
+    register_content(hash_algorithm, file_hash, filename)
+    logger.info(f"{filename} saved as {codec.data_fragments}+{codec.parity_fragments} erasure-coded fragments")
+    return (f"File {filename} saved successfully in {codec.data_fragments}+{codec.parity_fragments} "
+            f"erasure-coded fragments.")
+
+
+"""
+Metadata a GET of filename is served from
+Returns None if it doesn't exist, else a dict with the name its content is
+stored under (a deduplicated name reads the file it references), its
+primary node and its chunked_file or ec_file (None unless it is stored so).
+"""
+def lookup_download(filename):
+    filename = metadata_store.resolve_filename(os.path.basename(filename))
+    pnode = metadata_store.return_pnode_of_file(filename)
+    if not pnode:
+        return None
+    # blocks and fragments carry their own locations
+    chunked_file = metadata_store.get_chunked_file(filename)
+    ec_file = None if chunked_file else metadata_store.get_erasure_coded_file(filename)
+    return {'filename': filename, 'pnode': pnode, 'chunked_file': chunked_file, 'ec_file': ec_file}
+
+"""
+Nodes holding a copy of filename: its primary node, then the replicas
+"""
+def get_copy_nodes(filename, pnode):
+    return [pnode] + [sn for sn in metadata_store.get_sns_with_file_copy(filename) if sn != pnode]
+
+"""
+The healthy ones of the nodes holding filename, in the order to read from them
+Reads are spread across the primary and the replicas by their load.
+"""
+def order_read_candidates(filename, pnode, healthy_sns, node_loads):
+    if pnode not in healthy_sns:
+        logger.error(f"Primary node {pnode} unhealthy. Trying to retrieve {filename} from replicated copies.")
+    return placement.order_read_nodes(healthy_sns, node_loads)
+
+"""
+Metadata record of filename with where its content is stored, or None
+"""
+def get_file_stat(filename):
+    file_stat = metadata_store.get_file_record(filename)
+    if file_stat is None:
+        return None
+    target = metadata_store.resolve_filename(filename)
+    if target != filename:
+        # a deduplicated name is stored on the nodes of its target
+        file_stat['alias_of'] = target
+    if metadata_store.get_chunked_file(target):
+        file_stat['storage'] = 'blocks'
+        file_stat['blocks'] = metadata_store.get_file_blocks(target)
+        for block in file_stat['blocks']:
+            block['replica_nodes'] = metadata_store.get_sns_with_file_copy(block['block_name'])
+    elif metadata_store.get_erasure_coded_file(target):
+        file_stat['storage'] = 'erasure_coded'
+        file_stat['fragments'] = metadata_store.get_file_fragments(target)
+    else:
+        file_stat['storage'] = 'file'
+        file_stat['replica_nodes'] = metadata_store.get_sns_with_file_copy(target)
+    return file_stat
+
+"""
+Headers of the answer to HEAD /download of filename, from the metadata
+without reading from an SN; None if it doesn't exist
+"""
+def get_head_headers(filename):
+    record = metadata_store.get_file_record(filename)
+    if record is None:
+        return None
+    headers = {'Content-Type': 'application/octet-stream'}
+    if record['file_size'] is not None:
+        headers['Content-Length'] = str(record['file_size'])
+    if record['file_hash']:
+        headers['file_hash'] = record['file_hash']
+        headers['hash_algorithm'] = record['hash_algorithm']
+    if record['created_at'] is not None:
+        headers['Last-Modified'] = http_date(record['created_at'])
+    return headers
+
+"""
+A page of the records of the files whose names start with prefix, in name order
+A page holds up to limit files after start_after; next_start_after is the
+start_after of the next page, None after the last.
+"""
+def list_files(prefix='', start_after='', limit=None):
+    limit = max(1, min(limit or DEFAULT_LIST_LIMIT, MAX_LIST_LIMIT))
+    records = metadata_store.list_file_records(prefix=prefix, start_after=start_after, limit=limit)
+    return {
+        'files': records,
+        'next_start_after': records[-1]['filename'] if len(records) == limit else None
+    }
+
+
+"""
+Bytes [start, stop) of a file of file_size bytes a Range header asks for
+The whole file without a single range; None if the range is not satisfiable.
+"""
+def get_byte_range(range_header, file_size):
+    byte_range = parse_range_header(range_header)
+    if byte_range and len(byte_range.ranges) == 1:
+        return byte_range.range_for_length(file_size)
+    return 0, file_size
+
+"""
+Answer, status and headers of a GET whose range is not satisfiable
+"""
+def get_range_not_satisfiable(filename, file_size):
+    return ({'message': f"Requested range not satisfiable for {filename}."}, 416,
+            {'Content-Range': f"bytes */{file_size}"})
+
+"""
+Status and headers of bytes [start, stop) of a file the master assembles
+(from blocks, fragments or its read cache)
+"""
+def get_range_headers(file_size, file_hash, hash_algorithm, start, stop):
+    headers = {
+        'Content-Length': str(stop - start),
+        'Content-Type': 'application/octet-stream',
+        'Accept-Ranges': 'bytes',
+        'file_hash': file_hash,
+        'hash_algorithm': hash_algorithm
+    }
+    if (start, stop) == (0, file_size):
+        return 200, headers
+    headers['Content-Range'] = f"bytes {start}-{stop - 1}/{file_size}"
+    return 206, headers
+
+"""
+Stripes of an erasure-coded file holding bytes [start, stop)
+Returns (codec, stripe_size, first_stripe, end_stripe).
+"""
+def get_stripe_span(ec_file, start, stop):
+    codec = erasure_coding.ReedSolomon(ec_file['data_fragments'], ec_file['parity_fragments'])
+    stripe_size = codec.data_fragments * ec_file['stripe_unit']
+    return codec, stripe_size, start // stripe_size, -(-stop // stripe_size)
+
+"""
+The part of stripe stripe_index which falls in bytes [start, stop)
+"""
+def slice_stripe(stripe, stripe_index, stripe_size, start, stop):
+    stripe_start = stripe_index * stripe_size
+    return stripe[max(start - stripe_start, 0):min(stop - stripe_start, stripe_size)]
+
+"""
+Whether an SN's answer to a GET is the whole original file, which the read
+cache may keep
+"""
+def is_cacheable_response(status, headers):
+    return status == 200 and flask_utilities.FILE_ENCODING_HEADER not in headers \
+        and 'file_hash' in headers and 'Content-Length' in headers
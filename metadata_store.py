@@ -0,0 +1,763 @@
+import heapq
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+import flask_utilities
+import hash_ring
+import metrics
+
+SQLITE_BUSY_TIMEOUT_MS = 5000
+PENDING_PRIMARY_NODE = ''
+# primary node of a deduplicated name; its content is stored under the name
+# content_index gives for the hash in file_aliases
+ALIAS_PRIMARY_NODE = 'alias'
+COPY_PRIMARY = 'primary'
+COPY_REPLICA = 'replica'
+COPY_BLOCK = 'block'
+COPY_FRAGMENT = 'fragment'
+COPY_KINDS = (COPY_PRIMARY, COPY_REPLICA, COPY_BLOCK, COPY_FRAGMENT)
+SHARD_VIRTUAL_NODES = 128
+# names of the blocks and fragments stored for a file (see flask_utilities.BLOCK_NAME_FORMAT)
+PART_NAME_PATTERN = re.compile(r'^(.*)\.(?:blk\d{5}|frag\d{3})$')
+# tables with a row or rows per filename, moved together between shards
+FILENAME_TABLES = ('master_node', 'replication_data', 'chunked_files', 'file_blocks',
+                   'erasure_coded_files', 'file_fragments', 'file_aliases')
+FILE_RECORD_COLUMNS = ('filename', 'primary_node', 'file_size', 'file_hash', 'hash_algorithm', 'created_at')
+# (filename, primary_node, file_size, file_hash, hash_algorithm, created_at) of a stored file;
+# what isn't known (None) is left as it was, and a reserved name is stored as of now
+UPSERT_FILE_SQL = f"""
+    INSERT INTO master_node (filename, primary_node, file_size, file_hash, hash_algorithm, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(filename) DO UPDATE SET
+        primary_node=excluded.primary_node,
+        file_size=COALESCE(excluded.file_size, master_node.file_size),
+        file_hash=COALESCE(excluded.file_hash, master_node.file_hash),
+        hash_algorithm=COALESCE(excluded.hash_algorithm, master_node.hash_algorithm),
+        created_at=CASE WHEN master_node.primary_node = '{PENDING_PRIMARY_NODE}'
+                   THEN excluded.created_at ELSE master_node.created_at END;
+"""
+
+_local = threading.local()
+_change_listeners = []
+
+
+"""
+Connection of the current thread to a metadata shard ([default] database if None)
+Connections are opened once per thread and reused; sqlite3 keeps the
+parameterized statements of a connection prepared in its statement cache.
+"""
+def get_connection(shard=None):
+    if shard is None:
+        shard = flask_utilities.get_metadata_shards()[0]
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(shard)
+    if conn is None:
+        # autocommit mode; transactions are started explicitly where needed
+        conn = sqlite3.connect(shard, isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS};")
+        conns[shard] = conn
+    return conn
+
+"""
+BEGIN IMMEDIATE ... COMMIT on the thread's connection to shard, ROLLBACK on error
+The write lock is taken up front so that a check-then-write can't interleave
+with another writer.
+"""
+@contextmanager
+def transaction(shard=None):
+    conn = get_connection(shard)
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK;")
+        raise
+    conn.execute("COMMIT;")
+
+"""
+transaction() on each of shards at once, yielding {shard: connection}
+The shards are locked in name order, so that two callers can't deadlock.
+"""
+@contextmanager
+def transactions(shards):
+    with ExitStack() as stack:
+        yield {shard: stack.enter_context(transaction(shard)) for shard in sorted(set(shards))}
+
+
+"""
+Shard holding the rows of key: a filename, or a content key
+The shards sit on a consistent-hash ring, so adding one to N shards moves
+only ~1/N of the keys (see reshard.py). Every master computes the same shard,
+so any of them can serve any request.
+"""
+def get_shard(key, shards=None):
+    if shards is None:
+        shards = flask_utilities.get_metadata_shards()
+    if len(shards) == 1:
+        return shards[0]
+    return hash_ring.get_ring(tuple(shards), SHARD_VIRTUAL_NODES).get_nodes(key, 1)[0]
+
+"""
+Shards to look key up in: its shard, and while the rows are being moved to a
+grown shard list, its shard under the previous list
+"""
+def get_lookup_shards(key):
+    shards = [get_shard(key)]
+    previous_shards = flask_utilities.get_metadata_previous_shards()
+    if previous_shards:
+        previous_shard = get_shard(key, previous_shards)
+        if previous_shard != shards[0]:
+            shards.append(previous_shard)
+    return shards
+
+def get_all_shards():
+    shards = flask_utilities.get_metadata_shards()
+    return shards + [shard for shard in flask_utilities.get_metadata_previous_shards() if shard not in shards]
+
+def get_content_key(hash_algorithm, file_hash):
+    return f"{hash_algorithm}:{file_hash}"
+
+"""
+Filename whose shard holds the rows of the object stored as name: the file
+a block or fragment belongs to, or name itself
+"""
+def get_owner_filename(name, kind=COPY_PRIMARY):
+    if kind in (COPY_BLOCK, COPY_FRAGMENT):
+        match = PART_NAME_PATTERN.match(name)
+        if not match:
+            raise ValueError(f"{name} is not the name of a {kind}.")
+        return match.group(1)
+    return name
+
+def _group_by_shard(records, get_key):
+    groups = defaultdict(list)
+    for record in records:
+        groups[get_shard(get_key(record))].append(record)
+    return groups.items()
+
+def _fetch_first(key, sql, params):
+    for shard in get_lookup_shards(key):
+        data = get_connection(shard).execute(sql, params).fetchone()
+        if data:
+            return data
+    return None
+
+def _fetch_all(key, sql, params):
+    for shard in get_lookup_shards(key):
+        data = get_connection(shard).execute(sql, params).fetchall()
+        if data:
+            return data
+    return []
+
+
+"""
+Call listener(filenames) whenever where or how files are stored changes
+(their primary node, blocks or fragments), e.g. to drop cached copies
+"""
+def add_change_listener(listener):
+    _change_listeners.append(listener)
+
+def _notify_change(filenames):
+    for listener in _change_listeners:
+        listener(filenames)
+
+
+"""
+Reserve a filename not present in the file system yet
+The name is inserted with a pending primary node in the same transaction as
+the uniqueness check in its shard, so two concurrent PUTs through any masters
+can't both get the same name.
+"""
+@metrics.timed_query
+def reserve_unique_filename(filename):
+    return _reserve_unique_filename(filename, PENDING_PRIMARY_NODE)
+
+"""
+Reserve unique names for many files in one transaction per shard
+Returns the reserved names in the order of filenames.
+"""
+@metrics.timed_query
+def reserve_unique_filenames(filenames):
+    reserved = {}
+    for shard, indexed_filenames in _group_by_shard(enumerate(filenames), lambda record: record[1]):
+        with transaction(shard) as conn:
+            for index, filename in indexed_filenames:
+                if _insert_filename(conn, filename, PENDING_PRIMARY_NODE):
+                    reserved[index] = filename
+    # a taken name gets a random suffix, which may belong to another shard
+    return [
+        reserved[index] if index in reserved else _reserve_unique_filename(filename, PENDING_PRIMARY_NODE)
+        for index, filename in enumerate(filenames)
+    ]
+
+"""
+Insert filename, or the first free name with a random suffix, into its shard
+"""
+def _reserve_unique_filename(filename, primary_node):
+    name, ext = os.path.splitext(filename)
+    while True:
+        with transaction(get_shard(filename)) as conn:
+            if _insert_filename(conn, filename, primary_node):
+                return filename
+        filename = f"{name}_{flask_utilities.generate_random_str(5)}{ext}"
+
+def _insert_filename(conn, filename, primary_node, file_info=(None, None, None)):
+    if conn.execute("SELECT 1 FROM master_node WHERE filename=?;", (filename,)).fetchone():
+        return False
+    # rows not moved to a grown shard list yet; reshard.py writes a row to its
+    # new shard before deleting it from the old one, and can't while this
+    # transaction holds the write lock of the new shard
+    for shard in get_lookup_shards(filename)[1:]:
+        if get_connection(shard).execute("SELECT 1 FROM master_node WHERE filename=?;", (filename,)).fetchone():
+            return False
+    conn.execute(
+        """
+        INSERT INTO master_node (filename, primary_node, file_size, file_hash, hash_algorithm, created_at)
+        VALUES (?, ?, ?, ?, ?, ?);
+        """,
+        (filename, primary_node, *file_info, time.time())
+    )
+    return True
+
+@metrics.timed_query
+def release_filename(filename):
+    for shard in get_lookup_shards(filename):
+        get_connection(shard).execute(
+            "DELETE FROM master_node WHERE filename=? AND primary_node=?;",
+            (filename, PENDING_PRIMARY_NODE)
+        )
+
+"""
+Release the names reserved before reserved_before (a time.time()) whose
+upload neither committed nor failed, e.g. a direct upload never confirmed
+Returns the released names.
+"""
+@metrics.timed_query
+def release_expired_filenames(reserved_before):
+    released = []
+    for shard in get_all_shards():
+        with transaction(shard) as conn:
+            data = conn.execute(
+                "SELECT filename FROM master_node WHERE primary_node=? AND created_at < ?;",
+                (PENDING_PRIMARY_NODE, reserved_before)
+            ).fetchall()
+            conn.execute(
+                "DELETE FROM master_node WHERE primary_node=? AND created_at < ?;",
+                (PENDING_PRIMARY_NODE, reserved_before)
+            )
+        released.extend(row[0] for row in data)
+    return released
+
+"""
+Record filename as stored on primary_node, with its size and hash if given
+"""
+@metrics.timed_query
+def update_master_table(filename, primary_node, file_size=None, file_hash=None, hash_algorithm=None):
+    get_connection(get_shard(filename)).execute(
+        UPSERT_FILE_SQL,
+        (filename, primary_node, file_size, file_hash, hash_algorithm, time.time())
+    )
+    _notify_change([filename])
+
+"""
+Record many (filename, primary_node, file_size, file_hash, hash_algorithm) in
+one transaction per shard
+"""
+@metrics.timed_query
+def update_master_tables(records):
+    created_at = time.time()
+    for shard, shard_records in _group_by_shard(records, lambda record: record[0]):
+        with transaction(shard) as conn:
+            conn.executemany(UPSERT_FILE_SQL, [(*record, created_at) for record in shard_records])
+    _notify_change([record[0] for record in records])
+
+"""
+Return primary node of file if it exists
+Else return None
+"""
+@metrics.timed_query
+def return_pnode_of_file(filename):
+    data = _fetch_first(filename, "SELECT primary_node FROM master_node WHERE filename=?;", (filename,))
+    # a reserved name whose upload isn't finished doesn't exist yet, and a
+    # deduplicated name is stored on the node of the name it resolves to
+    if data and data[0] not in (PENDING_PRIMARY_NODE, ALIAS_PRIMARY_NODE):
+        return data[0]
+    return None
+
+@metrics.timed_query
+def get_sns_with_file_copy(filename):
+    nodes = []
+    # records of a file being moved to another shard may be in both
+    for shard in get_lookup_shards(filename):
+        data = get_connection(shard).execute(
+            "SELECT replicated_node FROM replication_data WHERE filename=?;", (filename,)
+        ).fetchall()  # -> [('sn0:5000',), ('sn3:6050',)]
+        nodes.extend(row[0] for row in data if row[0] not in nodes)
+    return nodes  # -> ['sn0:5000', 'sn3:6050']
+
+"""
+Insert many (filename, replicated_node) rows in one transaction per shard
+"""
+@metrics.timed_query
+def add_replication_records(records):
+    for shard, shard_records in _group_by_shard(records, lambda record: record[0]):
+        with transaction(shard) as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO replication_data (filename, replicated_node) VALUES (?, ?);",
+                shard_records
+            )
+
+def update_replication_table(filename, replicated_node):
+    add_replication_records([(filename, replicated_node)])
+
+@metrics.timed_query
+def update_chunked_file_tables(filename, file_size, file_hash, hash_algorithm, block_size, blocks):
+    with transaction(get_shard(filename)) as conn:
+        # an upsert: the reserved name may still be in its shard under the previous list
+        conn.execute(
+            UPSERT_FILE_SQL,
+            (filename, blocks[0]['node'], file_size, file_hash, hash_algorithm, time.time())
+        )
+        conn.execute(
+            """
+            INSERT INTO chunked_files (filename, file_size, file_hash, hash_algorithm, block_size)
+            VALUES (?, ?, ?, ?, ?);
+            """,
+            (filename, file_size, file_hash, hash_algorithm, block_size)
+        )
+        conn.executemany(
+            """
+            INSERT INTO file_blocks (filename, block_index, block_name, node, block_size, block_hash)
+            VALUES (?, ?, ?, ?, ?, ?);
+            """,
+            [(filename, b['block_index'], b['block_name'], b['node'], b['block_size'], b['block_hash'])
+                for b in blocks]
+        )
+    _notify_change([filename])
+
+"""
+Return size and hash of file if it is stored in blocks
+Else return None
+"""
+@metrics.timed_query
+def get_chunked_file(filename):
+    data = _fetch_first(
+        filename, "SELECT file_size, file_hash, hash_algorithm FROM chunked_files WHERE filename=?;", (filename,)
+    )
+    if data:
+        return {'file_size': data[0], 'file_hash': data[1], 'hash_algorithm': data[2]}
+    return None
+
+@metrics.timed_query
+def get_file_blocks(filename):
+    data = _fetch_all(
+        filename,
+        """
+        SELECT block_index, block_name, node, block_size, block_hash FROM file_blocks
+        WHERE filename=? ORDER BY block_index;
+        """,
+        (filename,)
+    )
+    return [
+        {'block_index': row[0], 'block_name': row[1], 'node': row[2], 'block_size': row[3], 'block_hash': row[4]}
+        for row in data
+    ]
+
+@metrics.timed_query
+def update_erasure_coded_file_tables(filename, file_size, file_hash, hash_algorithm, data_fragments,
+                                     parity_fragments, stripe_unit, fragments):
+    with transaction(get_shard(filename)) as conn:
+        # an upsert: the reserved name may still be in its shard under the previous list
+        conn.execute(
+            UPSERT_FILE_SQL,
+            (filename, fragments[0]['node'], file_size, file_hash, hash_algorithm, time.time())
+        )
+        conn.execute(
+            """
+            INSERT INTO erasure_coded_files (filename, file_size, file_hash, hash_algorithm,
+                                             data_fragments, parity_fragments, stripe_unit)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """,
+            (filename, file_size, file_hash, hash_algorithm, data_fragments, parity_fragments, stripe_unit)
+        )
+        conn.executemany(
+            """
+            INSERT INTO file_fragments (filename, fragment_index, fragment_name, node, fragment_size, fragment_hash)
+            VALUES (?, ?, ?, ?, ?, ?);
+            """,
+            [(filename, f['fragment_index'], f['fragment_name'], f['node'], f['fragment_size'], f['fragment_hash'])
+                for f in fragments]
+        )
+    _notify_change([filename])
+
+"""
+Return size, hash and code of file if it is erasure coded
+Else return None
+"""
+@metrics.timed_query
+def get_erasure_coded_file(filename):
+    data = _fetch_first(
+        filename,
+        """
+        SELECT file_size, file_hash, hash_algorithm, data_fragments, parity_fragments, stripe_unit
+        FROM erasure_coded_files WHERE filename=?;
+        """,
+        (filename,)
+    )
+    if data:
+        return {
+            'file_size': data[0],
+            'file_hash': data[1],
+            'hash_algorithm': data[2],
+            'data_fragments': data[3],
+            'parity_fragments': data[4],
+            'stripe_unit': data[5]
+        }
+    return None
+
+@metrics.timed_query
+def get_file_fragments(filename):
+    data = _fetch_all(
+        filename,
+        """
+        SELECT fragment_index, fragment_name, node, fragment_size, fragment_hash FROM file_fragments
+        WHERE filename=? ORDER BY fragment_index;
+        """,
+        (filename,)
+    )
+    return [
+        {'fragment_index': row[0], 'fragment_name': row[1], 'node': row[2], 'fragment_size': row[3],
+         'fragment_hash': row[4]}
+        for row in data
+    ]
+
+"""
+Size, hash, creation time and primary node of a stored file, as a dict of
+FILE_RECORD_COLUMNS; None if it doesn't exist or is only reserved
+Size and hash are None for files stored before they were recorded.
+"""
+@metrics.timed_query
+def get_file_record(filename):
+    data = _fetch_first(
+        filename, f"SELECT {', '.join(FILE_RECORD_COLUMNS)} FROM master_node WHERE filename=?;", (filename,))
+    if not data or data[1] == PENDING_PRIMARY_NODE:
+        return None
+    return _get_record(data)
+
+def _get_record(row):
+    record = dict(zip(FILE_RECORD_COLUMNS, row))
+    if record['primary_node'] == ALIAS_PRIMARY_NODE:
+        # where the content is now, which the rebalancer or reshard.py may have moved
+        record['primary_node'] = return_pnode_of_file(resolve_filename(record['filename']))
+    return record
+
+"""
+Records of up to limit stored files whose names start with prefix and come
+after start_after, in name order
+Each shard reads the range off its filename index; the shards' pages are merged.
+"""
+@metrics.timed_query
+def list_file_records(prefix='', start_after='', limit=100):
+    sql = (f"SELECT {', '.join(FILE_RECORD_COLUMNS)} FROM master_node "
+           f"WHERE filename > ? AND filename >= ? AND primary_node != ?")
+    params = [start_after, prefix, PENDING_PRIMARY_NODE]
+    if prefix and ord(prefix[-1]) < 0x10FFFF:
+        # the names starting with prefix sort below this one
+        sql += " AND filename < ?"
+        params.append(prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    sql += " ORDER BY filename LIMIT ?;"
+    params.append(limit)
+    pages = [get_connection(shard).execute(sql, params).fetchall() for shard in get_all_shards()]
+    records = []
+    for row in heapq.merge(*pages, key=lambda row: row[0]):
+        # in two shards while reshard.py moves it
+        if records and records[-1]['filename'] == row[0]:
+            continue
+        records.append(_get_record(row))
+        if len(records) == limit:
+            break
+    return records
+
+"""
+Name under which the content of filename is actually stored
+Same as filename unless it was deduplicated onto an existing file, whose name
+is looked up in content_index by the hash the alias references.
+"""
+@metrics.timed_query
+def resolve_filename(filename):
+    data = _fetch_first(filename, "SELECT hash_algorithm, file_hash FROM file_aliases WHERE filename=?;", (filename,))
+    content = _find_content(*data) if data else None
+    return content[1] if content else filename
+
+@metrics.timed_query
+def register_content(hash_algorithm, file_hash, filename):
+    get_connection(get_shard(get_content_key(hash_algorithm, file_hash))).execute(
+        """
+        INSERT OR IGNORE INTO content_index (hash_algorithm, file_hash, filename, ref_count)
+        VALUES (?, ?, ?, 1);
+        """,
+        (hash_algorithm, file_hash, filename)
+    )
+
+@metrics.timed_query
+def register_contents(records):
+    for shard, shard_records in _group_by_shard(records, lambda record: get_content_key(record[0], record[1])):
+        with transaction(shard) as conn:
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO content_index (hash_algorithm, file_hash, filename, ref_count)
+                VALUES (?, ?, ?, 1);
+                """,
+                shard_records
+            )
+
+"""
+Store filename as a new reference to already stored content with this hash
+Returns the unique name given to the new reference,
+or None if no stored file has this content.
+The content, the stored file and the new name may each be in another shard.
+The content and its file are looked up again once the write locks of all
+three shards are held, and the alias is inserted and the reference counted
+in the same transactions, so a file deleted meanwhile is never referenced.
+"""
+@metrics.timed_query
+def add_content_reference(filename, hash_algorithm, file_hash):
+    name, ext = os.path.splitext(filename)
+    while True:
+        content = _find_content(hash_algorithm, file_hash)
+        if content is None:
+            return None
+        content_shard, target_filename = content
+        shards = [content_shard, get_shard(filename)] + get_lookup_shards(target_filename)
+        with transactions(shards) as conns:
+            data = conns[content_shard].execute(
+                "SELECT filename FROM content_index WHERE hash_algorithm=? AND file_hash=?;",
+                (hash_algorithm, file_hash)
+            ).fetchone()
+            if not data or data[0] != target_filename:
+                # changed before the locks were taken; look it up again
+                continue
+            target = get_file_record(target_filename)
+            if not target:
+                return None
+            if _insert_filename(conns[get_shard(filename)], filename, ALIAS_PRIMARY_NODE,
+                                (target['file_size'], file_hash, hash_algorithm)):
+                conns[get_shard(filename)].execute(
+                    "INSERT INTO file_aliases (filename, hash_algorithm, file_hash) VALUES (?, ?, ?);",
+                    (filename, hash_algorithm, file_hash)
+                )
+                conns[content_shard].execute(
+                    "UPDATE content_index SET ref_count = ref_count + 1 WHERE hash_algorithm=? AND file_hash=?;",
+                    (hash_algorithm, file_hash)
+                )
+                return filename
+        filename = f"{name}_{flask_utilities.generate_random_str(5)}{ext}"
+
+"""
+(shard, filename) of the file stored with this content, or None
+"""
+def _find_content(hash_algorithm, file_hash):
+    for shard in get_lookup_shards(get_content_key(hash_algorithm, file_hash)):
+        data = get_connection(shard).execute(
+            "SELECT filename FROM content_index WHERE hash_algorithm=? AND file_hash=?;",
+            (hash_algorithm, file_hash)
+        ).fetchone()
+        if data:
+            return shard, data[0]
+    return None
+
+"""
+Delete filename from the metadata
+Returns the (name, node) copies stored for it, for the SNs to delete, or None
+if it doesn't exist. A deduplicated name only drops its reference to the
+content and has no copies of its own. A file whose content other names still
+reference is kept, and ValueError raised.
+A delete is rare: it locks every shard, so that the rows of the file, the
+replicas of its blocks and its content are seen and removed at once.
+"""
+@metrics.timed_query
+def delete_file(filename):
+    with transactions(get_all_shards()) as conns:
+        conns = list(conns.values())
+        data = _select_first(conns, "SELECT primary_node, hash_algorithm, file_hash FROM master_node WHERE filename=?;",
+                             (filename,))
+        if not data or data[0] == PENDING_PRIMARY_NODE:
+            return None
+        alias = _select_first(conns, "SELECT hash_algorithm, file_hash FROM file_aliases WHERE filename=?;",
+                              (filename,))
+        content_key = alias or data[1:]
+        content = _select_first(conns, """
+            SELECT filename, ref_count FROM content_index WHERE hash_algorithm=? AND file_hash=?;
+            """, content_key)
+        copies = []
+        if alias:
+            if content:
+                _update_all(conns, """
+                    UPDATE content_index SET ref_count = ref_count - 1 WHERE hash_algorithm=? AND file_hash=?;
+                    """, content_key)
+        else:
+            if content and content[0] == filename:
+                if content[1] > 1:
+                    raise ValueError(f"{filename} is referenced by {content[1] - 1} deduplicated files.")
+                _update_all(conns, "DELETE FROM content_index WHERE hash_algorithm=? AND file_hash=?;", content_key)
+            copies = _select_file_copies(conns, filename, data[0])
+        for table in FILENAME_TABLES:
+            _update_all(conns, f"DELETE FROM {table} WHERE filename=?;", (filename,))
+        # the replicas of its blocks
+        for name in {name for name, _ in copies if name != filename}:
+            _update_all(conns, "DELETE FROM replication_data WHERE filename=?;", (name,))
+    _notify_change([filename])
+    return copies
+
+def _select_first(conns, sql, params):
+    for conn in conns:
+        data = conn.execute(sql, params).fetchone()
+        if data:
+            return data
+    return None
+
+def _update_all(conns, sql, params):
+    for conn in conns:
+        conn.execute(sql, params)
+
+"""
+(name, node) of every copy of the file stored whole on primary_node, or as blocks or fragments
+"""
+def _select_file_copies(conns, filename, primary_node):
+    copies = set()
+    for conn in conns:
+        copies |= set(conn.execute("SELECT block_name, node FROM file_blocks WHERE filename=?;", (filename,)))
+        copies |= set(conn.execute("SELECT fragment_name, node FROM file_fragments WHERE filename=?;", (filename,)))
+    if not copies:
+        copies.add((filename, primary_node))
+    for name in {name for name, _ in copies}:
+        for conn in conns:
+            copies |= {(name, row[0]) for row in conn.execute(
+                "SELECT replicated_node FROM replication_data WHERE filename=?;", (name,))}
+    return sorted(copies)
+
+"""
+Every stored copy as (kind, name, node, group)
+kind is one of COPY_KINDS and name the object stored on node under that
+name. Copies of the same group must stay on distinct nodes: the primary and
+replicas of a file or block, and the fragments of an erasure-coded file.
+"""
+@metrics.timed_query
+def get_stored_copies():
+    copies = []
+    for shard in get_all_shards():
+        conn = get_connection(shard)
+        data = conn.execute(
+            """
+            SELECT filename, primary_node FROM master_node
+            WHERE primary_node != ?
+            AND filename NOT IN (SELECT filename FROM file_aliases)
+            AND filename NOT IN (SELECT filename FROM chunked_files)
+            AND filename NOT IN (SELECT filename FROM erasure_coded_files);
+            """,
+            (PENDING_PRIMARY_NODE,)
+        ).fetchall()
+        copies.extend((COPY_PRIMARY, filename, node, filename) for filename, node in data)
+        data = conn.execute("SELECT filename, replicated_node FROM replication_data;").fetchall()
+        copies.extend((COPY_REPLICA, filename, node, filename) for filename, node in data)
+        data = conn.execute("SELECT block_name, node FROM file_blocks;").fetchall()
+        copies.extend((COPY_BLOCK, block_name, node, block_name) for block_name, node in data)
+        data = conn.execute("SELECT fragment_name, node, filename FROM file_fragments;").fetchall()
+        copies.extend((COPY_FRAGMENT, fragment_name, node, filename) for fragment_name, node, filename in data)
+    return copies
+
+"""
+Nodes the metadata says hold a copy of the object stored as name
+"""
+@metrics.timed_query
+def get_copy_nodes(name):
+    shards = get_lookup_shards(name)
+    match = PART_NAME_PATTERN.match(name)
+    if match:
+        # a block or fragment, or a file named like one
+        shards += [shard for shard in get_lookup_shards(match.group(1)) if shard not in shards]
+    nodes = set()
+    for shard in shards:
+        nodes |= _select_copy_nodes(get_connection(shard), name)
+    return nodes
+
+def _select_copy_nodes(conn, name):
+    data = conn.execute(
+        """
+        SELECT primary_node FROM master_node WHERE filename=?
+        UNION SELECT replicated_node FROM replication_data WHERE filename=?
+        UNION SELECT node FROM file_blocks WHERE block_name=?
+        UNION SELECT node FROM file_fragments WHERE fragment_name=?;
+        """,
+        (name, name, name, name)
+    ).fetchall()
+    return {row[0] for row in data}
+
+"""
+Point the copy of name on src_node to dest_node, which holds the same bytes now
+Only done if the copy is still on src_node, in one transaction, so readers see
+either node. Returns whether it was moved.
+"""
+@metrics.timed_query
+def move_copy(kind, name, src_node, dest_node):
+    if kind not in COPY_KINDS:
+        raise ValueError(f"Unknown copy kind {kind}.")
+    for shard in get_lookup_shards(get_owner_filename(name, kind)):
+        filename = _move_copy_in_shard(shard, kind, name, src_node, dest_node)
+        if filename:
+            _notify_change([filename])
+            return True
+    return False
+
+def _move_copy_in_shard(shard, kind, name, src_node, dest_node):
+    with transaction(shard) as conn:
+        # e.g. replicated there while the bytes were being copied
+        if dest_node in _select_copy_nodes(conn, name):
+            return None
+        if kind == COPY_PRIMARY:
+            cursor = conn.execute(
+                "UPDATE master_node SET primary_node=? WHERE filename=? AND primary_node=?;",
+                (dest_node, name, src_node)
+            )
+        elif kind == COPY_REPLICA:
+            cursor = conn.execute(
+                "UPDATE replication_data SET replicated_node=? WHERE filename=? AND replicated_node=?;",
+                (dest_node, name, src_node)
+            )
+        elif kind == COPY_BLOCK:
+            cursor = conn.execute(
+                "UPDATE file_blocks SET node=? WHERE block_name=? AND node=?;",
+                (dest_node, name, src_node)
+            )
+        else:
+            cursor = conn.execute(
+                "UPDATE file_fragments SET node=? WHERE fragment_name=? AND node=?;",
+                (dest_node, name, src_node)
+            )
+        if cursor.rowcount != 1:
+            return None
+        filename = name
+        if kind in (COPY_BLOCK, COPY_FRAGMENT):
+            table, name_column, index_column = (
+                ('file_blocks', 'block_name', 'block_index') if kind == COPY_BLOCK
+                else ('file_fragments', 'fragment_name', 'fragment_index')
+            )
+            filename, index = conn.execute(
+                f"SELECT filename, {index_column} FROM {table} WHERE {name_column}=?;", (name,)
+            ).fetchone()
+            # the primary node of a chunked or erasure-coded file is that of its first block or fragment
+            if index == 0:
+                conn.execute(
+                    "UPDATE master_node SET primary_node=? WHERE filename=?;",
+                    (dest_node, filename)
+                )
+    return filename
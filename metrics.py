@@ -0,0 +1,199 @@
+"""
+Timing histograms, counters and trace ids, rendered for Prometheus on /metrics
+
+Every process keeps its own metrics in memory. The stages of handling a file
+(the SN post of an upload, hashing on the SN, a replication copy, ...) are
+timed into dfs_stage_seconds{stage=...}, the metadata queries into
+dfs_db_query_seconds{query=...} and whole HTTP requests into
+dfs_http_request_seconds.
+
+A trace id travels with a request in the X-Trace-Id header: the master takes
+the client's or makes one up, the pooled HTTP session sends it on to the SNs,
+and the SNs hand it to the replication task of the file.
+"""
+import bisect
+import contextvars
+import functools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+TRACE_ID_HEADER = 'X-Trace-Id'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds; from a cached metadata query up to a large file transfer
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+_trace_id = contextvars.ContextVar('trace_id', default=None)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, value in series:
+            lines.extend(self.render_series(labels, value))
+        return lines
+
+    def render_series(self, labels, value):
+        return [f"{self.name}{format_labels(labels)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+"""
+Value read from elsewhere at scrape time, e.g. the state of the nodes
+metric_type is 'counter' for values which only grow, like the connections a
+pool has opened.
+"""
+class Gauge(Metric):
+    def __init__(self, name, help_text, metric_type='gauge'):
+        super().__init__(name, help_text)
+        self.metric_type = metric_type
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            series['buckets'][bucket] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render_series(self, labels, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), series['buckets']):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(series['sum'])}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return lines
+
+
+STAGE_SECONDS = Histogram('dfs_stage_seconds', "Time spent in each stage of storing, serving or replicating a file.")
+STAGE_FAILURES = Counter('dfs_stage_failures_total', "Stages which raised an error.")
+STAGE_BYTES = Counter('dfs_stage_bytes_total', "Bytes moved by each stage.")
+REQUEST_SECONDS = Histogram('dfs_http_request_seconds', "Time to handle an HTTP request, up to its response headers.")
+DB_QUERY_SECONDS = Histogram('dfs_db_query_seconds', "Latency of the metadata store queries.")
+
+
+def observe_stage(stage, seconds, num_bytes=None):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if num_bytes is not None:
+        STAGE_BYTES.inc(num_bytes, stage=stage)
+
+"""
+Time the block into the stage histogram; a raised error counts as a failure
+"""
+@contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_FAILURES.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+"""
+Time stages which interleave, like receiving, hashing and writing the chunks
+of a stream: lap(stage) books the time since the previous lap to stage, and
+observe() records the totals.
+"""
+class StageClock:
+    def __init__(self):
+        self.totals = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0) + now - self.last
+        self.last = now
+
+    def observe(self):
+        for stage, seconds in self.totals.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+
+"""
+Decorator timing every call of a metadata store function
+"""
+def timed_query(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, query=func.__name__)
+    return wrapper
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def set_trace_id(trace_id):
+    _trace_id.set(trace_id)
+
+def get_trace_id():
+    return _trace_id.get()
+
+"""
+executor.submit which runs fn with the trace id of the caller
+Threads don't inherit the context of the thread which started them.
+"""
+def submit_in_context(executor, fn, *args, **kwargs):
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,221 @@
+"""
+Incremental reader of multipart/form-data request bodies
+
+Werkzeug parses a whole multipart body, spooling the files to memory or a
+temp file, before the view gets the first byte. MultipartReader reads the
+parts in order from the request stream instead, with no more than two
+chunks buffered: the form fields are collected until the file part, whose
+bytes the caller reads and passes on as they arrive. The senders in this
+repo (requests, aiohttp.FormData, the client) all put the fields before the
+file.
+"""
+import uuid
+
+from werkzeug.http import parse_options_header
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEADER_BYTES = 16 * 1024
+MAX_FIELD_BYTES = 64 * 1024
+
+
+class MultipartReader:
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.delimiter = b'\r\n--' + boundary.encode('latin-1')
+        self.chunk_size = chunk_size
+        # the first delimiter has no line break before it
+        self.buffer = b'\r\n'
+        self.done = False
+
+    def _fill(self):
+        data = self.stream.read(self.chunk_size)
+        if not data:
+            raise ValueError("The multipart body ended before its closing boundary.")
+        self.buffer += data
+
+    """
+    Skip the rest of the current part and return (name, filename) of the
+    next one, or None after the last
+    filename is None for a form field.
+    """
+    def next_part(self):
+        while not self.done:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                break
+            # keep what may be the start of a delimiter
+            self.buffer = self.buffer[-(len(self.delimiter) - 1):]
+            self._fill()
+        if self.done:
+            return None
+        while len(self.buffer) < 2:
+            self._fill()
+        if self.buffer.startswith(b'--'):
+            self.done = True
+            return None
+        while b'\r\n\r\n' not in self.buffer:
+            if len(self.buffer) > MAX_HEADER_BYTES:
+                raise ValueError("Multipart part headers are too large.")
+            self._fill()
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        # the rest of the delimiter line, then the headers
+        lines = head.decode('latin-1').split('\r\n')[1:]
+        headers = {}
+        for line in lines:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        _, options = parse_options_header(headers.get('content-disposition', ''))
+        if 'name' not in options:
+            raise ValueError("Multipart part without a name.")
+        return options['name'], options.get('filename')
+
+    """
+    Up to size bytes of the current part; b'' at its end
+    """
+    def read(self, size=CHUNK_SIZE):
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                available = index
+            else:
+                available = len(self.buffer) - (len(self.delimiter) - 1)
+            if available > 0 or index == 0:
+                data = self.buffer[:min(available, size)]
+                self.buffer = self.buffer[len(data):]
+                return data
+            self._fill()
+
+    def read_field(self):
+        value = b''
+        while True:
+            data = self.read()
+            if not data:
+                return value.decode('utf-8')
+            value += data
+            if len(value) > MAX_FIELD_BYTES:
+                raise ValueError("Multipart form field is too large.")
+
+    """
+    The form fields up to the first file part, and (name, filename) of that
+    part, its bytes left to read()
+    Returns (fields, None) if the body has no file.
+    """
+    def read_fields(self):
+        fields = {}
+        while True:
+            part = self.next_part()
+            if part is None:
+                return fields, None
+            name, filename = part
+            if filename is not None:
+                return fields, part
+            fields[name] = self.read_field()
+
+    """
+    Read the body to its end, so that the connection can take the next request
+    """
+    def drain(self):
+        while self.stream.read(self.chunk_size):
+            pass
+        self.done = True
+
+
+"""
+File part of a streamed upload, read from the client as an SN takes it
+The chunks read are kept until there are more than max_bytes of them; until
+then a retry can send the file again from its start.
+"""
+class UploadReplay:
+    def __init__(self, reader, max_bytes):
+        self.reader = reader
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self.read_bytes = 0
+        self.overflowed = False
+        # error reading from the client, which no retry helps with
+        self.error = None
+
+    def can_replay(self):
+        return not self.overflowed
+
+    def iter_body(self, head, tail):
+        yield head
+        yield from self.chunks
+        while True:
+            try:
+                data = self.reader.read()
+            except Exception as e:
+                self.error = e
+                raise
+            if not data:
+                break
+            self.read_bytes += len(data)
+            if not self.overflowed:
+                if self.read_bytes <= self.max_bytes:
+                    self.chunks.append(data)
+                else:
+                    self.overflowed = True
+                    self.chunks = []
+            yield data
+        yield tail
+
+
+def new_boundary():
+    return uuid.uuid4().hex
+
+"""
+Start of a multipart/form-data body: the fields, then the headers of the
+file part; the file's bytes and form_tail() follow
+"""
+def form_head(boundary, fields, name, filename):
+    head = "".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"\r\n\r\n{value}\r\n'
+        for field, value in fields.items()
+    )
+    filename = filename.replace('"', '%22')
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+             f'Content-Type: application/octet-stream\r\n\r\n')
+    return head.encode('utf-8')
+
+def form_tail(boundary):
+    return f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+def get_content_type(boundary):
+    return f'multipart/form-data; boundary={boundary}'
+
+"""
+multipart/form-data body of the fields and a file part of chunks, produced
+as it is sent
+Given the file's size, its len tells requests the Content-Length; without
+it the body is sent chunked.
+"""
+class FormBody:
+    def __init__(self, fields, name, filename, chunks, file_size=None):
+        boundary = new_boundary()
+        self.content_type = get_content_type(boundary)
+        self.head = form_head(boundary, fields, name, filename)
+        self.tail = form_tail(boundary)
+        self.chunks = chunks
+        if file_size is not None:
+            self.len = len(self.head) + file_size + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        yield from self.chunks
+        yield self.tail
+
+"""
+Boundary of a multipart/form-data body of content_type, or None for any other body
+"""
+def parse_boundary(content_type):
+    mimetype, options = parse_options_header(content_type or '')
+    if mimetype.lower() != 'multipart/form-data':
+        return None
+    return options.get('boundary')
+
+"""
+Boundary of a multipart/form-data (Flask) request, or None for any other body
+"""
+def get_boundary(request):
+    return parse_boundary(request.headers.get('Content-Type'))
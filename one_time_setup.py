@@ -1,34 +1,162 @@
 import sqlite3
-import flask_utilities
+import metadata_store
+
+# recorded when a file is stored, for stat and list without the SNs;
+# added to the master_node tables of older DBs in this order
+MASTER_NODE_FILE_COLUMNS = [
+    ('file_size', 'INTEGER'),
+    ('file_hash', 'VARCHAR(128)'),
+    ('hash_algorithm', 'VARCHAR(16)'),
+    ('created_at', 'REAL')
+]
 
 
 def get_sql_create_master_table():
     return """
-        CREATE TABLE master_node (
+        CREATE TABLE IF NOT EXISTS master_node (
             filename        VARCHAR(100)    PRIMARY KEY     NOT NULL,
-            primary_node    VARCHAR(100)    NOT NULL
+            primary_node    VARCHAR(100)    NOT NULL,
+            file_size       INTEGER,
+            file_hash       VARCHAR(128),
+            hash_algorithm  VARCHAR(16),
+            created_at      REAL
         );
     """
 
+def add_missing_master_columns(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(master_node);")}
+    for column, column_type in MASTER_NODE_FILE_COLUMNS:
+        if column not in columns:
+            conn.execute(f"ALTER TABLE master_node ADD COLUMN {column} {column_type};")
+            print(f"Column {column} added to the master node table.")
+
 def get_sql_create_replication_table():
     return f"""
-        CREATE TABLE replication_data (
+        CREATE TABLE IF NOT EXISTS replication_data (
             filename            VARCHAR(100)    NOT NULL,
             replicated_node     VARCHAR(100)    NOT NULL,
             PRIMARY KEY (filename, replicated_node)
         );
     """
 
+def get_sql_create_chunked_files_table():
+    return """
+        CREATE TABLE IF NOT EXISTS chunked_files (
+            filename        VARCHAR(100)    PRIMARY KEY     NOT NULL,
+            file_size       INTEGER         NOT NULL,
+            file_hash       VARCHAR(128)    NOT NULL,
+            hash_algorithm  VARCHAR(16)     NOT NULL    DEFAULT 'md5',
+            block_size      INTEGER         NOT NULL
+        );
+    """
 
-def main():
-    db_name = flask_utilities.get_db_name()
+def get_sql_create_file_blocks_table():
+    return """
+        CREATE TABLE IF NOT EXISTS file_blocks (
+            filename        VARCHAR(100)    NOT NULL,
+            block_index     INTEGER         NOT NULL,
+            block_name      VARCHAR(120)    NOT NULL,
+            node            VARCHAR(100)    NOT NULL,
+            block_size      INTEGER         NOT NULL,
+            block_hash      VARCHAR(128)    NOT NULL,
+            PRIMARY KEY (filename, block_index)
+        );
+    """
+
+def get_sql_create_erasure_coded_files_table():
+    return """
+        CREATE TABLE IF NOT EXISTS erasure_coded_files (
+            filename            VARCHAR(100)    PRIMARY KEY     NOT NULL,
+            file_size           INTEGER         NOT NULL,
+            file_hash           VARCHAR(128)    NOT NULL,
+            hash_algorithm      VARCHAR(16)     NOT NULL    DEFAULT 'md5',
+            data_fragments      INTEGER         NOT NULL,
+            parity_fragments    INTEGER         NOT NULL,
+            stripe_unit         INTEGER         NOT NULL
+        );
+    """
+
+def get_sql_create_file_fragments_table():
+    return """
+        CREATE TABLE IF NOT EXISTS file_fragments (
+            filename        VARCHAR(100)    NOT NULL,
+            fragment_index  INTEGER         NOT NULL,
+            fragment_name   VARCHAR(120)    NOT NULL,
+            node            VARCHAR(100)    NOT NULL,
+            fragment_size   INTEGER         NOT NULL,
+            fragment_hash   VARCHAR(128)    NOT NULL,
+            PRIMARY KEY (filename, fragment_index)
+        );
+    """
+
+def get_sql_create_content_index_table():
+    return """
+        CREATE TABLE IF NOT EXISTS content_index (
+            hash_algorithm  VARCHAR(16)     NOT NULL,
+            file_hash       VARCHAR(128)    NOT NULL,
+            filename        VARCHAR(100)    NOT NULL,
+            ref_count       INTEGER         NOT NULL    DEFAULT 1,
+            PRIMARY KEY (hash_algorithm, file_hash)
+        );
+    """
+
+def get_sql_create_file_aliases_table():
+    return """
+        CREATE TABLE IF NOT EXISTS file_aliases (
+            filename            VARCHAR(100)    PRIMARY KEY     NOT NULL,
+            hash_algorithm      VARCHAR(16)     NOT NULL,
+            file_hash           VARCHAR(128)    NOT NULL
+        );
+    """
+
+def migrate_file_aliases_table(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(file_aliases);")}
+    if 'target_filename' not in columns:
+        return
+    # aliases of older DBs name their target and copy its primary node; they
+    # reference its content now, whose hash the alias's master_node row holds
+    conn.execute("ALTER TABLE file_aliases RENAME TO file_aliases_by_target;")
+    conn.execute(get_sql_create_file_aliases_table())
+    conn.execute(
+        """
+        INSERT INTO file_aliases (filename, hash_algorithm, file_hash)
+        SELECT a.filename, m.hash_algorithm, m.file_hash
+        FROM file_aliases_by_target a JOIN master_node m ON m.filename = a.filename;
+        """
+    )
+    conn.execute("DROP TABLE file_aliases_by_target;")
+    conn.execute(
+        "UPDATE master_node SET primary_node=? WHERE filename IN (SELECT filename FROM file_aliases);",
+        (metadata_store.ALIAS_PRIMARY_NODE,)
+    )
+    conn.commit()
+    print("File aliases table migrated to content references.")
+
+
+def create_tables(db_name):
     conn = sqlite3.connect(db_name)
     print(f"Created database {db_name}.")
     conn.execute(get_sql_create_master_table())
+    add_missing_master_columns(conn)
     print("Table created for master node.")
     conn.execute(get_sql_create_replication_table())
     print("Table created for storing replication data.")
+    conn.execute(get_sql_create_chunked_files_table())
+    conn.execute(get_sql_create_file_blocks_table())
+    print("Tables created for storing file blocks.")
+    conn.execute(get_sql_create_erasure_coded_files_table())
+    conn.execute(get_sql_create_file_fragments_table())
+    print("Tables created for storing erasure-coded fragments.")
+    conn.execute(get_sql_create_content_index_table())
+    conn.execute(get_sql_create_file_aliases_table())
+    migrate_file_aliases_table(conn)
+    print("Tables created for content deduplication.")
     conn.close()
+
+def main():
+    # the shards being moved from as well
+    for db_name in metadata_store.get_all_shards():
+        create_tables(db_name)
     print("Setup done!")
 
 if __name__ == "__main__":
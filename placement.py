@@ -0,0 +1,86 @@
+"""
+Placement of new files and replicas, and choice of the node to read from
+
+Decisions are made from the load the storage nodes report on /health:
+free_bytes, in_flight_requests and latency_ms (moving average of their
+request latency). node_loads maps each candidate node to that report; a node
+whose report has no such stats is treated as idle with unknown free space.
+"""
+import random
+
+import flask_utilities
+import hash_ring
+
+
+def get_load_score(load):
+    # lower is better: the expected wait for a new request on the node
+    if not load:
+        return 1
+    return (load.get('in_flight_requests', 0) + 1) * max(load.get('latency_ms', 0), 1)
+
+def has_free_space(load, num_bytes=0):
+    if not load or load.get('free_bytes') is None:
+        return True
+    return load['free_bytes'] - num_bytes >= flask_utilities.get_placement_reserved_free_bytes()
+
+def get_capacity_weights(nodes, node_loads):
+    # without the free space of every node, draw uniformly
+    if any(not node_loads.get(sn) or node_loads[sn].get('free_bytes') is None for sn in nodes):
+        return None
+    return [max(node_loads[sn]['free_bytes'], 1) for sn in nodes]
+
+"""
+Pick the node to write num_bytes to
+Power of two choices: two nodes are drawn weighted by free capacity and the
+less loaded one wins. Fuller nodes get fewer new files, and a busy node is
+passed over without all writers piling onto the one least loaded node
+between two heartbeats.
+Returns None if no node has num_bytes to spare.
+With hash_ring placement, a file (key) goes to the first of its ring nodes
+which can take it instead.
+"""
+def choose_write_node(node_loads, num_bytes=0, key=None):
+    if key is not None and flask_utilities.is_hash_ring_placement():
+        ring_nodes = choose_ring_nodes(key, node_loads, 1, num_bytes)
+        return ring_nodes[0] if ring_nodes else None
+    candidates = [sn for sn, load in node_loads.items() if has_free_space(load, num_bytes)]
+    if not candidates:
+        return None
+    weights = get_capacity_weights(candidates, node_loads)
+    first, second = random.choices(candidates, weights=weights, k=2)
+    return min((first, second), key=lambda sn: get_load_score(node_loads.get(sn)))
+
+"""
+Pick k distinct nodes to hold replicas of num_bytes, weighted by free capacity
+"""
+def choose_replica_nodes(node_loads, k, num_bytes=0):
+    candidates = [sn for sn, load in node_loads.items() if has_free_space(load, num_bytes)]
+    chosen = []
+    while candidates and len(chosen) < k:
+        sn = random.choices(candidates, weights=get_capacity_weights(candidates, node_loads))[0]
+        chosen.append(sn)
+        candidates.remove(sn)
+    return chosen
+
+"""
+The first k nodes of key on the hash ring which are up and have num_bytes to spare
+"""
+def choose_ring_nodes(key, node_loads, k, num_bytes=0):
+    ring_nodes = hash_ring.get_cluster_ring().get_nodes(key)
+    return [sn for sn in ring_nodes if sn in node_loads and has_free_space(node_loads[sn], num_bytes)][:k]
+
+"""
+Order the nodes holding a copy of a file for reading it
+The power-of-two-choices pick goes first so that reads spread across the
+primary and the replicas; the others follow, least loaded first, as fallbacks.
+"""
+def order_read_nodes(nodes, node_loads):
+    nodes = list(nodes)
+    if len(nodes) < 2:
+        return nodes
+
+    def score(sn):
+        return get_load_score(node_loads.get(sn))
+
+    best = min(random.sample(nodes, 2), key=score)
+    return [best] + sorted((sn for sn in nodes if sn != best), key=score)
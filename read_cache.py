@@ -0,0 +1,261 @@
+"""
+Read-through cache of hot files on the master
+
+Whole files read through the master are kept so that the next GET of the
+same name is answered without a storage node: files up to
+memory_max_file_size in memory, larger ones up to disk_max_file_size as files
+under disk_dir. Each tier has a byte budget and evicts its least recently read
+files first.
+
+An entry is only kept if the bytes streamed to the client match the file's
+hash. It is tagged with the primary node of the file when it was filled;
+a lookup giving another version (the file was re-stored or moved) drops it,
+which also covers other master processes changing the metadata. The master
+drops the entries of the names it changes itself right away.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import flask_utilities
+
+TIER_MEMORY = 'memory'
+TIER_DISK = 'disk'
+TIERS = (TIER_MEMORY, TIER_DISK)
+# disk entries of a master process go in <disk_dir>/master-<pid>
+DISK_DIR_PREFIX = 'master-'
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class CacheEntry:
+    def __init__(self, version, size, file_hash, hash_algorithm, data=None, path=None):
+        self.version = version
+        self.size = size
+        self.file_hash = file_hash
+        self.hash_algorithm = hash_algorithm
+        self.data = data
+        self.path = path
+
+
+class ReadCache:
+    def __init__(self):
+        self.entries = {tier: OrderedDict() for tier in TIERS}
+        self.tier_bytes = {tier: 0 for tier in TIERS}
+        self.stats = {
+            'hits': {tier: 0 for tier in TIERS},
+            'misses': 0,
+            'fills': {tier: 0 for tier in TIERS},
+            'evictions': {tier: 0 for tier in TIERS},
+            'invalidations': 0,
+            'rejected_fills': 0
+        }
+        self.lock = threading.Lock()
+        self.disk_dir = None
+
+    def get_tier(self, size):
+        if size <= flask_utilities.get_read_cache_memory_max_file_size():
+            return TIER_MEMORY
+        if size <= flask_utilities.get_read_cache_disk_max_file_size():
+            return TIER_DISK
+        return None
+
+    def get_budget(self, tier):
+        if tier == TIER_MEMORY:
+            return flask_utilities.get_read_cache_memory_bytes()
+        return flask_utilities.get_read_cache_disk_bytes()
+
+    def get_disk_dir(self):
+        with self.lock:
+            if self.disk_dir is None:
+                root = flask_utilities.get_read_cache_disk_dir()
+                os.makedirs(root, exist_ok=True)
+                remove_stale_disk_dirs(root)
+                # one dir per master process, as uvicorn may run several workers;
+                # entries don't outlive it
+                self.disk_dir = os.path.join(root, f"{DISK_DIR_PREFIX}{os.getpid()}")
+                shutil.rmtree(self.disk_dir, ignore_errors=True)
+                os.makedirs(self.disk_dir)
+                atexit.register(shutil.rmtree, self.disk_dir, True)
+            return self.disk_dir
+
+    """
+    Look filename up for a read of its current version (None: any version)
+    Returns (entry, fp) with fp an open file of a disk entry (None in memory),
+    or None on a miss. The file stays readable even if the entry is evicted
+    while it is being sent.
+    """
+    def get(self, filename, version=None):
+        with self.lock:
+            for tier in TIERS:
+                entry = self.entries[tier].get(filename)
+                if entry is None:
+                    continue
+                if version is not None and entry.version != version:
+                    self._remove(tier, filename)
+                    self.stats['invalidations'] += 1
+                    break
+                self.entries[tier].move_to_end(filename)
+                self.stats['hits'][tier] += 1
+                return entry, open(entry.path, 'rb') if tier == TIER_DISK else None
+            self.stats['misses'] += 1
+        return None
+
+    """
+    Start caching a whole-file read of filename as its chunks come in
+    Returns a CacheFill taking the chunks, or None if the file is too large
+    to cache.
+    """
+    def begin_fill(self, filename, version, size, file_hash, hash_algorithm):
+        tier = self.get_tier(size)
+        if tier is None or size > self.get_budget(tier):
+            return None
+        return CacheFill(self, tier, filename, CacheEntry(version, size, file_hash, hash_algorithm))
+
+    """
+    Pass the chunks of a whole-file read through, caching the file if all of
+    them arrive and they match file_hash
+    """
+    def fill(self, filename, version, chunks, size, file_hash, hash_algorithm):
+        cache_fill = self.begin_fill(filename, version, size, file_hash, hash_algorithm)
+        if cache_fill is None:
+            yield from chunks
+            return
+        is_complete = False
+        try:
+            for chunk in chunks:
+                cache_fill.add(chunk)
+                yield chunk
+            is_complete = True
+        finally:
+            cache_fill.finish(is_complete)
+
+    def _add(self, tier, filename, entry):
+        with self.lock:
+            for any_tier in TIERS:
+                self._remove(any_tier, filename)
+            self.entries[tier][filename] = entry
+            self.tier_bytes[tier] += entry.size
+            self.stats['fills'][tier] += 1
+            budget = self.get_budget(tier)
+            while self.tier_bytes[tier] > budget:
+                evicted_filename = next(iter(self.entries[tier]))
+                self._remove(tier, evicted_filename)
+                self.stats['evictions'][tier] += 1
+
+    def _remove(self, tier, filename):
+        entry = self.entries[tier].pop(filename, None)
+        if entry is None:
+            return
+        self.tier_bytes[tier] -= entry.size
+        if entry.path:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    """
+    Drop the entries of filenames, whose metadata changed
+    """
+    def invalidate(self, filenames):
+        with self.lock:
+            for filename in filenames:
+                if any(filename in self.entries[tier] for tier in TIERS):
+                    self.stats['invalidations'] += 1
+                for tier in TIERS:
+                    self._remove(tier, filename)
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                'hits': dict(self.stats['hits']),
+                'misses': self.stats['misses'],
+                'fills': dict(self.stats['fills']),
+                'evictions': dict(self.stats['evictions']),
+                'invalidations': self.stats['invalidations'],
+                'rejected_fills': self.stats['rejected_fills'],
+                'files': {tier: len(self.entries[tier]) for tier in TIERS},
+                'bytes': dict(self.tier_bytes)
+            }
+        stats['enabled'] = flask_utilities.is_read_cache_enabled()
+        stats['budget_bytes'] = {tier: self.get_budget(tier) for tier in TIERS}
+        return stats
+
+
+"""
+A file being cached as it is read
+Chunks are kept in memory or written to a file under the disk dir; finish()
+adds the entry if the read completed and the bytes match the file's hash.
+"""
+class CacheFill:
+    def __init__(self, cache, tier, filename, entry):
+        self.cache = cache
+        self.tier = tier
+        self.filename = filename
+        self.entry = entry
+        self.hasher = flask_utilities.new_hasher(entry.hash_algorithm)
+        self.received = 0
+        if tier == TIER_MEMORY:
+            self.buffer = []
+        else:
+            self.buffer = tempfile.NamedTemporaryFile(dir=cache.get_disk_dir(), delete=False)
+
+    def add(self, chunk):
+        self.hasher.update(chunk)
+        self.received += len(chunk)
+        if self.tier == TIER_MEMORY:
+            self.buffer.append(chunk)
+        else:
+            self.buffer.write(chunk)
+
+    def finish(self, is_complete):
+        entry = self.entry
+        if self.tier == TIER_DISK:
+            self.buffer.close()
+        if is_complete and self.received == entry.size and self.hasher.hexdigest() == entry.file_hash:
+            if self.tier == TIER_MEMORY:
+                entry.data = b"".join(self.buffer)
+            else:
+                entry.path = self.buffer.name
+            self.cache._add(self.tier, self.filename, entry)
+            return
+        if is_complete:
+            with self.cache.lock:
+                self.cache.stats['rejected_fills'] += 1
+        if self.tier == TIER_DISK:
+            os.remove(self.buffer.name)
+
+
+"""
+Remove the disk dirs under root of master processes which are gone, e.g.
+killed before they could remove their own
+"""
+def remove_stale_disk_dirs(root):
+    for name in os.listdir(root):
+        pid = name[len(DISK_DIR_PREFIX):]
+        if not name.startswith(DISK_DIR_PREFIX) or not pid.isdigit() or is_process_running(int(pid)):
+            continue
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+def is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # another user's
+        return True
+    return True
+
+
+def get_read_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ReadCache()
+    return _cache
@@ -0,0 +1,253 @@
+"""
+Background rebalancer moving stored copies between storage nodes
+
+Placement only decides where new files go, so nodes added to
+[storage_nodes] stay nearly empty while the old ones stay full and serve
+most reads. Every interval seconds this process compares the bytes each
+reachable node stores for the metadata (primaries, replicas, blocks and
+fragments, sized from the nodes' /inventory) with its share of all of them by
+capacity, and moves copies from the nodes above their share to the nodes
+below it. A node's primaries, which take the reads, go first while it has
+more than its share of them.
+
+A move copies the object like a replication, within the max_bandwidth budget,
+then points the metadata to the new node in one transaction if the copy is
+still where it was. GETs which looked the old node up finish from the old
+copy, which is deleted delete_delay seconds later.
+
+Run with `python rebalancer.py` (--once for a single round).
+"""
+import argparse
+import logging
+import os
+import time
+from collections import defaultdict
+
+import flask_utilities
+import http_pool
+import metadata_store
+import placement
+import replication
+import requests
+
+SCRIPT_NAME = os.path.basename(__file__)
+SN_INVENTORY_ENDPOINT = "http://{node_ip}/inventory"
+SN_DELETE_ENDPOINT = "http://{node_ip}/delete"
+SN_REQUEST_TIMEOUT = (3.05, 60)
+# copies serving the reads of their file
+READ_COPY_KINDS = (metadata_store.COPY_PRIMARY, metadata_store.COPY_BLOCK)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser(prog=SCRIPT_NAME)
+    parser.add_argument("--once", help="Run one round, wait for its deletions and exit",
+                        action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+class Move:
+    def __init__(self, kind, name, src_node, dest_node, size):
+        self.kind = kind
+        self.name = name
+        self.src_node = src_node
+        self.dest_node = dest_node
+        self.size = size
+
+    def __repr__(self):
+        return f"{self.kind} {self.name} {self.src_node} -> {self.dest_node} ({self.size} bytes)"
+
+
+def fetch_inventory(sn_node):
+    params = {'token': flask_utilities.generate_transfer_token('inventory', sn_node, '')}
+    resp = http_pool.get_session().get(url=SN_INVENTORY_ENDPOINT.format(node_ip=sn_node), params=params,
+                                       timeout=SN_REQUEST_TIMEOUT)
+    if resp.status_code != requests.codes.ok:
+        raise Exception(f"Listing the files of {sn_node} failed: {resp.status_code}")
+    return resp.json()['files']
+
+def delete_copy(name, sn_node):
+    params = {
+        'filename': name,
+        'token': flask_utilities.generate_transfer_token('delete', sn_node, name)
+    }
+    resp = http_pool.get_session().delete(url=SN_DELETE_ENDPOINT.format(node_ip=sn_node), params=params,
+                                          timeout=SN_REQUEST_TIMEOUT)
+    if resp.status_code not in (requests.codes.ok, requests.codes.not_found):
+        raise Exception(f"Deleting {name} from {sn_node} failed: {resp.status_code}")
+
+"""
+Share of total each node should hold, by its capacity (stored + free bytes)
+"""
+def get_targets(total, usage, node_loads):
+    capacities = {
+        sn_node: usage[sn_node] + (node_loads[sn_node].get('free_bytes') or 0)
+        for sn_node in usage
+    }
+    total_capacity = sum(capacities.values())
+    if not total_capacity:
+        return {sn_node: total / len(usage) for sn_node in usage}
+    return {sn_node: total * capacity / total_capacity for sn_node, capacity in capacities.items()}
+
+"""
+Moves bringing every node within tolerance of its target, largest copies first
+Only copies found in the inventory of their node are moved, and never to a
+node holding a copy of the same group already.
+"""
+def plan_moves(copies, inventories, node_loads, max_bytes):
+    usage = {sn_node: 0 for sn_node in inventories}
+    read_copies = {sn_node: 0 for sn_node in inventories}
+    holders = defaultdict(set)
+    candidates = defaultdict(list)
+    for kind, name, sn_node, group in copies:
+        holders[group].add(sn_node)
+        size = inventories.get(sn_node, {}).get(name)
+        if size is None:
+            # on a node which is down, or missing from its node
+            continue
+        usage[sn_node] += size
+        candidates[sn_node].append((kind, name, group, size))
+        if kind in READ_COPY_KINDS:
+            read_copies[sn_node] += 1
+    total = sum(usage.values())
+    if len(usage) < 2 or not total:
+        return []
+    targets = get_targets(total, usage, node_loads)
+    read_targets = get_targets(sum(read_copies.values()), read_copies, node_loads)
+    slack = flask_utilities.get_rebalancer_tolerance() * total / len(usage)
+
+    moves = []
+    moved_bytes = 0
+    sources = set(usage)
+    while sources and moved_bytes < max_bytes:
+        src_node = max(sources, key=lambda sn_node: usage[sn_node] - targets[sn_node])
+        excess = usage[src_node] - targets[src_node]
+        if excess <= slack:
+            break
+        prefer_reads = read_copies[src_node] > read_targets[src_node]
+        move = None
+        for dest_node in sorted(usage, key=lambda sn_node: usage[sn_node] - targets[sn_node]):
+            deficit = targets[dest_node] - usage[dest_node]
+            if deficit <= slack:
+                break
+            # a move never leaves either node further from its target than before
+            fitting = [
+                candidate for candidate in candidates[src_node]
+                if dest_node not in holders[candidate[2]] and candidate[3] < min(excess, deficit) * 2
+                and moved_bytes + candidate[3] <= max_bytes
+                and placement.has_free_space(node_loads[dest_node], candidate[3])
+            ]
+            if fitting:
+                kind, name, group, size = max(
+                    fitting, key=lambda candidate: ((candidate[0] in READ_COPY_KINDS) == prefer_reads, candidate[3]))
+                move = Move(kind, name, src_node, dest_node, size)
+                candidates[src_node].remove((kind, name, group, size))
+                break
+        if move is None:
+            sources.discard(src_node)
+            continue
+        moves.append(move)
+        moved_bytes += move.size
+        usage[move.src_node] -= move.size
+        usage[move.dest_node] += move.size
+        holders[group].discard(move.src_node)
+        holders[group].add(move.dest_node)
+        if move.kind in READ_COPY_KINDS:
+            read_copies[move.src_node] -= 1
+            read_copies[move.dest_node] += 1
+    return moves
+
+
+class Rebalancer:
+    def __init__(self):
+        # (due time, name, node) of the old copies of moved objects
+        self.pending_deletions = []
+        self.stats = {'rounds': 0, 'moves': 0, 'moved_bytes': 0, 'failed_moves': 0, 'deleted_copies': 0}
+
+    def run_round(self):
+        self.delete_due_copies()
+        node_loads = flask_utilities.get_sn_loads(flask_utilities.get_all_storage_nodes())
+        inventories = {}
+        for sn_node in node_loads:
+            try:
+                inventories[sn_node] = fetch_inventory(sn_node)
+            except Exception as e:
+                logger.error(f"Leaving {sn_node} out of this round: {str(e)}")
+        moves = plan_moves(
+            copies=metadata_store.get_stored_copies(),
+            inventories=inventories,
+            node_loads=node_loads,
+            max_bytes=flask_utilities.get_rebalancer_max_bytes_per_round()
+        )
+        logger.info(f"Planned {len(moves)} moves of {sum(move.size for move in moves)} bytes "
+                    f"across {len(inventories)} nodes.")
+        for move in moves:
+            self.execute_move(move)
+        self.stats['rounds'] += 1
+        self.delete_due_copies()
+
+    def execute_move(self, move):
+        start = time.perf_counter()
+        try:
+            # each move has the whole budget; moves run one after the other
+            throttle = replication.Throttle(flask_utilities.get_rebalancer_max_bandwidth())
+            replication.replicate_file(move.name, move.src_node, move.dest_node, throttle=throttle)
+            if not metadata_store.move_copy(move.kind, move.name, move.src_node, move.dest_node):
+                # stored again, moved or deleted meanwhile
+                logger.info(f"Metadata of {move.name} changed during the move; leaving it where it is.")
+                if move.dest_node not in metadata_store.get_copy_nodes(move.name):
+                    delete_copy(move.name, move.dest_node)
+                self.stats['failed_moves'] += 1
+                return
+        except Exception as e:
+            logger.error(f"Moving {move} failed: {str(e)}")
+            self.stats['failed_moves'] += 1
+            return
+        self.pending_deletions.append(
+            (time.monotonic() + flask_utilities.get_rebalancer_delete_delay(), move.name, move.src_node))
+        self.stats['moves'] += 1
+        self.stats['moved_bytes'] += move.size
+        logger.info(f"Moved {move} in {time.perf_counter() - start:.3f}s.")
+
+    """
+    Delete the old copies whose grace period is over
+    A copy the metadata points to again (e.g. moved back) is kept.
+    """
+    def delete_due_copies(self, wait=False):
+        if wait and self.pending_deletions:
+            time.sleep(max(0, max(due for due, _, _ in self.pending_deletions) - time.monotonic()))
+        now = time.monotonic()
+        due_deletions = [deletion for deletion in self.pending_deletions if deletion[0] <= now]
+        self.pending_deletions = [deletion for deletion in self.pending_deletions if deletion[0] > now]
+        for _, name, sn_node in due_deletions:
+            try:
+                if sn_node in metadata_store.get_copy_nodes(name):
+                    continue
+                delete_copy(name, sn_node)
+                self.stats['deleted_copies'] += 1
+            except Exception as e:
+                # left behind as an unreferenced file
+                logger.error(f"Deleting the old copy of {name} on {sn_node} failed: {str(e)}")
+
+
+def main():
+    args = parse_cmd_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    flask_utilities.install_config_reload_handler()
+    rebalancer = Rebalancer()
+    while True:
+        try:
+            rebalancer.run_round()
+        except Exception as e:
+            logger.error(f"Rebalancing round failed: {str(e)}")
+        if args.once:
+            rebalancer.delete_due_copies(wait=True)
+            logger.info(f"Rebalancer stats: {rebalancer.stats}")
+            break
+        logger.info(f"Rebalancer stats: {rebalancer.stats}")
+        time.sleep(flask_utilities.get_rebalancer_interval())
+
+if __name__ == "__main__":
+    main()
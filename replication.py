@@ -0,0 +1,250 @@
+import fcntl
+import os
+import time
+from contextlib import ExitStack, closing, contextmanager
+
+import compression
+import flask_utilities
+import http_pool
+import metrics
+import requests
+
+SN_DOWNLOAD_ENDPOINT = "http://{node_ip}/download"
+SN_REPLICA_ENDPOINT = "http://{node_ip}/replica"
+COPY_CHUNK_SIZE = 1024 * 1024
+SLOT_RETRY_INTERVAL = 0.1
+REPLICA_TRANSFER_TIMEOUT = (3.05, 300)
+
+
+def get_node_storage_dir(node_addr):
+    node, port = node_addr.split(':')
+    return os.path.join(flask_utilities.get_replication_storage_root(), f"storage_{node}_{port}")
+
+
+"""
+Limits the rate of one transfer to bytes_per_sec (0 means unlimited)
+"""
+class Throttle:
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self.start = time.monotonic()
+        self.sent = 0
+
+    def consume(self, num_bytes):
+        if not self.bytes_per_sec:
+            return
+        self.sent += num_bytes
+        ahead_by = self.sent / self.bytes_per_sec - (time.monotonic() - self.start)
+        if ahead_by > 0:
+            time.sleep(ahead_by)
+
+
+"""
+Hold one of the max_concurrency_per_node transfer slots of node_addr
+Slots are lock files shared by all the worker processes on this machine,
+so the limit holds across the Celery worker pool.
+"""
+@contextmanager
+def node_transfer_slot(node_addr):
+    max_slots = flask_utilities.get_replication_max_concurrency_per_node()
+    slots_dir = flask_utilities.get_replication_slots_dir()
+    flask_utilities.create_storage_dir(slots_dir)
+    node_slug = node_addr.replace(':', '_')
+    while True:
+        for slot in range(max_slots):
+            slot_file = open(os.path.join(slots_dir, f"{node_slug}.{slot}.lock"), "w")
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                slot_file.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(slot_file, fcntl.LOCK_UN)
+                slot_file.close()
+            return
+        time.sleep(SLOT_RETRY_INTERVAL)
+
+@contextmanager
+def node_transfer_slots(*node_addrs):
+    # always lock nodes in the same order so two transfers can't wait on each other
+    with ExitStack() as stack:
+        for node_addr in sorted(set(node_addrs)):
+            stack.enter_context(node_transfer_slot(node_addr))
+        yield
+
+def get_transfer_throttle():
+    # the node's bandwidth is shared by the transfers holding its slots
+    max_bandwidth = flask_utilities.get_replication_max_bandwidth_per_node()
+    max_slots = flask_utilities.get_replication_max_concurrency_per_node()
+    return Throttle(max_bandwidth / max_slots if max_bandwidth else 0)
+
+"""
+Copy src_filepath to dest_filepath inside the kernel
+Uses copy_file_range (falling back to sendfile) so the data never passes
+through user space. The copy is written to a .part file, which verify (if
+given) may check and reject by raising, and is removed if the copy fails.
+"""
+def zero_copy_file(src_filepath, dest_filepath, throttle, verify=None):
+    tmp_filepath = f"{dest_filepath}.part"
+    try:
+        with open(src_filepath, "rb") as src, open(tmp_filepath, "wb") as dest:
+            remaining = os.fstat(src.fileno()).st_size
+            offset = 0
+            use_copy_file_range = hasattr(os, 'copy_file_range')
+            while remaining > 0:
+                count = min(COPY_CHUNK_SIZE, remaining)
+                copied = None
+                if use_copy_file_range:
+                    try:
+                        # explicit offsets; sendfile below doesn't move the source's file position
+                        copied = os.copy_file_range(src.fileno(), dest.fileno(), count, offset, offset)
+                    except OSError:
+                        # e.g. EXDEV on older kernels when crossing file systems
+                        use_copy_file_range = False
+                if copied is None:
+                    # sendfile writes at the destination's file position
+                    os.lseek(dest.fileno(), offset, os.SEEK_SET)
+                    copied = os.sendfile(dest.fileno(), src.fileno(), offset, count)
+                if copied == 0:
+                    raise Exception(f"{src_filepath} was cut short while copied: {remaining} bytes missing.")
+                offset += copied
+                remaining -= copied
+                throttle.consume(copied)
+        if verify is not None:
+            verify(tmp_filepath)
+        os.replace(tmp_filepath, dest_filepath)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+def copy_checksum_file(src_dir, dest_dir, filename):
+    src_checksum_filepath = flask_utilities.get_checksum_filepath(src_dir, filename)
+    dest_checksum_filepath = flask_utilities.get_checksum_filepath(dest_dir, filename)
+    flask_utilities.create_storage_dir(os.path.dirname(dest_checksum_filepath))
+    zero_copy_file(src_checksum_filepath, dest_checksum_filepath, Throttle(0))
+
+"""
+Hash of the content of a stored file, decompressed if it is stored with encoding
+"""
+def calc_stored_file_hash(filepath, algorithm, encoding=None):
+    hasher = flask_utilities.new_hasher(algorithm)
+    with open(filepath, "rb") as fp:
+        byte_blocks = iter(lambda: fp.read(flask_utilities.HASH_READ_CHUNK_SIZE), b"")
+        for data in compression.decompress_stream(byte_blocks, encoding) if encoding else byte_blocks:
+            hasher.update(data)
+    return hasher.hexdigest()
+
+"""
+Copy filename between the storage dirs of two nodes mounted here
+The copy is hashed before it replaces anything on the destination and is
+dropped if it doesn't match the source's checksum, as an SN drops a
+replica sent over the network which doesn't.
+"""
+def copy_local(filename, src_node_addr, dest_node_addr, throttle=None):
+    src_dir = get_node_storage_dir(src_node_addr)
+    dest_dir = get_node_storage_dir(dest_node_addr)
+    src_filepath = os.path.join(src_dir, filename)
+    flask_utilities.create_storage_dir(dest_dir)
+    checksum = flask_utilities.read_checksum_file(src_dir, filename)
+    if checksum is None:
+        # stored before checksums were persisted
+        hash_algorithm = flask_utilities.get_hash_algorithm()
+        checksum = {
+            'hash_algorithm': hash_algorithm,
+            'file_hash': flask_utilities.calc_file_hash(src_filepath, hash_algorithm)
+        }
+
+    def verify(copy_filepath):
+        copy_hash = calc_stored_file_hash(copy_filepath, checksum['hash_algorithm'], checksum.get('encoding'))
+        if copy_hash != checksum['file_hash']:
+            raise Exception(f"The copy of {filename} to {dest_node_addr} doesn't match its hash.")
+
+    zero_copy_file(
+        src_filepath=src_filepath,
+        dest_filepath=os.path.join(dest_dir, filename),
+        throttle=throttle or get_transfer_throttle(),
+        verify=verify
+    )
+    # the checksum travels with the file so the replica never has to re-hash it
+    if os.path.exists(flask_utilities.get_checksum_filepath(src_dir, filename)):
+        copy_checksum_file(src_dir, dest_dir, filename)
+
+"""
+File-like view of a response body of known length
+Lets requests send it with a Content-Length instead of buffering it.
+"""
+class SizedStream:
+    def __init__(self, raw, length, throttle=None):
+        self.raw = raw
+        self.length = length
+        self.throttle = throttle or Throttle(0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(lambda: self.read(COPY_CHUNK_SIZE), b"")
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+def copy_over_network(filename, src_node_addr, dest_node_addr, throttle=None):
+    download_params = {
+        'filename': filename,
+        'token': flask_utilities.generate_transfer_token('download', src_node_addr, filename)
+    }
+    # a file stored compressed is copied as it is, never inflated on the wire
+    download_headers = {
+        flask_utilities.ACCEPT_FILE_ENCODING_HEADER: ', '.join(compression.get_available_encodings())
+    }
+    src_url = SN_DOWNLOAD_ENDPOINT.format(node_ip=src_node_addr)
+    with closing(http_pool.get_session().get(url=src_url, params=download_params, headers=download_headers,
+                                             stream=True, timeout=REPLICA_TRANSFER_TIMEOUT)) as src_resp:
+        if src_resp.status_code != requests.codes.ok:
+            raise Exception(f"Reading {filename} from {src_node_addr} failed: {src_resp.status_code}")
+        replica_params = {
+            'filename': filename,
+            'file_hash': src_resp.headers['file_hash'],
+            'hash_algorithm': src_resp.headers.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM),
+            'token': flask_utilities.generate_transfer_token('upload', dest_node_addr, filename)
+        }
+        file_encoding = src_resp.headers.get(flask_utilities.FILE_ENCODING_HEADER)
+        if file_encoding:
+            replica_params['file_encoding'] = file_encoding
+        body = SizedStream(
+            raw=src_resp.raw,
+            length=int(src_resp.headers['Content-Length']),
+            throttle=throttle or get_transfer_throttle()
+        )
+        dest_url = SN_REPLICA_ENDPOINT.format(node_ip=dest_node_addr)
+        dest_resp = http_pool.get_session().put(url=dest_url, params=replica_params, data=body,
+                                                timeout=REPLICA_TRANSFER_TIMEOUT)
+        if dest_resp.status_code != requests.codes.ok:
+            raise Exception(f"Writing {filename} to {dest_node_addr} failed: {dest_resp.status_code}")
+
+def is_local_copy_possible(filename, src_node_addr, dest_node_addr):
+    src_dir = get_node_storage_dir(src_node_addr)
+    dest_dir = get_node_storage_dir(dest_node_addr)
+    return os.path.isfile(os.path.join(src_dir, filename)) and os.path.isdir(dest_dir)
+
+"""
+Copy filename from one storage node to another
+Uses an in-kernel copy when both nodes' storage is mounted here (shared docker
+volume) and streams SN to SN over HTTP otherwise. throttle replaces the
+per-node bandwidth limit of replication, e.g. with the rebalancer's budget.
+"""
+def replicate_file(filename, src_node_addr, dest_node_addr, throttle=None):
+    slot_wait_start = time.perf_counter()
+    with node_transfer_slots(src_node_addr, dest_node_addr):
+        metrics.observe_stage('replication_slot_wait', time.perf_counter() - slot_wait_start)
+        if is_local_copy_possible(filename, src_node_addr, dest_node_addr):
+            with metrics.stage_timer('replication_copy_local'):
+                copy_local(filename, src_node_addr, dest_node_addr, throttle)
+        else:
+            with metrics.stage_timer('replication_copy_network'):
+                copy_over_network(filename, src_node_addr, dest_node_addr, throttle)
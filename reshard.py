@@ -0,0 +1,105 @@
+"""
+Move the metadata rows to their shards after [metadata] shards changed
+
+To grow the metadata from N to N+1 shards: copy the current list to
+previous_shards, add the new file to shards, run `python one_time_setup.py` to
+create it and then `python reshard.py`. The masters pick the new list up from
+dfs.cfg; until the rows are moved they look a name up in its shard under both
+lists and check new names against both, so they keep serving. Only the ~1/N of
+the names the new shard takes over are moved. Empty previous_shards when done.
+
+The rows of a filename (in every table keyed by it) are written to its new
+shard and then deleted from the old one while both shards' write locks are
+held, taken in name order like every other multi-shard transaction, so no
+update of them is lost in between. Replication rows move by the name of the
+copy they record (a file, block or fragment), which is what they are sharded
+by, and content index rows by content hash, the same way.
+"""
+import argparse
+import logging
+import os
+
+import flask_utilities
+import metadata_store
+
+SCRIPT_NAME = os.path.basename(__file__)
+# keys moved per transaction
+BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser(prog=SCRIPT_NAME)
+    parser.add_argument("--dry-run", help="Only count the keys which are in the wrong shard",
+                        action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+"""
+Move the rows of tables matching where with each of params_list from
+src_shard to dest_shard
+"""
+def move_rows(src_shard, dest_shard, tables, where, params_list):
+    # locked in name order, so a concurrent run or a master locking several shards can't deadlock with it
+    with metadata_store.transactions([src_shard, dest_shard]) as conns:
+        src_conn, dest_conn = conns[src_shard], conns[dest_shard]
+        for table in tables:
+            for params in params_list:
+                rows = src_conn.execute(f"SELECT * FROM {table} WHERE {where};", params).fetchall()
+                if rows:
+                    placeholders = ", ".join("?" * len(rows[0]))
+                    # rows written to the new shard meanwhile are newer
+                    dest_conn.executemany(f"INSERT OR IGNORE INTO {table} VALUES ({placeholders});", rows)
+        for table in tables:
+            src_conn.executemany(f"DELETE FROM {table} WHERE {where};", params_list)
+
+"""
+Move the rows of src_shard whose key belongs to another shard
+Returns the number of keys which were in the wrong shard.
+"""
+def reshard(src_shard, tables, where, key_sql, get_key, dry_run=False):
+    keys = metadata_store.get_connection(src_shard).execute(key_sql).fetchall()
+    stray = {}
+    for params in keys:
+        dest_shard = metadata_store.get_shard(get_key(params))
+        if dest_shard != src_shard:
+            stray.setdefault(dest_shard, []).append(params)
+    if dry_run:
+        return sum(len(params_list) for params_list in stray.values())
+    for dest_shard, params_list in stray.items():
+        for start in range(0, len(params_list), BATCH_SIZE):
+            move_rows(src_shard, dest_shard, tables, where, params_list[start:start + BATCH_SIZE])
+        logger.info(f"Moved {len(params_list)} keys from {src_shard} to {dest_shard}.")
+    return sum(len(params_list) for params_list in stray.values())
+
+"""
+Move every row of shard whose key belongs to another shard
+Returns the numbers of filenames, replicated names and contents moved.
+"""
+def reshard_shard(shard, dry_run=False):
+    file_tables = tuple(table for table in metadata_store.FILENAME_TABLES if table != 'replication_data')
+    filename_sql = " UNION ".join(f"SELECT filename FROM {table}" for table in file_tables)
+    num_filenames = reshard(shard, file_tables, "filename=?", f"{filename_sql};",
+                            lambda params: params[0], dry_run)
+    num_replicas = reshard(shard, ('replication_data',), "filename=?",
+                           "SELECT DISTINCT filename FROM replication_data;",
+                           lambda params: params[0], dry_run)
+    num_contents = reshard(shard, ('content_index',), "hash_algorithm=? AND file_hash=?",
+                           "SELECT hash_algorithm, file_hash FROM content_index;",
+                           lambda params: metadata_store.get_content_key(*params), dry_run)
+    return num_filenames, num_replicas, num_contents
+
+def main():
+    args = parse_cmd_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s in %(module)s: %(message)s")
+    if not flask_utilities.get_metadata_previous_shards():
+        logger.warning("[metadata] previous_shards is empty: masters may miss the names being moved.")
+    for shard in metadata_store.get_all_shards():
+        num_filenames, num_replicas, num_contents = reshard_shard(shard, args.dry_run)
+        logger.info(f"{shard}: {num_filenames} filenames, {num_replicas} replicated names and {num_contents} contents "
+                    f"{'to move' if args.dry_run else 'moved'}.")
+
+if __name__ == "__main__":
+    main()
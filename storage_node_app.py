@@ -1,89 +1,606 @@
+import io
 import os
-import random
+import shutil
+import threading
+import time
+from collections import defaultdict
 
+import compression
 import flask_utilities
+import metrics
+import multipart_stream
+import placement
+import volume_store
 from celery import Celery
-from flask import Flask, jsonify, request, send_from_directory
+from health_registry import get_health_registry
+from flask import Flask, Response, g, jsonify, request, safe_join, send_from_directory
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound, RequestedRangeNotSatisfiable
+from werkzeug.serving import WSGIRequestHandler
+from werkzeug.wsgi import ClosingIterator
 
 MY_NODE = os.environ['NODE']
 MY_PORT = os.environ['PORT']
 STORAGE_DIR = f"storage_{MY_NODE}_{MY_PORT}"
-CELERY_BROKER_URL = 'redis://redis:6379/0'
-CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+# weight of the latest request in the moving average of the request latency
+LATENCY_EWMA_WEIGHT = 0.2
+# a batch whose replication task can't be sent is queued again after a backoff
+# doubling from REPLICATION_RETRY_BACKOFF seconds, up to MAX_REPLICATION_SEND_ATTEMPTS sends
+REPLICATION_RETRY_BACKOFF = 1
+MAX_REPLICATION_RETRY_BACKOFF = 60
+MAX_REPLICATION_SEND_ATTEMPTS = 8
+PACKED_FILES = metrics.Gauge('dfs_packed_files', "Files stored in the volumes of this node.")
+PACKED_BYTES = metrics.Gauge('dfs_packed_bytes', "Bytes of the volumes of this node, all and still referenced.")
+PACKING_EVENTS = metrics.Gauge('dfs_packing_events_total', "Files packed and read, volumes compacted.", 'counter')
+
+replication_queue = []
+replication_queue_lock = threading.Condition()
+replication_thread = None
+request_stats = {'in_flight_requests': 0, 'latency_ms': 0.0}
+request_stats_lock = threading.Lock()
 
 app = Flask(__name__)
+# HTTP/1.0 closes the connection after every response, defeating the callers' keep-alive pools
+WSGIRequestHandler.protocol_version = "HTTP/1.1"
+flask_utilities.install_config_reload_handler()
 celery = Celery('tasks',
-                broker=CELERY_BROKER_URL,
-                backend=CELERY_RESULT_BACKEND)
+                broker=flask_utilities.get_celery_broker_url(),
+                backend=flask_utilities.get_celery_result_backend())
+celery.conf.broker_transport = flask_utilities.get_celery_broker_transport()
+celery.conf.broker_transport_options = flask_utilities.get_celery_broker_transport_options()
+
+
+@app.before_request
+def track_request_start():
+    g.request_timer_start = time.perf_counter()
+    # carried on into the replication task of an uploaded file
+    metrics.set_trace_id(request.headers.get(metrics.TRACE_ID_HEADER) or metrics.new_trace_id())
+    if request.endpoint in ('health', 'metrics_endpoint'):
+        return
+    g.request_started_at = time.monotonic()
+    with request_stats_lock:
+        request_stats['in_flight_requests'] += 1
+
+@app.after_request
+def observe_request(resp):
+    if 'request_timer_start' in g:
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - g.request_timer_start,
+            endpoint=request.endpoint or 'unknown',
+            status=resp.status_code
+        )
+    resp.headers[metrics.TRACE_ID_HEADER] = metrics.get_trace_id() or ''
+    return resp
 
+@app.teardown_request
+def track_request_end(exc):
+    if 'request_started_at' not in g:
+        return
+    latency_ms = (time.monotonic() - g.request_started_at) * 1000
+    with request_stats_lock:
+        request_stats['in_flight_requests'] -= 1
+        request_stats['latency_ms'] += LATENCY_EWMA_WEIGHT * (latency_ms - request_stats['latency_ms'])
 
+
+"""
+Liveness probe of the master
+Also reports the load of this node, which the master places files by.
+"""
 @app.route('/health', methods=['GET'])
 def health():
-    data = {
-        'message': 'Server is running'
-    }
+    flask_utilities.create_storage_dir(STORAGE_DIR)
+    disk_usage = shutil.disk_usage(STORAGE_DIR)
+    with request_stats_lock:
+        data = {
+            'message': 'Server is running',
+            'free_bytes': disk_usage.free,
+            'total_bytes': disk_usage.total,
+            'in_flight_requests': request_stats['in_flight_requests'],
+            'latency_ms': round(request_stats['latency_ms'], 3)
+        }
     resp = jsonify(data)
     resp.status_code = 200
     return resp
 
+"""
+Timings of this node in the Prometheus text format
+"""
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    store = get_volume_store()
+    if store is not None:
+        packing_stats = store.get_stats()
+        PACKED_FILES.set(packing_stats['files'])
+        PACKED_BYTES.set(packing_stats['volume_bytes'], kind='volume')
+        PACKED_BYTES.set(packing_stats['live_bytes'], kind='live')
+        for event in ('puts', 'reads', 'compactions'):
+            PACKING_EVENTS.set(packing_stats[event], event=event)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 
 @app.route('/upload', methods=['POST'])
 def upload():
+    storage_filepath = None
+    reader = None
     try:
         flask_utilities.create_storage_dir(STORAGE_DIR)
-        fp = request.files['input_file']
-        file_hash = request.form['file_hash']
-        filename = request.form['filename']
-        storage_filepath = os.path.join(STORAGE_DIR, filename)
-        fp.save(storage_filepath)
-        is_file_valid = flask_utilities.is_file_integrity_matched(
-            filepath=storage_filepath,
-            recvd_hash=file_hash
-        )
-        if is_file_valid:
-            app.logger.debug(f"File {storage_filepath} saved and integrity verified.")
-            resp = jsonify({'message': f"File {storage_filepath} saved successfully."})
-            resp.status_code = 200
+        boundary = multipart_stream.get_boundary(request)
+        if not boundary:
+            raise ValueError("Expected a multipart/form-data body.")
+        # the file is written as it arrives instead of being spooled first
+        reader = multipart_stream.MultipartReader(request.stream, boundary)
+        form, file_part = reader.read_fields()
+        if file_part is None or file_part[0] != 'input_file':
+            raise ValueError("The form fields must be followed by the input_file part.")
+        file_hash = form['file_hash']
+        filename = form['filename']
+        storage_filepath = get_storage_filepath(filename)
+        if not is_transfer_authorized(filename=filename, operation='upload', args=form):
+            return transfer_forbidden_response(filename)
+        hash_algorithm = form.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        # the client may send the file already compressed; else the cluster codec applies
+        file_encoding = form.get('file_encoding') or None
+        # hash while writing to disk instead of reading the file back
+        with metrics.stage_timer('sn_upload_save'):
+            file_size = save_file(
+                fp=reader,
+                filename=filename,
+                # the multipart body is a little larger than the file; a master
+                # streaming the upload through passes the size of the client's
+                size_hint=request.content_length or int(form.get('size_hint', 0)) or None,
+                expected_hash=file_hash,
+                algorithm=hash_algorithm,
+                encoding=file_encoding,
+                compress_with=None if file_encoding else flask_utilities.get_compression_codec()
+            )
+        metrics.STAGE_BYTES.inc(file_size, stage='sn_upload_save')
+        app.logger.debug(f"File {storage_filepath} saved and integrity verified.")
+        # the original size, recorded by the master
+        resp = jsonify({'message': f"File {storage_filepath} saved successfully.", 'file_size': file_size})
+        resp.status_code = 200
+        # erasure-coded fragments are redundant already
+        if form.get('replicate', 'true') == 'true':
             add_replication_to_queue(filename)
     except Exception as e:
         resp = jsonify({
             'message': f"Error while saving {storage_filepath}: {str(e)}"
         })
+        # a filename reaching outside the storage dir is a 400
+        resp.status_code = e.code if isinstance(e, HTTPException) else 500
+    finally:
+        if reader is not None:
+            # leave the connection ready for the next request
+            reader.drain()
+    return resp
+
+"""
+Store a replica pushed by the replication worker
+The body is the file as stored on the source node, compressed with the
+file_encoding param if given; it is verified like an upload but not
+replicated further.
+"""
+@app.route('/replica', methods=['PUT'])
+def replica():
+    try:
+        flask_utilities.create_storage_dir(STORAGE_DIR)
+        filename = request.args['filename']
+        file_hash = request.args['file_hash']
+        hash_algorithm = request.args.get('hash_algorithm', flask_utilities.DEFAULT_HASH_ALGORITHM)
+        storage_filepath = get_storage_filepath(filename)
+        if not is_transfer_authorized(filename=filename, operation='upload'):
+            return transfer_forbidden_response(filename)
+        with metrics.stage_timer('sn_replica_save'):
+            file_size = save_file(
+                fp=request.stream,
+                filename=filename,
+                size_hint=request.content_length,
+                expected_hash=file_hash,
+                algorithm=hash_algorithm,
+                encoding=request.args.get('file_encoding') or None
+            )
+        metrics.STAGE_BYTES.inc(file_size, stage='sn_replica_save')
+        app.logger.debug(f"Replica {storage_filepath} saved and integrity verified.")
+        resp = jsonify({'message': f"Replica {storage_filepath} saved successfully."})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({
+            'message': f"Error while saving replica {request.args.get('filename')}: {str(e)}"
+        })
+        resp.status_code = e.code if isinstance(e, HTTPException) else 500
+    return resp
+
+"""
+Delete a stored file, e.g. a copy the rebalancer moved to another node
+"""
+@app.route('/delete', methods=['DELETE'])
+def delete():
+    try:
+        filename = request.args['filename']
+        if not is_transfer_authorized(filename=filename, operation='delete'):
+            return transfer_forbidden_response(filename)
+        is_deleted = False
+        for filepath in (get_storage_filepath(filename), flask_utilities.get_checksum_filepath(STORAGE_DIR, filename)):
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+                is_deleted = True
+        store = get_volume_store()
+        if store is not None and store.delete(filename):
+            is_deleted = True
+        if is_deleted:
+            app.logger.info(f"Deleted {filename}.")
+            resp = jsonify({'message': f"File {filename} deleted."})
+            resp.status_code = 200
+        else:
+            resp = jsonify({'message': f"{filename} is not stored on this node."})
+            resp.status_code = 404
+    except Exception as e:
+        resp = jsonify({
+            'message': f"Error while deleting {request.args.get('filename')}: {str(e)}"
+        })
+        resp.status_code = e.code if isinstance(e, HTTPException) else 500
+    return resp
+
+"""
+Checksum of a stored file, plain or packed: its hash, hash algorithm and
+original size, which the master checks a direct upload's commit against
+"""
+@app.route('/stat', methods=['GET'])
+def stat():
+    try:
+        filename = request.args['filename']
+        if not is_transfer_authorized(filename=filename, operation='stat'):
+            return transfer_forbidden_response(filename)
+        if os.path.isfile(get_storage_filepath(filename)):
+            checksum = get_file_checksum(filename)
+        else:
+            store = get_volume_store()
+            checksum = store.get_checksum(filename) if store is not None else None
+            if checksum is None:
+                raise NotFound()
+        resp = jsonify(checksum)
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({
+            'message': f"Error while reading the checksum of {request.args.get('filename')}: {str(e)}"
+        })
+        resp.status_code = e.code if isinstance(e, HTTPException) else 500
+    return resp
+
+"""
+Stored size of every file on this node, plain or packed
+"""
+@app.route('/inventory', methods=['GET'])
+def inventory():
+    try:
+        if not is_transfer_authorized(filename='', operation='inventory'):
+            return transfer_forbidden_response('the inventory')
+        flask_utilities.create_storage_dir(STORAGE_DIR)
+        files = {}
+        store = get_volume_store()
+        if store is not None:
+            files.update(store.list_files())
+        with os.scandir(STORAGE_DIR) as entries:
+            for entry in entries:
+                # a plain file takes precedence over a packed one of the same name
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    files[entry.name] = entry.stat().st_size
+        resp = jsonify({'files': files})
+        resp.status_code = 200
+    except Exception as e:
+        resp = jsonify({'message': f"Error while listing {STORAGE_DIR}: {str(e)}"})
         resp.status_code = 500
     return resp
 
+"""
+Store a file of the upload or replica request being handled, with its checksum
+Files of up to size_hint bytes are packed into a volume if packing is on;
+the version stored last, packed or plain, replaces the other.
+Returns the size of the original content.
+"""
+def save_file(fp, filename, size_hint, expected_hash, algorithm, encoding=None, compress_with=None):
+    store = get_volume_store()
+    storage_filepath = get_storage_filepath(filename)
+    if should_pack(size_hint):
+        buffer = io.BytesIO()
+        file_size, stored_encoding = flask_utilities.write_stream_with_hash(
+            fp, buffer, expected_hash, algorithm, encoding, compress_with)
+        store.put(filename, buffer.getvalue(),
+                  flask_utilities.make_checksum(algorithm, expected_hash, file_size, stored_encoding))
+        for filepath in (storage_filepath, flask_utilities.get_checksum_filepath(STORAGE_DIR, filename)):
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        return file_size
+    file_size, stored_encoding = flask_utilities.save_stream_with_hash(
+        fp, storage_filepath, expected_hash, algorithm, encoding, compress_with)
+    flask_utilities.write_checksum_file(STORAGE_DIR, filename, algorithm, expected_hash, file_size, stored_encoding)
+    if store is not None:
+        store.delete(filename)
+    return file_size
+
+def should_pack(size_hint):
+    return (flask_utilities.is_packing_enabled() and size_hint is not None
+            and size_hint <= flask_utilities.get_packing_max_file_size())
+
+"""
+Path of filename in the storage dir
+Raises BadRequest for a name reaching outside of it, e.g. with "../".
+"""
+def get_storage_filepath(filename):
+    try:
+        return safe_join(STORAGE_DIR, filename)
+    except NotFound:
+        raise BadRequest(f"Invalid filename {filename}.")
+
+"""
+Volume store of this node, or None if nothing was ever packed here
+Packed files stay readable after packing is turned off.
+"""
+def get_volume_store():
+    if flask_utilities.is_packing_enabled() or os.path.isdir(os.path.join(STORAGE_DIR, volume_store.VOLUME_DIR)):
+        return volume_store.get_volume_store(STORAGE_DIR)
+    return None
+
+"""
+Size of filename as stored on this node
+"""
+def get_stored_size(filename):
+    storage_filepath = get_storage_filepath(filename)
+    if os.path.isfile(storage_filepath):
+        return os.path.getsize(storage_filepath)
+    store = get_volume_store()
+    stored_size = store.get_stored_size(filename) if store is not None else None
+    if stored_size is None:
+        raise FileNotFoundError(f"{filename} is not stored on this node.")
+    return stored_size
+
+"""
+Send a stored file
+A compressed file is sent as it is stored, with the file_encoding header, if
+the caller accepts its codec (accept_file_encoding header) and asked for the
+whole file. Otherwise it is decompressed on the fly, so callers which don't
+know about compression and Range requests always get the original bytes.
+"""
 @app.route('/download', methods=['GET'])
 def download():
+    storage_filepath = None
     try:
         flask_utilities.create_storage_dir(STORAGE_DIR)
         filename = request.args['filename']
-        storage_filepath = os.path.join(STORAGE_DIR, filename)
-        resp = send_from_directory(
-            directory=STORAGE_DIR,
-            filename=filename
-        )
-        file_hash = flask_utilities.calc_file_md5(filepath=storage_filepath)
-        resp.headers['file_hash'] = file_hash
+        storage_filepath = get_storage_filepath(filename)
+        if not is_transfer_authorized(filename=filename, operation='download'):
+            return transfer_forbidden_response(filename)
+        packed = None
+        if not os.path.isfile(storage_filepath):
+            store = get_volume_store()
+            packed = store.read(filename) if store is not None else None
+            if packed is None:
+                raise NotFound()
+        data, checksum = packed if packed else (None, get_file_checksum(filename))
+        encoding = checksum.get('encoding')
+        accepted_encodings = compression.parse_accepted_encodings(
+            request.headers.get(flask_utilities.ACCEPT_FILE_ENCODING_HEADER))
+        if encoding and (request.range or encoding not in accepted_encodings):
+            byte_blocks = [data] if packed else iter_file_blocks(storage_filepath)
+            resp = send_decompressed(byte_blocks, encoding, checksum['file_size'])
+        elif packed:
+            resp = Response(data, mimetype='application/octet-stream')
+            resp.make_conditional(request, accept_ranges=True, complete_length=len(data))
+            if encoding:
+                resp.headers[flask_utilities.FILE_ENCODING_HEADER] = encoding
+        else:
+            # conditional responses honour Range and answer 206 with just those bytes
+            # Flask resolves a relative directory against the app's root, not the working dir
+            resp = send_from_directory(
+                directory=os.path.abspath(STORAGE_DIR),
+                filename=filename,
+                conditional=True
+            )
+            if encoding:
+                resp.headers[flask_utilities.FILE_ENCODING_HEADER] = encoding
+        resp.headers['file_hash'] = checksum['file_hash']
+        resp.headers['hash_algorithm'] = checksum['hash_algorithm']
+        time_download_send(resp)
     except Exception as e:
         resp = jsonify({
             'message': f"Error while saving {storage_filepath}: {str(e)}"
         })
-        resp.status_code = 500
+        # keep the status of e.g. a missing file (404) or a range past its end (416)
+        resp.status_code = e.code if isinstance(e, HTTPException) else 500
     return resp
 
+"""
+Time sending the body of a download, which happens after the view returns
+"""
+def time_download_send(resp):
+    start = time.perf_counter()
+    stage = 'sn_download_send' if resp.status_code == 200 else 'sn_download_send_range'
+    num_bytes = resp.content_length
+
+    def observe():
+        metrics.observe_stage(stage, time.perf_counter() - start, num_bytes)
+    if resp.direct_passthrough:
+        # werkzeug hands a passed-through file to the server without the close callbacks
+        resp.response = ClosingIterator(resp.response, observe)
+    else:
+        resp.call_on_close(observe)
+
+"""
+Stream the original content of a compressed file, or the requested range of it
+byte_blocks is the stored file.
+"""
+def send_decompressed(byte_blocks, encoding, file_size):
+    start, stop = 0, file_size
+    is_partial = request.range is not None and len(request.range.ranges) == 1
+    if is_partial:
+        content_range = request.range.range_for_length(file_size)
+        if content_range is None:
+            raise RequestedRangeNotSatisfiable(length=file_size)
+        start, stop = content_range
+
+    def generate():
+        offset = 0
+        for data in compression.decompress_stream(byte_blocks, encoding):
+            if offset + len(data) > start:
+                yield data[max(start - offset, 0):stop - offset]
+            offset += len(data)
+            if offset >= stop:
+                break
+
+    resp = Response(generate(), status=206 if is_partial else 200, mimetype='application/octet-stream')
+    resp.headers['Content-Length'] = str(stop - start)
+    resp.headers['Accept-Ranges'] = 'bytes'
+    if is_partial:
+        resp.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{file_size}"
+    return resp
+
+def iter_file_blocks(filepath):
+    with open(filepath, "rb") as fp:
+        yield from iter(lambda: fp.read(flask_utilities.HASH_READ_CHUNK_SIZE), b"")
+
+def get_file_checksum(filename):
+    checksum = flask_utilities.read_checksum_file(STORAGE_DIR, filename)
+    if checksum:
+        return checksum
+    # stored before checksums were persisted; hash once and keep it
+    storage_filepath = get_storage_filepath(filename)
+    hash_algorithm = flask_utilities.get_hash_algorithm()
+    file_hash = flask_utilities.calc_file_hash(storage_filepath, hash_algorithm)
+    file_size = os.path.getsize(storage_filepath)
+    flask_utilities.write_checksum_file(STORAGE_DIR, filename, hash_algorithm, file_hash, file_size)
+    return {'hash_algorithm': hash_algorithm, 'file_hash': file_hash, 'file_size': file_size}
+
+"""
+The token is read from args if given (the fields of a streamed form), else
+from the query string or form
+"""
+def is_transfer_authorized(filename, operation, args=None):
+    token = (args if args is not None else request.values).get('token')
+    if token is None and not flask_utilities.is_token_required():
+        return True
+    return flask_utilities.is_transfer_token_valid(
+        token=token,
+        operation=operation,
+        sn_node=f"{MY_NODE}:{MY_PORT}",
+        filename=filename
+    )
+
+def transfer_forbidden_response(filename):
+    app.logger.error(f"Rejected transfer of {filename}: missing or invalid token.")
+    resp = jsonify({'message': f"Missing or invalid transfer token for {filename}."})
+    resp.status_code = 403
+    return resp
+
+"""
+Queue filename for replication
+Files are replicated in batches: one task per batch_size files or per
+batch_interval seconds, whichever comes first. The trace id of the upload
+travels with the file to the replication task.
+"""
 def add_replication_to_queue(filename):
+    global replication_thread
+    with replication_queue_lock:
+        replication_queue.append((filename, metrics.get_trace_id(), time.perf_counter(), 0))
+        if replication_thread is None:
+            replication_thread = threading.Thread(target=replication_queue_worker, daemon=True)
+            replication_thread.start()
+        # wakes the worker up for a new batch; a partial batch still waits out batch_interval
+        replication_queue_lock.notify()
+
+def replication_queue_worker():
+    while True:
+        with replication_queue_lock:
+            replication_queue_lock.wait_for(lambda: replication_queue)
+            # give the batch a chance to fill up
+            replication_queue_lock.wait_for(
+                lambda: len(replication_queue) >= flask_utilities.get_replication_batch_size(),
+                timeout=flask_utilities.get_replication_batch_interval()
+            )
+            batch_size = flask_utilities.get_replication_batch_size()
+            batch = replication_queue[:batch_size]
+            del replication_queue[:batch_size]
+        filenames = [filename for filename, _, _, _ in batch]
+        trace_ids = [trace_id for _, trace_id, _, _ in batch]
+        for _, _, enqueued_at, attempts in batch:
+            if not attempts:
+                metrics.observe_stage('sn_replication_queue_wait', time.perf_counter() - enqueued_at)
+        try:
+            with metrics.stage_timer('sn_replication_send_task'):
+                unsent_filenames = set(send_replication_batch(filenames, trace_ids))
+        except Exception as e:
+            app.logger.error(f"Could not queue replication of {filenames}: {str(e)}")
+            unsent_filenames = set(filenames)
+        if unsent_filenames:
+            requeue_replication([entry for entry in batch if entry[0] in unsent_filenames])
+
+"""
+Queue again the (filename, trace_id, enqueued_at, attempts) entries whose
+replication task wasn't sent, after a backoff
+Files which failed MAX_REPLICATION_SEND_ATTEMPTS times are given up on and
+stay with their primary copy only.
+"""
+def requeue_replication(entries):
+    retries = [(filename, trace_id, enqueued_at, attempts + 1) for filename, trace_id, enqueued_at, attempts in entries
+               if attempts + 1 < MAX_REPLICATION_SEND_ATTEMPTS]
+    given_up = [filename for filename, _, _, attempts in entries if attempts + 1 >= MAX_REPLICATION_SEND_ATTEMPTS]
+    if given_up:
+        app.logger.error(f"Giving up on replicating {given_up} after {MAX_REPLICATION_SEND_ATTEMPTS} attempts.")
+    if not retries:
+        return
+    attempts = max(attempts for _, _, _, attempts in retries)
+    backoff = min(REPLICATION_RETRY_BACKOFF * 2 ** (attempts - 1), MAX_REPLICATION_RETRY_BACKOFF)
+    app.logger.warning(f"Retrying the replication of {[filename for filename, _, _, _ in retries]} in {backoff}s.")
+    # the worker waits out the backoff; whatever made the send fail likely holds for the next batch too
+    time.sleep(backoff)
+    with replication_queue_lock:
+        replication_queue[:0] = retries
+
+"""
+Send replication tasks for a batch of files stored on this node
+The replica nodes are chosen from the loads the health registry keeps
+cached. Returns the filenames whose task couldn't be sent, for lack of a
+node with room or because the broker failed.
+"""
+def send_replication_batch(filenames, trace_ids):
     replication_factor = flask_utilities.get_replication_factor()
-    all_storage_nodes = flask_utilities.get_all_storage_nodes()
     cur_storage_node = f"{MY_NODE}:{MY_PORT}"
-    available_sns = list(set(all_storage_nodes) - {cur_storage_node})
-    selected_sns = random.sample(available_sns, k=replication_factor)
-    app.logger.debug(f"Asynchronously replicate {filename} from {cur_storage_node} to {selected_sns}")
-    for count, dest_sn in enumerate(selected_sns):
-        task = celery.send_task(
-            'dfs_tasks.replicate',
-            args=[filename, cur_storage_node, dest_sn]
-        )
-        app.logger.debug(f"#{count+1}: Added task {task.id} for replication of {filename} to {dest_sn}")
+    node_loads = {sn: load for sn, load in get_health_registry().get_node_loads().items() if sn != cur_storage_node}
+    if flask_utilities.is_hash_ring_placement():
+        # every file has its own replica nodes on the ring; files sharing them share a task
+        batches = defaultdict(list)
+        for filename, trace_id in zip(filenames, trace_ids):
+            selected_sns = placement.choose_ring_nodes(filename, node_loads, replication_factor,
+                                                       num_bytes=get_stored_size(filename))
+            batches[tuple(selected_sns)].append((filename, trace_id))
+    else:
+        batch_size = sum(get_stored_size(filename) for filename in filenames)
+        # replicas go to the reachable nodes with room for the batch, weighted by free space
+        selected_sns = placement.choose_replica_nodes(node_loads, k=replication_factor, num_bytes=batch_size)
+        batches = {tuple(selected_sns): list(zip(filenames, trace_ids))}
+    unsent_filenames = []
+    for selected_sns, files in batches.items():
+        batch_filenames = [filename for filename, _ in files]
+        if not selected_sns:
+            app.logger.error(f"No reachable storage node has room for the replicas of {batch_filenames}.")
+            unsent_filenames.extend(batch_filenames)
+            continue
+        if len(selected_sns) < replication_factor:
+            app.logger.warning(f"Only {len(selected_sns)} of the {replication_factor} replicas of {batch_filenames} "
+                               f"can be placed on the reachable storage nodes.")
+        # primary -> r1 -> r2 ...: each node sends every file out once
+        chain = [cur_storage_node] + list(selected_sns)
+        try:
+            task = celery.send_task(
+                'dfs_tasks.replicate_batch',
+                args=[batch_filenames, chain],
+                # the worker reports how long the task waited in the broker
+                kwargs={'trace_ids': [trace_id for _, trace_id in files], 'queued_at': time.time()}
+            )
+        except Exception as e:
+            app.logger.error(f"Could not queue replication of {batch_filenames}: {str(e)}")
+            unsent_filenames.extend(batch_filenames)
+            continue
+        app.logger.debug(f"Added task {task.id} for replication of {len(files)} files along {chain} "
+                         f"(trace ids {[trace_id for _, trace_id in files]})")
+    return unsent_filenames
 
 if __name__ == '__main__':
     flask_utilities.create_storage_dir(dir_path=STORAGE_DIR)
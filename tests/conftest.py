@@ -0,0 +1,18 @@
+import os
+
+import flask_utilities
+import one_time_setup
+import pytest
+
+# the apps read the node they run as when imported
+os.environ.setdefault('NODE', 'master')
+os.environ.setdefault('PORT', '8820')
+
+
+@pytest.fixture
+def shard(tmp_path, monkeypatch):
+    db_name = str(tmp_path / "dfs.db")
+    one_time_setup.create_tables(db_name)
+    monkeypatch.setattr(flask_utilities, 'get_metadata_shards', lambda: [db_name])
+    monkeypatch.setattr(flask_utilities, 'get_metadata_previous_shards', lambda: [])
+    return db_name
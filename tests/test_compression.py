@@ -0,0 +1,73 @@
+import io
+import os
+
+import client
+import compression
+import http_pool
+import multipart_stream
+import pytest
+
+ENCODINGS = [
+    pytest.param(encoding, marks=pytest.mark.skipif(encoding not in compression.get_available_encodings(),
+                                                    reason=f"{encoding} isn't installed"))
+    for encoding in ('zlib', 'zstd', 'lz4')
+]
+DATA = b"".join(f"line {i}: some compressible text\n".encode() for i in range(20000))
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+@pytest.mark.parametrize('data', [b"", b"x", DATA])
+def test_round_trip(encoding, data):
+    assert compression.decompress_bytes(compression.compress_bytes(data, encoding), encoding) == data
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_streamed_round_trip_in_any_chunks(encoding):
+    compressor = compression.get_codec(encoding).compressor()
+    compressed = b"".join(compressor.compress(DATA[i:i + 1000]) for i in range(0, len(DATA), 1000))
+    compressed += compressor.flush()
+    chunks = [compressed[i:i + 7] for i in range(0, len(compressed), 7)]
+
+    assert len(compressed) < len(DATA) / 2
+    assert b"".join(compression.decompress_stream(chunks, encoding)) == DATA
+
+
+class FakeSession:
+    def post(self, url, data, headers):
+        self.body = b"".join(data)
+        self.boundary = multipart_stream.parse_boundary(headers['Content-Type'])
+        self.length = getattr(data, 'len', None)
+
+
+def post_upload(tmp_path, monkeypatch, data, compress_with):
+    filepath = tmp_path / "a.txt"
+    filepath.write_bytes(data)
+    session = FakeSession()
+    monkeypatch.setattr(http_pool, 'get_session', lambda: session)
+    monkeypatch.setattr(client, 'UPLOAD_CHUNK_SIZE', 4096)
+    client.post_upload_form('http://master/upload', {'file_hash': 'abc'}, str(filepath), compress_with)
+    reader = multipart_stream.MultipartReader(io.BytesIO(session.body), session.boundary)
+    fields, file_part = reader.read_fields()
+    return session, fields, file_part, b"".join(iter(reader.read, b""))
+
+
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_client_uploads_compressed_chunk_by_chunk(tmp_path, monkeypatch, encoding):
+    session, fields, file_part, sent = post_upload(tmp_path, monkeypatch, DATA, encoding)
+
+    assert fields == {'file_hash': 'abc', 'file_encoding': encoding, 'size_hint': str(len(DATA))}
+    assert file_part == ('input_file', 'a.txt')
+    assert len(sent) < len(DATA)
+    assert compression.decompress_bytes(sent, encoding) == DATA
+    # the compressed size isn't known up front
+    assert session.length is None
+
+
+def test_client_uploads_incompressible_data_raw(tmp_path, monkeypatch):
+    data = os.urandom(20000)
+
+    session, fields, _, sent = post_upload(tmp_path, monkeypatch, data, 'zlib')
+
+    assert fields == {'file_hash': 'abc'}
+    assert sent == data
+    assert session.length == len(session.body)
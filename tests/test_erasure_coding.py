@@ -0,0 +1,83 @@
+import configparser
+import itertools
+import os
+
+import erasure_coding
+import flask_utilities
+import master_core
+import pytest
+
+
+STRIPE_UNIT = 16
+
+
+def encode_fragments(codec, data):
+    fragments = [b""] * codec.total_fragments
+    stripe_size = codec.data_fragments * STRIPE_UNIT
+    for offset in range(0, len(data), stripe_size):
+        for fragment_index, unit in enumerate(codec.encode_stripe(data[offset:offset + stripe_size], STRIPE_UNIT)):
+            fragments[fragment_index] += unit
+    return fragments
+
+
+def get_units(fragments, indices, stripe_index):
+    return {i: fragments[i][stripe_index * STRIPE_UNIT:(stripe_index + 1) * STRIPE_UNIT] for i in indices}
+
+
+@pytest.mark.parametrize('data_fragments, parity_fragments', [(3, 2), (4, 2), (2, 1)])
+def test_decode_from_every_subset_of_k_fragments(data_fragments, parity_fragments):
+    codec = erasure_coding.ReedSolomon(data_fragments, parity_fragments)
+    data = os.urandom(data_fragments * STRIPE_UNIT * 2 + 5)
+    fragments = encode_fragments(codec, data)
+    num_stripes = len(fragments[0]) // STRIPE_UNIT
+
+    for indices in itertools.combinations(range(codec.total_fragments), data_fragments):
+        rebuilt = b"".join(
+            b"".join(codec.decode(get_units(fragments, indices, stripe_index)))
+            for stripe_index in range(num_stripes)
+        )
+        assert rebuilt[:len(data)] == data, indices
+
+
+def test_decode_needs_k_fragments():
+    codec = erasure_coding.ReedSolomon(3, 2)
+    fragments = encode_fragments(codec, os.urandom(3 * STRIPE_UNIT))
+
+    with pytest.raises(Exception):
+        codec.decode(get_units(fragments, (1, 4), 0))
+
+
+def test_degraded_partial_stripe_read():
+    codec = erasure_coding.ReedSolomon(3, 2)
+    data = os.urandom(3 * STRIPE_UNIT * 3 - 7)
+    fragments = encode_fragments(codec, data)
+    ec_file = {'data_fragments': 3, 'parity_fragments': 2, 'stripe_unit': STRIPE_UNIT}
+    # fragments 0 and 2 are lost, so every stripe comes back through the parity
+    surviving = (1, 3, 4)
+
+    for start, stop in [(5, 40), (40, 100), (0, len(data)), (len(data) - 3, len(data))]:
+        codec, stripe_size, first_stripe, last_stripe = master_core.get_stripe_span(ec_file, start, stop)
+        read = b"".join(
+            master_core.slice_stripe(b"".join(codec.decode(get_units(fragments, surviving, stripe_index))),
+                                     stripe_index, stripe_size, start, stop)
+            for stripe_index in range(first_stripe, last_stripe)
+        )
+        assert read == data[start:stop], (start, stop)
+
+
+def get_config(enabled, data_fragments, parity_fragments, num_nodes):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'erasure_coding': {'enabled': str(enabled), 'data_fragments': str(data_fragments),
+                           'parity_fragments': str(parity_fragments)},
+        'storage_nodes': {'machine_list_docker': ",\n".join(f"sn{i}:5000" for i in range(num_nodes))},
+    })
+    return config
+
+
+def test_check_config_rejects_more_fragments_than_nodes():
+    flask_utilities.check_config(get_config(True, 3, 2, 5))
+    flask_utilities.check_config(get_config(False, 3, 2, 4))
+
+    with pytest.raises(ValueError):
+        flask_utilities.check_config(get_config(True, 3, 2, 4))
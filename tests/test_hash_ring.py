@@ -0,0 +1,50 @@
+import flask_utilities
+import hash_ring
+import pytest
+
+NODES = [f"sn{i}:5000" for i in range(5)]
+KEYS = [f"file{i}.txt" for i in range(10000)]
+
+
+def get_primaries(ring):
+    return {key: ring.get_nodes(key, 1)[0] for key in KEYS}
+
+
+def test_adding_a_node_moves_about_1_in_n_keys():
+    before = get_primaries(hash_ring.HashRing(NODES, 128))
+    after = get_primaries(hash_ring.HashRing(NODES + ['sn5:5000'], 128))
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert len(moved) == pytest.approx(len(KEYS) / 6, rel=0.25)
+    # only to the new node
+    assert {after[key] for key in moved} == {'sn5:5000'}
+
+
+def test_removing_a_node_moves_only_its_keys():
+    before = get_primaries(hash_ring.HashRing(NODES, 128))
+    after = get_primaries(hash_ring.HashRing(NODES[1:], 128))
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert len(moved) == pytest.approx(len(KEYS) / 5, rel=0.25)
+    assert {before[key] for key in moved} == {NODES[0]}
+
+
+def test_keys_spread_evenly():
+    primaries = list(get_primaries(hash_ring.HashRing(NODES, 128)).values())
+
+    for node in NODES:
+        assert primaries.count(node) == pytest.approx(len(KEYS) / len(NODES), rel=0.25)
+
+
+@pytest.mark.parametrize('replication_factor', [0, 2, 4, 7])
+def test_get_file_nodes_returns_distinct_nodes(replication_factor, monkeypatch):
+    monkeypatch.setattr(flask_utilities, 'get_all_storage_nodes', lambda: NODES)
+    monkeypatch.setattr(flask_utilities, 'get_ring_virtual_nodes', lambda: 128)
+    monkeypatch.setattr(flask_utilities, 'get_replication_factor', lambda: replication_factor)
+
+    for key in KEYS[:200]:
+        nodes = hash_ring.get_file_nodes(key)
+        assert len(nodes) == min(1 + replication_factor, len(NODES))
+        assert len(set(nodes)) == len(nodes)
+        # the primary comes first, and more copies only add nodes after it
+        assert nodes == hash_ring.get_cluster_ring().get_nodes(key)[:len(nodes)]
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+
+import flask_utilities
+import hedging
+import pytest
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status_code = status
+        self.status = status
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+    def release(self):
+        self.closed.set()
+
+
+@pytest.fixture(autouse=True)
+def hedging_config(monkeypatch):
+    monkeypatch.setattr(flask_utilities, 'is_hedging_enabled', lambda: True)
+    monkeypatch.setattr(flask_utilities, 'get_hedging_initial_delay', lambda: 0.02)
+    monkeypatch.setattr(flask_utilities, 'get_hedging_min_delay', lambda: 0.02)
+    monkeypatch.setattr(flask_utilities, 'get_hedging_percentile', lambda: 95)
+
+
+def make_send(answers):
+    # sn_node -> (seconds before the answer, status)
+    responses = {sn_node: FakeResponse(status) for sn_node, (_, status) in answers.items()}
+
+    def send(sn_node):
+        time.sleep(answers[sn_node][0])
+        return responses[sn_node]
+    return send, responses
+
+
+def make_send_async(answers):
+    responses = {sn_node: FakeResponse(status) for sn_node, (_, status) in answers.items()}
+
+    async def send(sn_node):
+        await asyncio.sleep(answers[sn_node][0])
+        return responses[sn_node]
+    return send, responses
+
+
+@pytest.mark.parametrize('status', [404, 500])
+def test_hedge_wins_over_a_slow_error_answer(status):
+    reader = hedging.HedgedReader()
+    send, responses = make_send({'sn0': (0.2, status), 'sn1': (0, 200)})
+
+    assert reader.read(['sn0', 'sn1'], send) == ('sn1', responses['sn1'])
+    # the loser is closed once it answers
+    assert responses['sn0'].closed.wait(1)
+    assert not responses['sn1'].closed.is_set()
+    assert reader.get_stats()['hedges_won'] == 1
+
+
+@pytest.mark.parametrize('status', [404, 500])
+def test_error_answer_falls_back_on_the_next_node(status):
+    reader = hedging.HedgedReader()
+    send, responses = make_send({'sn0': (0, status), 'sn1': (0, 200)})
+
+    assert reader.read(['sn0', 'sn1'], send) == ('sn1', responses['sn1'])
+    assert responses['sn0'].closed.is_set()
+
+
+def test_error_answer_of_every_node_is_passed_on():
+    reader = hedging.HedgedReader()
+    send, responses = make_send({'sn0': (0, 404), 'sn1': (0, 404)})
+
+    assert reader.read(['sn0', 'sn1'], send) == ('sn1', responses['sn1'])
+    assert responses['sn0'].closed.is_set()
+    assert not responses['sn1'].closed.is_set()
+
+
+@pytest.mark.parametrize('status', [404, 500])
+def test_async_hedge_wins_over_a_slow_error_answer(status):
+    reader = hedging.HedgedReader()
+    send, responses = make_send_async({'sn0': (0.2, status), 'sn1': (0, 200)})
+
+    async def read():
+        result = await reader.read_async(['sn0', 'sn1'], send)
+        # let the loser answer
+        await asyncio.sleep(0.3)
+        return result
+
+    assert asyncio.run(read()) == ('sn1', responses['sn1'])
+    assert responses['sn0'].closed.is_set()
+    assert not responses['sn1'].closed.is_set()
@@ -0,0 +1,90 @@
+import flask_utilities
+import master_app
+import master_core
+import metadata_store
+import pytest
+
+
+@pytest.fixture
+def client(shard, monkeypatch):
+    monkeypatch.setattr(master_app, 'select_healthy_sn', lambda exclude_sns=None, num_bytes=0, filename=None: 'sn0:5000')
+    monkeypatch.setattr(master_app, 'get_read_candidates', lambda filename, pnode: [pnode])
+    return master_app.app.test_client()
+
+
+def stored_checksums(monkeypatch, checksums):
+    # what the SNs' /stat report, by filename
+    monkeypatch.setattr(master_app, 'get_sn_checksum', lambda sn_node, filename: checksums.get(filename))
+
+
+def get_checksum(file_size, file_hash):
+    return {'hash_algorithm': 'md5', 'file_hash': file_hash, 'file_size': file_size}
+
+
+def test_upload_locations_reserves_unique_names(client):
+    metadata_store.reserve_unique_filename('a.txt')
+
+    resp = client.post('/upload_locations', json={'files': [{'filename': 'a.txt'}, {'filename': 'dir/b.txt'}]})
+
+    assert resp.status_code == 200
+    locations = resp.get_json()['locations']
+    assert [location['status_code'] for location in locations] == [200, 200]
+    assert locations[0]['filename'] != 'a.txt'
+    assert locations[1]['filename'] == 'b.txt'
+    assert all(location['node'] == 'sn0:5000' and location['token'] for location in locations)
+
+
+def test_upload_commits_records_the_files_the_sns_hold(client, monkeypatch):
+    locations = client.post('/upload_locations', json={'files': [
+        {'filename': name, 'file_size': 10} for name in ('a.txt', 'b.txt', 'c.txt', 'd.txt')
+    ]}).get_json()['locations']
+    stored_checksums(monkeypatch, {
+        'a.txt': get_checksum(10, 'hash-a'),
+        'b.txt': get_checksum(10, 'hash-b'),
+        'c.txt': get_checksum(10, 'hash-c'),
+    })
+    files = [{'filename': location['filename'], 'node': location['node'], 'token': location['token'],
+              'file_size': 10, 'file_hash': f"hash-{location['filename'][0]}", 'hash_algorithm': 'md5'}
+             for location in locations]
+    files[1]['token'] = 'invalid'
+    files[2]['file_hash'] = 'hash-other'
+
+    resp = client.post('/upload_commits', json={'files': files})
+
+    assert resp.status_code == 200
+    # d.txt never reached its SN
+    assert [result['status_code'] for result in resp.get_json()['results']] == [200, 403, 409, 409]
+    record = metadata_store.get_file_record('a.txt')
+    assert (record['primary_node'], record['file_size'], record['file_hash']) == ('sn0:5000', 10, 'hash-a')
+    for filename in ('b.txt', 'c.txt', 'd.txt'):
+        assert metadata_store.get_file_record(filename) is None
+
+
+def test_download_locations_answers_per_file(client):
+    metadata_store.reserve_unique_filename('a.txt')
+    metadata_store.update_master_table('a.txt', 'sn0:5000', 10, 'hash-a', 'md5')
+
+    resp = client.post('/download_locations', json={'filenames': ['a.txt', 'missing.txt']})
+
+    assert resp.status_code == 200
+    locations = resp.get_json()['locations']
+    assert [location['status_code'] for location in locations] == [200, 404]
+    assert locations[0]['node'] == 'sn0:5000'
+    assert flask_utilities.is_transfer_token_valid(locations[0]['token'], 'download', 'sn0:5000', 'a.txt')
+
+
+def test_delete_removes_the_file_and_its_copies(client, monkeypatch):
+    deleted = []
+    monkeypatch.setattr(master_app, 'delete_stored_copies', deleted.extend)
+    monkeypatch.setattr(flask_utilities, 'is_dedup_enabled', lambda: True)
+    metadata_store.reserve_unique_filename('a.txt')
+    master_core.record_upload('a.txt', 'sn0:5000', 10, 'hash-a', 'md5')
+    metadata_store.add_content_reference('b.txt', 'md5', 'hash-a')
+
+    # still referenced by b.txt
+    assert client.delete('/delete', query_string={'filename': 'a.txt'}).status_code == 409
+    assert client.delete('/delete', query_string={'filename': 'b.txt'}).status_code == 200
+    assert deleted == []
+    assert client.delete('/delete', query_string={'filename': 'a.txt'}).status_code == 200
+    assert deleted == [('a.txt', 'sn0:5000')]
+    assert client.delete('/delete', query_string={'filename': 'a.txt'}).status_code == 404
@@ -0,0 +1,27 @@
+import asyncio
+import json
+
+import master_async_app
+from starlette.requests import ClientDisconnect
+
+
+class DisconnectingRequest:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+        raise ClientDisconnect()
+
+
+def test_upload_streaming_answers_when_the_client_goes_away_midway():
+    request = DisconnectingRequest([
+        b'--b\r\nContent-Disposition: form-data; name="other_file"; filename="a.txt"\r\n\r\n',
+        b'first bytes of the file',
+    ])
+
+    resp = asyncio.run(master_async_app.upload_streaming(request, 'b', None))
+
+    assert resp.status_code == 500
+    assert 'input_file' in json.loads(resp.body)['message']
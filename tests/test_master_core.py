@@ -0,0 +1,20 @@
+import master_core
+import pytest
+
+
+CHECKSUM = {'hash_algorithm': 'md5', 'file_hash': 'hash-a', 'file_size': 10}
+
+
+@pytest.mark.parametrize('checksum, file_size, file_hash, hash_algorithm, is_committed', [
+    (CHECKSUM, 10, 'hash-a', 'md5', True),
+    # a commit may leave out the size and hash
+    (CHECKSUM, None, None, 'md5', True),
+    (None, 10, 'hash-a', 'md5', False),
+    (CHECKSUM, 11, 'hash-a', 'md5', False),
+    (CHECKSUM, 10, 'hash-b', 'md5', False),
+    (CHECKSUM, 10, 'hash-a', 'sha256', False),
+])
+def test_check_committed_upload(checksum, file_size, file_hash, hash_algorithm, is_committed):
+    error = master_core.check_committed_upload('a.txt', 'sn0:5000', checksum, file_size, file_hash, hash_algorithm)
+
+    assert (error is None) == is_committed
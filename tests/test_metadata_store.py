@@ -0,0 +1,160 @@
+import sqlite3
+import time
+
+import flask_utilities
+import metadata_store
+import one_time_setup
+import pytest
+
+
+def test_update_master_tables_records_files_and_notifies(shard, monkeypatch):
+    changed = []
+    monkeypatch.setattr(metadata_store, '_change_listeners', [changed.extend])
+    metadata_store.reserve_unique_filenames(['a.txt', 'b.txt'])
+    metadata_store.update_master_tables([
+        ('a.txt', 'sn0:5000', 10, 'hash-a', 'md5'),
+        ('b.txt', 'sn1:5050', None, None, 'md5'),
+    ])
+
+    assert changed == ['a.txt', 'b.txt']
+    record = metadata_store.get_file_record('a.txt')
+    assert record['primary_node'] == 'sn0:5000'
+    assert (record['file_size'], record['file_hash'], record['hash_algorithm']) == (10, 'hash-a', 'md5')
+    assert record['created_at'] is not None
+    assert metadata_store.get_file_record('b.txt')['file_size'] is None
+    assert [r['filename'] for r in metadata_store.list_file_records()] == ['a.txt', 'b.txt']
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    db_names = [str(tmp_path / f"dfs{i}.db") for i in range(3)]
+    for db_name in db_names:
+        one_time_setup.create_tables(db_name)
+    monkeypatch.setattr(flask_utilities, 'get_metadata_shards', lambda: db_names)
+    monkeypatch.setattr(flask_utilities, 'get_metadata_previous_shards', lambda: [])
+    return db_names
+
+
+def get_ref_count(hash_algorithm, file_hash):
+    shard = metadata_store.get_shard(metadata_store.get_content_key(hash_algorithm, file_hash))
+    return metadata_store.get_connection(shard).execute(
+        "SELECT ref_count FROM content_index WHERE hash_algorithm=? AND file_hash=?;", (hash_algorithm, file_hash)
+    ).fetchone()[0]
+
+
+@pytest.mark.parametrize('shard_fixture', ['shard', 'shards'])
+def test_add_content_reference_aliases_and_counts(shard_fixture, request):
+    request.getfixturevalue(shard_fixture)
+    metadata_store.reserve_unique_filename('a.txt')
+    metadata_store.update_master_table('a.txt', 'sn0:5000', 10, 'hash-a', 'md5')
+    metadata_store.register_content('md5', 'hash-a', 'a.txt')
+
+    names = [metadata_store.add_content_reference(name, 'md5', 'hash-a') for name in ('b.txt', 'b.txt', 'a.txt')]
+
+    assert names[0] == 'b.txt'
+    assert len(set(names + ['a.txt'])) == 4
+    for name in names:
+        assert metadata_store.resolve_filename(name) == 'a.txt'
+        assert metadata_store.get_file_record(name)['primary_node'] == 'sn0:5000'
+    assert get_ref_count('md5', 'hash-a') == 4
+    assert metadata_store.add_content_reference('c.txt', 'md5', 'hash-other') is None
+
+
+def test_add_content_reference_skips_a_deleted_target(shards):
+    metadata_store.register_content('md5', 'hash-a', 'a.txt')
+
+    assert metadata_store.add_content_reference('b.txt', 'md5', 'hash-a') is None
+    assert metadata_store.get_file_record('b.txt') is None
+    assert get_ref_count('md5', 'hash-a') == 1
+
+
+def test_release_expired_filenames_keeps_recent_and_stored_names(shard):
+    metadata_store.reserve_unique_filenames(['old.txt', 'stored.txt'])
+    metadata_store.update_master_table('stored.txt', 'sn0:5000')
+    reserved_before = time.time()
+    metadata_store.reserve_unique_filename('new.txt')
+
+    assert metadata_store.release_expired_filenames(reserved_before) == ['old.txt']
+    # a released name can be reserved again; the others are still taken
+    assert metadata_store.reserve_unique_filename('old.txt') == 'old.txt'
+    assert metadata_store.reserve_unique_filename('new.txt') != 'new.txt'
+    assert metadata_store.return_pnode_of_file('stored.txt') == 'sn0:5000'
+
+
+def store_file(filename, primary_node='sn0:5000', file_hash='hash-a'):
+    metadata_store.reserve_unique_filename(filename)
+    metadata_store.update_master_table(filename, primary_node, 10, file_hash, 'md5')
+    metadata_store.register_content('md5', file_hash, filename)
+
+
+@pytest.mark.parametrize('shard_fixture', ['shard', 'shards'])
+def test_alias_reads_where_its_content_is_now(shard_fixture, request):
+    request.getfixturevalue(shard_fixture)
+    store_file('a.txt')
+    metadata_store.add_content_reference('b.txt', 'md5', 'hash-a')
+
+    # e.g. the rebalancer moving the stored file
+    assert metadata_store.move_copy(metadata_store.COPY_PRIMARY, 'a.txt', 'sn0:5000', 'sn1:5050')
+
+    assert metadata_store.get_file_record('b.txt')['primary_node'] == 'sn1:5050'
+    assert [r['primary_node'] for r in metadata_store.list_file_records()] == ['sn1:5050', 'sn1:5050']
+    assert metadata_store.resolve_filename('b.txt') == 'a.txt'
+    assert metadata_store.return_pnode_of_file('b.txt') is None
+
+
+@pytest.mark.parametrize('shard_fixture', ['shard', 'shards'])
+def test_delete_file_counts_down_the_references(shard_fixture, request):
+    request.getfixturevalue(shard_fixture)
+    store_file('a.txt')
+    metadata_store.update_replication_table('a.txt', 'sn1:5050')
+    metadata_store.add_content_reference('b.txt', 'md5', 'hash-a')
+
+    with pytest.raises(ValueError):
+        metadata_store.delete_file('a.txt')
+    # an alias has nothing stored of its own
+    assert metadata_store.delete_file('b.txt') == []
+    assert get_ref_count('md5', 'hash-a') == 1
+    assert metadata_store.get_file_record('b.txt') is None
+
+    assert metadata_store.delete_file('a.txt') == [('a.txt', 'sn0:5000'), ('a.txt', 'sn1:5050')]
+    assert metadata_store.get_file_record('a.txt') is None
+    assert metadata_store.get_sns_with_file_copy('a.txt') == []
+    assert metadata_store.add_content_reference('c.txt', 'md5', 'hash-a') is None
+    assert metadata_store.delete_file('a.txt') is None
+
+
+def test_delete_file_returns_blocks_and_their_replicas(shards):
+    metadata_store.reserve_unique_filename('big.bin')
+    blocks = [
+        {'block_index': i, 'block_name': f"big.bin.blk{i:05d}", 'node': f"sn{i}:5000", 'block_size': 5,
+         'block_hash': f"hash-{i}"}
+        for i in range(2)
+    ]
+    metadata_store.update_chunked_file_tables('big.bin', 10, 'hash-big', 'md5', 5, blocks)
+    metadata_store.update_replication_table('big.bin.blk00001', 'sn2:5000')
+
+    assert metadata_store.delete_file('big.bin') == [
+        ('big.bin.blk00000', 'sn0:5000'), ('big.bin.blk00001', 'sn1:5000'), ('big.bin.blk00001', 'sn2:5000')
+    ]
+    assert metadata_store.get_chunked_file('big.bin') is None
+    assert metadata_store.get_file_blocks('big.bin') == []
+    assert metadata_store.get_stored_copies() == []
+
+
+def test_older_aliases_are_migrated_to_content_references(tmp_path, monkeypatch):
+    db_name = str(tmp_path / "dfs.db")
+    conn = sqlite3.connect(db_name)
+    conn.execute(one_time_setup.get_sql_create_master_table())
+    conn.execute("CREATE TABLE file_aliases (filename VARCHAR(100) PRIMARY KEY, target_filename VARCHAR(100));")
+    conn.executemany("INSERT INTO master_node VALUES (?, ?, 10, 'hash-a', 'md5', 0);",
+                     [('a.txt', 'sn0:5000'), ('b.txt', 'sn0:5000')])
+    conn.execute("INSERT INTO file_aliases VALUES ('b.txt', 'a.txt');")
+    conn.commit()
+    conn.close()
+    one_time_setup.create_tables(db_name)
+    monkeypatch.setattr(flask_utilities, 'get_metadata_shards', lambda: [db_name])
+    monkeypatch.setattr(flask_utilities, 'get_metadata_previous_shards', lambda: [])
+    metadata_store.register_content('md5', 'hash-a', 'a.txt')
+
+    assert metadata_store.resolve_filename('b.txt') == 'a.txt'
+    assert metadata_store.get_file_record('b.txt')['primary_node'] == 'sn0:5000'
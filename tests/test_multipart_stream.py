@@ -0,0 +1,91 @@
+import io
+
+import multipart_stream
+import pytest
+
+
+def make_body(fields, data, filename='a.txt'):
+    body = multipart_stream.FormBody(fields, 'input_file', filename, [data])
+    boundary = multipart_stream.parse_boundary(body.content_type)
+    return b"".join(body), boundary
+
+
+def read_file(reader):
+    return b"".join(iter(reader.read, b""))
+
+
+# at chunk_size 1 every delimiter is split across reads
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64 * 1024])
+def test_fields_then_file_at_any_chunk_size(chunk_size):
+    # the file holds most of a delimiter, which must not end it
+    data = b"first line\r\n--not the boundary\r\n" + bytes(range(256)) * 4
+    body, boundary = make_body({'file_hash': 'abc', 'hash_algorithm': 'md5'}, data)
+    reader = multipart_stream.MultipartReader(io.BytesIO(body), boundary, chunk_size=chunk_size)
+
+    fields, file_part = reader.read_fields()
+
+    assert fields == {'file_hash': 'abc', 'hash_algorithm': 'md5'}
+    assert file_part == ('input_file', 'a.txt')
+    assert read_file(reader) == data
+    assert reader.next_part() is None
+
+
+def test_field_over_max_field_bytes():
+    body, boundary = make_body({'file_hash': 'a' * (multipart_stream.MAX_FIELD_BYTES + 1)}, b"data")
+    reader = multipart_stream.MultipartReader(io.BytesIO(body), boundary)
+
+    with pytest.raises(ValueError):
+        reader.read_fields()
+
+
+def test_body_ending_early():
+    body, boundary = make_body({'file_hash': 'abc'}, b"x" * 1000)
+    reader = multipart_stream.MultipartReader(io.BytesIO(body[:500]), boundary, chunk_size=64)
+    reader.read_fields()
+
+    with pytest.raises(ValueError):
+        read_file(reader)
+
+
+def test_drain_reads_the_rest_of_the_body():
+    body, boundary = make_body({}, b"x" * 1000)
+    stream = io.BytesIO(body)
+    reader = multipart_stream.MultipartReader(stream, boundary)
+
+    reader.drain()
+
+    assert stream.read() == b""
+    assert reader.next_part() is None
+
+
+def start_replay(data, max_bytes, chunk_size):
+    body, boundary = make_body({}, data)
+    reader = multipart_stream.MultipartReader(io.BytesIO(body), boundary, chunk_size=chunk_size)
+    reader.read_fields()
+    return multipart_stream.UploadReplay(reader, max_bytes)
+
+
+def test_replay_sends_the_file_again_from_its_start():
+    data = bytes(range(200))
+    replay = start_replay(data, max_bytes=1000, chunk_size=16)
+    first_try = replay.iter_body(b"head", b"tail")
+    # the SN fails after some of the file
+    sent = [next(first_try) for _ in range(4)]
+
+    assert sent[0] == b"head"
+    assert replay.can_replay()
+    assert b"".join(replay.iter_body(b"head", b"tail")) == b"head" + data + b"tail"
+
+
+def test_no_replay_after_overflow():
+    data = bytes(range(200))
+    replay = start_replay(data, max_bytes=50, chunk_size=16)
+    first_try = replay.iter_body(b"head", b"tail")
+    # past the bytes kept to retry
+    for _ in range(6):
+        next(first_try)
+
+    assert not replay.can_replay()
+    assert replay.chunks == []
+    # what is left of the file still goes out
+    assert b"".join(first_try).endswith(data[-16:] + b"tail")
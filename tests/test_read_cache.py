@@ -0,0 +1,103 @@
+import os
+import subprocess
+
+import flask_utilities
+import master_core
+import metadata_store
+import pytest
+import read_cache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(flask_utilities, 'get_read_cache_memory_max_file_size', lambda: 10)
+    monkeypatch.setattr(flask_utilities, 'get_read_cache_memory_bytes', lambda: 25)
+    monkeypatch.setattr(flask_utilities, 'get_read_cache_disk_max_file_size', lambda: 100)
+    monkeypatch.setattr(flask_utilities, 'get_read_cache_disk_bytes', lambda: 250)
+    monkeypatch.setattr(flask_utilities, 'get_read_cache_disk_dir', lambda: str(tmp_path / "cache"))
+    # the one master_core drops entries from
+    monkeypatch.setattr(read_cache, '_cache', read_cache.ReadCache())
+    return read_cache.get_read_cache()
+
+
+def fill(cache, filename, data, version='sn0:5000'):
+    file_hash = flask_utilities.calc_bytes_hash(data, 'md5')
+    assert b"".join(cache.fill(filename, version, [data[:3], data[3:]], len(data), file_hash, 'md5')) == data
+
+
+def read(cache, filename, version='sn0:5000'):
+    found = cache.get(filename, version)
+    if found is None:
+        return None
+    entry, fp = found
+    if fp is None:
+        return entry.data
+    with fp:
+        return fp.read()
+
+
+def test_memory_tier_evicts_the_least_recently_read(cache):
+    for filename in ('a', 'b'):
+        fill(cache, filename, filename.encode() * 10)
+    assert read(cache, 'a') == b"a" * 10
+
+    fill(cache, 'c', b"c" * 10)
+
+    assert read(cache, 'b') is None
+    assert read(cache, 'a') == b"a" * 10
+    assert read(cache, 'c') == b"c" * 10
+    stats = cache.get_stats()
+    assert stats['evictions'][read_cache.TIER_MEMORY] == 1
+    assert stats['bytes'][read_cache.TIER_MEMORY] == 20
+
+
+def test_disk_tier_evicts_and_removes_the_file(cache):
+    for filename in ('a', 'b', 'c'):
+        fill(cache, filename, filename.encode() * 100)
+
+    assert read(cache, 'a') is None
+    assert read(cache, 'c') == b"c" * 100
+    assert len(os.listdir(cache.get_disk_dir())) == 2
+    assert cache.get_stats()['evictions'][read_cache.TIER_DISK] == 1
+
+
+def test_fill_not_matching_the_hash_is_not_kept(cache):
+    chunks = cache.fill('a', 'sn0:5000', [b"a" * 10], 10, 'other-hash', 'md5')
+
+    assert b"".join(chunks) == b"a" * 10
+    assert read(cache, 'a') is None
+    assert cache.get_stats()['rejected_fills'] == 1
+
+
+def test_read_of_another_version_drops_the_entry(cache):
+    fill(cache, 'a', b"a" * 10)
+
+    assert read(cache, 'a', version='sn1:5050') is None
+    assert read(cache, 'a') is None
+    assert cache.get_stats()['invalidations'] == 1
+
+
+def test_primary_node_change_invalidates(shard, cache):
+    metadata_store.reserve_unique_filename('a.txt')
+    master_core.record_upload('a.txt', 'sn0:5000', 10, 'hash-a', 'md5')
+    fill(cache, 'a.txt', b"a" * 10)
+
+    # the rebalancer moving it
+    assert metadata_store.move_copy(metadata_store.COPY_PRIMARY, 'a.txt', 'sn0:5000', 'sn1:5050')
+
+    assert read(cache, 'a.txt', version=None) is None
+    assert cache.get_stats()['invalidations'] == 1
+
+
+def test_disk_dirs_of_gone_masters_are_removed(cache, tmp_path):
+    root = tmp_path / "cache"
+    gone = subprocess.Popen(['true'])
+    gone.wait()
+    (root / f"{read_cache.DISK_DIR_PREFIX}{gone.pid}").mkdir(parents=True)
+    (root / f"{read_cache.DISK_DIR_PREFIX}{gone.pid}" / "entry").write_bytes(b"x")
+    (root / "other").mkdir()
+
+    disk_dir = cache.get_disk_dir()
+
+    assert disk_dir == str(root / f"{read_cache.DISK_DIR_PREFIX}{os.getpid()}")
+    assert sorted(os.listdir(root)) == sorted([os.path.basename(disk_dir), "other"])
@@ -0,0 +1,74 @@
+import os
+
+import compression
+import flask_utilities
+import pytest
+import replication
+
+
+@pytest.fixture
+def storage_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(flask_utilities, 'get_replication_storage_root', lambda: str(tmp_path))
+    return tmp_path
+
+
+def store_file(storage_root, node_addr, filename, data, checksum_data=None, encoding=None):
+    storage_dir = replication.get_node_storage_dir(node_addr)
+    os.makedirs(storage_dir, exist_ok=True)
+    with open(os.path.join(storage_dir, filename), "wb") as fp:
+        fp.write(compression.compress_bytes(data, encoding) if encoding else data)
+    file_hash = flask_utilities.calc_bytes_hash(checksum_data or data, 'md5')
+    flask_utilities.write_checksum_file(storage_dir, filename, 'md5', file_hash, len(data), encoding)
+
+
+def test_zero_copy_file_falls_back_to_sendfile_midway(tmp_path, monkeypatch):
+    data = os.urandom(10 * 1000 + 7)
+    (tmp_path / "src").write_bytes(data)
+    monkeypatch.setattr(replication, 'COPY_CHUNK_SIZE', 1000)
+    calls = []
+
+    def copy_file_range(*args):
+        calls.append(args)
+        if len(calls) > 3:
+            raise OSError("EXDEV")
+        return os.copy_file_range(*args)
+    monkeypatch.setattr(replication.os, 'copy_file_range', copy_file_range, raising=False)
+
+    replication.zero_copy_file(str(tmp_path / "src"), str(tmp_path / "dest"), replication.Throttle(0))
+
+    assert (tmp_path / "dest").read_bytes() == data
+    assert not (tmp_path / "dest.part").exists()
+
+
+def test_zero_copy_file_removes_the_part_file_on_failure(tmp_path):
+    (tmp_path / "src").write_bytes(b"data")
+
+    def verify(filepath):
+        raise Exception("rejected")
+
+    with pytest.raises(Exception):
+        replication.zero_copy_file(str(tmp_path / "src"), str(tmp_path / "dest"), replication.Throttle(0), verify)
+    assert not (tmp_path / "dest").exists()
+    assert not (tmp_path / "dest.part").exists()
+
+
+@pytest.mark.parametrize('encoding', [None, 'zlib'])
+def test_copy_local_copies_the_file_and_its_checksum(storage_root, encoding):
+    store_file(storage_root, 'sn0:5000', 'a.txt', b"hello " * 100, encoding=encoding)
+
+    replication.copy_local('a.txt', 'sn0:5000', 'sn1:5050', replication.Throttle(0))
+
+    src_dir = replication.get_node_storage_dir('sn0:5000')
+    dest_dir = replication.get_node_storage_dir('sn1:5050')
+    with open(os.path.join(src_dir, 'a.txt'), "rb") as src, open(os.path.join(dest_dir, 'a.txt'), "rb") as dest:
+        assert dest.read() == src.read()
+    assert flask_utilities.read_checksum_file(dest_dir, 'a.txt') == flask_utilities.read_checksum_file(src_dir, 'a.txt')
+
+
+def test_copy_local_rejects_a_copy_not_matching_the_hash(storage_root):
+    store_file(storage_root, 'sn0:5000', 'a.txt', b"hello", checksum_data=b"other")
+
+    with pytest.raises(Exception):
+        replication.copy_local('a.txt', 'sn0:5000', 'sn1:5050', replication.Throttle(0))
+    dest_dir = replication.get_node_storage_dir('sn1:5050')
+    assert os.listdir(dest_dir) == []
@@ -0,0 +1,43 @@
+import flask_utilities
+import metadata_store
+import one_time_setup
+import reshard
+
+
+def count_rows(shard, table, where, params):
+    return metadata_store.get_connection(shard).execute(
+        f"SELECT COUNT(*) FROM {table} WHERE {where};", params
+    ).fetchone()[0]
+
+
+def test_reshard_moves_rows_to_their_new_shards(tmp_path, monkeypatch):
+    db_names = [str(tmp_path / f"dfs{i}.db") for i in range(3)]
+    for db_name in db_names:
+        one_time_setup.create_tables(db_name)
+    monkeypatch.setattr(flask_utilities, 'get_metadata_previous_shards', lambda: [])
+    monkeypatch.setattr(flask_utilities, 'get_metadata_shards', lambda: db_names[:1])
+    filenames = [f"file{i}.txt" for i in range(30)]
+    # replicas of a block are recorded under the block's own name
+    replicated_names = filenames + [flask_utilities.get_block_name(filename, 1) for filename in filenames]
+    metadata_store.reserve_unique_filenames(filenames)
+    metadata_store.update_master_tables([(filename, 'sn0:5000', 1, f"hash-{filename}", 'md5') for filename in filenames])
+    metadata_store.add_replication_records([(name, 'sn1:5050') for name in replicated_names])
+    metadata_store.register_contents([('md5', f"hash-{filename}", filename) for filename in filenames])
+
+    # grown to 3 shards
+    monkeypatch.setattr(flask_utilities, 'get_metadata_shards', lambda: db_names)
+    monkeypatch.setattr(flask_utilities, 'get_metadata_previous_shards', lambda: db_names[:1])
+    num_filenames, num_replicas, num_contents = reshard.reshard_shard(db_names[0])
+
+    assert 0 < num_filenames < len(filenames)
+    assert num_replicas > 0 and num_contents > 0
+    for filename in filenames:
+        shard = metadata_store.get_shard(filename)
+        assert count_rows(shard, 'master_node', "filename=?", (filename,)) == 1
+        assert sum(count_rows(db_name, 'master_node', "filename=?", (filename,)) for db_name in db_names) == 1
+        content_shard = metadata_store.get_shard(metadata_store.get_content_key('md5', f"hash-{filename}"))
+        assert count_rows(content_shard, 'content_index', "file_hash=?", (f"hash-{filename}",)) == 1
+    for name in replicated_names:
+        assert count_rows(metadata_store.get_shard(name), 'replication_data', "filename=?", (name,)) == 1
+        assert metadata_store.get_sns_with_file_copy(name) == ['sn1:5050']
+    assert reshard.reshard_shard(db_names[0]) == (0, 0, 0)
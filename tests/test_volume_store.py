@@ -0,0 +1,83 @@
+import os
+
+import flask_utilities
+import pytest
+import volume_store
+
+
+def get_checksum(data):
+    return flask_utilities.make_checksum('md5', flask_utilities.calc_bytes_hash(data, 'md5'), len(data))
+
+
+@pytest.fixture
+def storage_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(flask_utilities, 'get_packing_volume_size', lambda: 64)
+    monkeypatch.setattr(flask_utilities, 'get_packing_compaction_garbage_ratio', lambda: 0.5)
+    # compaction runs only when a test calls it
+    monkeypatch.setattr(flask_utilities, 'get_packing_compaction_interval', lambda: 3600)
+    return str(tmp_path)
+
+
+def test_put_and_read(storage_dir):
+    store = volume_store.VolumeStore(storage_dir)
+    store.put('a.txt', b"a" * 10, get_checksum(b"a" * 10))
+    store.put('b.txt', b"b" * 20, get_checksum(b"b" * 20))
+    store.put('a.txt', b"A" * 5, get_checksum(b"A" * 5))
+
+    assert store.read('a.txt') == (b"A" * 5, get_checksum(b"A" * 5))
+    assert store.read('b.txt') == (b"b" * 20, get_checksum(b"b" * 20))
+    assert store.read('c.txt') is None
+    assert store.list_files() == {'a.txt': 5, 'b.txt': 20}
+    assert store.delete('b.txt')
+    assert 'b.txt' not in store
+
+
+def test_compact_moves_live_files(storage_dir):
+    store = volume_store.VolumeStore(storage_dir)
+    for i in range(4):
+        store.put(f"{i}.txt", bytes([i]) * 30, get_checksum(bytes([i]) * 30))
+    first_volume = store.volumes[1].path
+    store.delete('0.txt')
+
+    store.compact()
+
+    assert not os.path.exists(first_volume)
+    assert 1 not in store.volumes
+    for i in range(1, 4):
+        assert store.read(f"{i}.txt")[0] == bytes([i]) * 30
+    assert store.get_stats()['compactions'] == 1
+
+
+def test_reload_keeps_the_index(storage_dir):
+    store = volume_store.VolumeStore(storage_dir)
+    store.put('a.txt', b"a" * 10, get_checksum(b"a" * 10))
+    store.put('b.txt', b"b" * 60, get_checksum(b"b" * 60))
+
+    reloaded = volume_store.VolumeStore(storage_dir)
+
+    assert reloaded.read('a.txt') == (b"a" * 10, get_checksum(b"a" * 10))
+    assert reloaded.read('b.txt')[0] == b"b" * 60
+    assert reloaded.get_stats()['live_bytes'] == 70
+
+
+def test_reload_drops_files_of_a_truncated_volume(storage_dir):
+    store = volume_store.VolumeStore(storage_dir)
+    store.put('a.txt', b"a" * 10, get_checksum(b"a" * 10))
+    store.put('b.txt', b"b" * 20, get_checksum(b"b" * 20))
+    os.truncate(store.volumes[1].path, 25)
+
+    reloaded = volume_store.VolumeStore(storage_dir)
+
+    assert reloaded.read('a.txt')[0] == b"a" * 10
+    assert 'b.txt' not in reloaded
+    assert volume_store.VolumeStore(storage_dir).list_files() == {'a.txt': 10}
+
+
+def test_corrupted_bytes_are_detected(storage_dir):
+    store = volume_store.VolumeStore(storage_dir)
+    store.put('a.txt', b"a" * 10, get_checksum(b"a" * 10))
+    os.pwrite(store.volumes[1].fd, b"x", 3)
+
+    with pytest.raises(Exception):
+        store.read('a.txt')
+    assert 'a.txt' not in volume_store.VolumeStore(storage_dir)
@@ -0,0 +1,307 @@
+"""
+Small files of a storage node packed into append-only volume files
+
+Creating, writing and later opening one file per small object costs the SN
+more than moving its bytes. With packing on, files of up to max_file_size
+bytes are appended to the current volume under <storage dir>/.volumes
+instead, and an index maps each name to its volume, offset and length along
+with the checksum which would otherwise be kept in .checksums. The index is
+held in memory and persisted in a SQLite file next to the volumes; a read is
+one pread on a volume kept open. Appends are fsynced before they are indexed,
+and the CRC-32 of the stored bytes is kept in the index and checked when the
+index is loaded and on every read, so an entry never points at bytes the
+volume lost or garbled.
+
+Storing a name again leaves its old bytes behind as garbage. A background
+thread rewrites the live files of a volume whose garbage reaches
+compaction_garbage_ratio of its size into the current volume and deletes it.
+A plain file of the same name (copied in by the replication worker) is newer
+than the packed one and takes precedence; compaction drops such entries.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import flask_utilities
+
+VOLUME_DIR = '.volumes'
+INDEX_DB = 'index.db'
+VOLUME_NAME_FORMAT = "volume_{volume_id:06d}.dat"
+
+logger = logging.getLogger(__name__)
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class PackedFile:
+    def __init__(self, volume_id, offset, length, checksum, crc):
+        self.volume_id = volume_id
+        self.offset = offset
+        self.length = length
+        self.checksum = checksum
+        # CRC-32 of the stored bytes; None for entries indexed before it was kept
+        self.crc = crc
+
+
+class Volume:
+    def __init__(self, volume_id, path):
+        self.volume_id = volume_id
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.live_bytes = 0
+        # reads in progress; the fd of a compacted volume is closed after the last one
+        self.readers = 0
+        # appends not indexed yet; the volume isn't compacted until they are
+        self.writers = 0
+        self.retired = False
+
+    def get_garbage_ratio(self):
+        if self.size == 0:
+            return 0.0
+        return 1 - self.live_bytes / self.size
+
+
+class VolumeStore:
+    def __init__(self, storage_dir):
+        self.storage_dir = storage_dir
+        self.volume_dir = os.path.join(storage_dir, VOLUME_DIR)
+        flask_utilities.create_storage_dir(self.volume_dir)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.volumes = {}
+        self.active = None
+        self.stats = {'puts': 0, 'reads': 0, 'compactions': 0, 'compacted_bytes': 0}
+        self.conn = sqlite3.connect(os.path.join(self.volume_dir, INDEX_DB), isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS packed_files (
+            filename TEXT PRIMARY KEY,
+            volume_id INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            crc32 INTEGER
+        );""")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(packed_files);")}
+        if 'crc32' not in columns:
+            self.conn.execute("ALTER TABLE packed_files ADD COLUMN crc32 INTEGER;")
+        self.load()
+        self.compaction_thread = threading.Thread(target=self.compaction_worker, daemon=True)
+        self.compaction_thread.start()
+
+    def load(self):
+        for name in sorted(os.listdir(self.volume_dir)):
+            if name.startswith('volume_') and name.endswith('.dat'):
+                volume_id = int(name[len('volume_'):-len('.dat')])
+                self.volumes[volume_id] = Volume(volume_id, os.path.join(self.volume_dir, name))
+        rows = self.conn.execute("SELECT filename, volume_id, offset, length, checksum, crc32 FROM packed_files;")
+        lost = []
+        for filename, volume_id, offset, length, checksum, crc in rows.fetchall():
+            volume = self.volumes.get(volume_id)
+            if volume is None or offset + length > volume.size \
+                    or (crc is not None and zlib.crc32(os.pread(volume.fd, length, offset)) != crc):
+                # the volume lost or garbled the data (e.g. not synced before a crash)
+                lost.append(filename)
+                continue
+            self.files[filename] = PackedFile(volume_id, offset, length, json.loads(checksum), crc)
+            volume.live_bytes += length
+        if lost:
+            logger.error(f"Dropped {len(lost)} files which {self.volume_dir} no longer holds intact: {lost}")
+            self.conn.executemany("DELETE FROM packed_files WHERE filename = ?;", [(filename,) for filename in lost])
+        if self.volumes:
+            self.active = self.volumes[max(self.volumes)]
+        else:
+            self.active = self.new_volume()
+
+    def new_volume(self):
+        volume_id = max(self.volumes, default=0) + 1
+        volume = Volume(volume_id, os.path.join(self.volume_dir, VOLUME_NAME_FORMAT.format(volume_id=volume_id)))
+        self.volumes[volume_id] = volume
+        return volume
+
+    def __contains__(self, filename):
+        with self.lock:
+            return filename in self.files
+
+    def get_checksum(self, filename):
+        with self.lock:
+            packed_file = self.files.get(filename)
+            return dict(packed_file.checksum) if packed_file else None
+
+    """
+    Size of filename as stored (compressed if it is), or None if it isn't packed
+    """
+    def get_stored_size(self, filename):
+        with self.lock:
+            packed_file = self.files.get(filename)
+            return packed_file.length if packed_file else None
+
+    """
+    Stored size of every packed file by name
+    """
+    def list_files(self):
+        with self.lock:
+            return {filename: packed_file.length for filename, packed_file in self.files.items()}
+
+    """
+    Append data, the stored bytes of filename, and index it with its checksum
+    """
+    def put(self, filename, data, checksum):
+        with self.lock:
+            volume = self.active
+            if volume.size > 0 and volume.size + len(data) > flask_utilities.get_packing_volume_size():
+                volume = self.active = self.new_volume()
+            offset = volume.size
+            # the space is reserved; writers of other files don't wait for this one's bytes
+            volume.size += len(data)
+            volume.writers += 1
+        try:
+            os.pwrite(volume.fd, data, offset)
+            # the index must not get ahead of the volume's bytes on disk
+            os.fsync(volume.fd)
+            self._index(filename, PackedFile(volume.volume_id, offset, len(data), checksum, zlib.crc32(data)))
+        finally:
+            with self.lock:
+                volume.writers -= 1
+                self.stats['puts'] += 1
+
+    def _index(self, filename, packed_file, expected=None):
+        with self.lock:
+            current = self.files.get(filename)
+            if expected is not None and current is not expected:
+                # stored again or deleted while compaction moved it
+                return False
+            self.conn.execute(
+                "INSERT OR REPLACE INTO packed_files (filename, volume_id, offset, length, checksum, crc32) "
+                "VALUES (?, ?, ?, ?, ?, ?);",
+                (filename, packed_file.volume_id, packed_file.offset, packed_file.length,
+                 json.dumps(packed_file.checksum), packed_file.crc)
+            )
+            if current is not None:
+                self.volumes[current.volume_id].live_bytes -= current.length
+            self.files[filename] = packed_file
+            self.volumes[packed_file.volume_id].live_bytes += packed_file.length
+            return True
+
+    """
+    Stored bytes and checksum of filename, or None if it isn't packed
+    """
+    def read(self, filename):
+        with self.lock:
+            packed_file = self.files.get(filename)
+            if packed_file is None:
+                return None
+            volume = self.volumes[packed_file.volume_id]
+            volume.readers += 1
+            self.stats['reads'] += 1
+        try:
+            data = os.pread(volume.fd, packed_file.length, packed_file.offset)
+        finally:
+            self._release(volume)
+        if len(data) != packed_file.length:
+            raise Exception(f"Volume {volume.volume_id} is missing {packed_file.length - len(data)} bytes of {filename}.")
+        if packed_file.crc is not None and zlib.crc32(data) != packed_file.crc:
+            raise Exception(f"Volume {volume.volume_id} holds corrupted bytes of {filename}.")
+        return data, dict(packed_file.checksum)
+
+    def _release(self, volume):
+        with self.lock:
+            volume.readers -= 1
+            if volume.retired and volume.readers == 0:
+                os.close(volume.fd)
+
+    def delete(self, filename):
+        with self.lock:
+            packed_file = self.files.pop(filename, None)
+            if packed_file is None:
+                return False
+            self.conn.execute("DELETE FROM packed_files WHERE filename = ?;", (filename,))
+            self.volumes[packed_file.volume_id].live_bytes -= packed_file.length
+            return True
+
+    def compaction_worker(self):
+        while True:
+            time.sleep(flask_utilities.get_packing_compaction_interval())
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Compaction of {self.volume_dir} failed: {str(e)}")
+
+    """
+    Rewrite the volumes with too much garbage, except the one being appended to
+    """
+    def compact(self):
+        garbage_ratio = flask_utilities.get_packing_compaction_garbage_ratio()
+        with self.lock:
+            volumes = [volume for volume in self.volumes.values()
+                       if volume is not self.active and volume.writers == 0
+                       and volume.get_garbage_ratio() >= garbage_ratio]
+        for volume in volumes:
+            self.compact_volume(volume)
+
+    def compact_volume(self, volume):
+        with self.lock:
+            packed_files = [(filename, packed_file) for filename, packed_file in self.files.items()
+                            if packed_file.volume_id == volume.volume_id]
+        moved_bytes = 0
+        for filename, packed_file in packed_files:
+            if os.path.isfile(os.path.join(self.storage_dir, filename)):
+                # superseded by a plain copy of the file
+                self._drop(filename, packed_file, volume)
+                continue
+            data = os.pread(volume.fd, packed_file.length, packed_file.offset)
+            crc = zlib.crc32(data)
+            if len(data) != packed_file.length or (packed_file.crc is not None and crc != packed_file.crc):
+                logger.error(f"Dropping {filename} from {volume.path}: its bytes are corrupted.")
+                self._drop(filename, packed_file, volume)
+                continue
+            with self.lock:
+                target = self.active
+                if target.size > 0 and target.size + len(data) > flask_utilities.get_packing_volume_size():
+                    target = self.active = self.new_volume()
+                offset = target.size
+                target.size += len(data)
+            os.pwrite(target.fd, data, offset)
+            os.fsync(target.fd)
+            if self._index(filename, PackedFile(target.volume_id, offset, len(data), packed_file.checksum, crc),
+                           expected=packed_file):
+                moved_bytes += len(data)
+        with self.lock:
+            del self.volumes[volume.volume_id]
+            volume.retired = True
+            if volume.readers == 0:
+                os.close(volume.fd)
+            self.stats['compactions'] += 1
+            self.stats['compacted_bytes'] += volume.size - moved_bytes
+        os.remove(volume.path)
+        logger.info(f"Compacted {volume.path}: moved {moved_bytes} of {volume.size} bytes.")
+
+    def _drop(self, filename, packed_file, volume):
+        with self.lock:
+            if self.files.get(filename) is packed_file:
+                self.files.pop(filename)
+                self.conn.execute("DELETE FROM packed_files WHERE filename = ?;", (filename,))
+                volume.live_bytes -= packed_file.length
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['files'] = len(self.files)
+            stats['volumes'] = len(self.volumes)
+            stats['volume_bytes'] = sum(volume.size for volume in self.volumes.values())
+            stats['live_bytes'] = sum(volume.live_bytes for volume in self.volumes.values())
+        return stats
+
+
+def get_volume_store(storage_dir):
+    with _stores_lock:
+        store = _stores.get(storage_dir)
+        if store is None:
+            store = _stores[storage_dir] = VolumeStore(storage_dir)
+        return store